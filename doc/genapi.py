@@ -74,11 +74,13 @@ def dataflow():
         ('core', 'instrument definition'),
         ('data', 'module interchange formats'),
         ('deps', 'graph dependeny resolution'),
+        ('executor', 'worker pool for concurrent node evaluation'),
         #('doi_resolve', ??),
         ('fakeredis', 'memory-based cache manager with redis interface'),
         ('fetch', 'fetch data from remote data source, with caching'),
         ('rst2html', 'convert restructured text document to html'),
         ('store', 'template serializer'),
+        ('trace', 'timing and cache statistics for template nodes'),
         ('lib.err1d', '1-D error propagation functions'),
         ('lib.errutil', 'extensions to the PyPI uncertainties package'),
         ('lib.formatnum', 'nice formatting of uncertain numbers'),
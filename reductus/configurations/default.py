@@ -19,11 +19,36 @@ config = {
     # ssl_args for https serving the rpc
     # ssl_args = {"keyfile": None, "certfile": None}
 
-    # Cache engines are diskcache, redis, or memory if not specified
+    # Cache engines are diskcache, redis, file, or memory if not specified.
+    # The file engine takes cachedir, file_cachedir, size and size_limit params.
+    # Use "local_bytes": {"maxbytes": int(2**28)} to keep the encoded bytes
+    # of recently used entries in process memory in front of redis or
+    # diskcache.
+    # With redis, use "lease": {"ttl": 300} so that server processes wait
+    # for a node being calculated by another process instead of repeating it.
     "cache": {
         "engine": "",
         "params": {"size_limit": int(4*2**30)}
     },
+    # Executor engines are threads, processes, or serial if not specified.
+    # With threads or processes, independent template nodes are evaluated
+    # concurrently on a pool of max_workers.
+    "executor": {
+        "engine": "",
+        "params": {"max_workers": 4}
+    },
+    # Set "jobs" to enable the submit_job api.  The local broker runs the
+    # jobs on worker threads in a single server process.  When running
+    # several server processes (start_flask_many.sh), use the redis broker
+    # so that job_status requests reaching any process find the job, with
+    # "workers": 0 and worker processes started by
+    #     python -m reductus.web_gui.jobs config.json
+    # unless uwsgi is started with --enable-threads.
+    #"jobs": {"broker": "local", "workers": 2},
+    #"jobs": {"broker": "redis", "workers": 0, "params": {"host": "localhost"}},
+    # Set expose_stats to serve node timings and cache hit counts
+    # from /RPC2/get_stats.
+    "expose_stats": False,
     "data_sources": [
         {
             "name": "local",
@@ -47,6 +47,20 @@ def nocache(action):
     action.cached = False
     return action
 
+def pure(action):
+    """
+    Decorator which adds the *pure* attribute to the function.
+
+    Use *@pure* for single input actions whose result depends only on
+    their arguments and which do not modify their inputs.  When a worker
+    pool is configured (see :mod:`.executor`), the action will be called
+    concurrently for each dataset in the bundle rather than one dataset
+    after another.  The outputs are returned in the same order as the
+    inputs.
+    """
+    action.pure = True
+    return action
+
 def module(tag=""):
     """
     Decorator adds *group=tag* as an attribute to the function.
@@ -8,6 +8,14 @@ need a single shared cache.  Call *cache.use_redis(redis args)* during
 program configuration to set up redis, otherwise the default is to use
 an in-memory cache.   The calculation library will call *cache.get_cache()*
 to retrieve the cache connection, allowing calculations to be memoized.
+
+Cached values are stored using :func:`dumps`, which writes the large
+numpy arrays after the pickled object rather than inside it, so that
+:func:`loads` can use them in place without copying.
+
+Entries which are being calculated can be claimed with
+:meth:`CacheManager.claim` so that concurrent requests for the same
+entry wait for the first calculation rather than repeating it.
 """
 import warnings
 import sys
@@ -15,6 +23,8 @@ import os
 import subprocess
 import time
 import tempfile
+import struct
+import threading
 
 try:
     # CRUFT: use cPickle for python 2.7
@@ -24,13 +34,98 @@ except ImportError:
 
 PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL # use the best
 
+# Cache entry layout for pickle protocol 5 and above:
+#    magic, number of buffers, pickle length, buffer lengths,
+#    pickle data, buffers
+# Each buffer starts on a BUFFER_ALIGNMENT boundary so that arrays can
+# be used directly from the stored string.
+CODEC_MAGIC = b"RDX5"
+BUFFER_ALIGNMENT = 64
+_HEADER = struct.Struct("<4sIQ")
+_LENGTH = struct.Struct("<Q")
+
+def _padding(offset):
+    return -offset % BUFFER_ALIGNMENT
+
+def dumps(value, protocol=PICKLE_PROTOCOL):
+    """
+    Serialize *value* for storage in the cache.
+
+    Contiguous numpy arrays are stored out-of-band following the pickle
+    data.  Protocols before 5 do not support this, and so the value is
+    stored as a plain pickle.
+    """
+    if protocol < 5:
+        return pickle.dumps(value, protocol=protocol)
+    buffers = []
+    data = pickle.dumps(value, protocol=protocol,
+                        buffer_callback=buffers.append)
+    views = [buffer.raw() for buffer in buffers]
+    parts = [_HEADER.pack(CODEC_MAGIC, len(views), len(data))]
+    parts.extend(_LENGTH.pack(view.nbytes) for view in views)
+    parts.append(data)
+    offset = sum(len(part) for part in parts)
+    for view in views:
+        pad = _padding(offset)
+        parts.append(b"\0"*pad)
+        parts.append(view)
+        offset += pad + view.nbytes
+    return b"".join(parts)
+
+def loads(string):
+    """
+    Restore a value stored with :func:`dumps`.
+
+    The arrays in the value are views into *string*.  If *string* is
+    immutable (e.g., *bytes*), then it is first copied to a *bytearray*
+    so that the arrays are writable.  Pass a *bytearray* or a writable
+    memory map to avoid the copy.  Plain pickles are also accepted.
+    """
+    if string[:len(CODEC_MAGIC)] != CODEC_MAGIC:
+        return pickle.loads(string)
+    view = memoryview(string)
+    if view.readonly:
+        view = memoryview(bytearray(view))
+    _, count, size = _HEADER.unpack_from(view)
+    offset = _HEADER.size
+    lengths = [_LENGTH.unpack_from(view, offset + k*_LENGTH.size)[0]
+               for k in range(count)]
+    offset += count*_LENGTH.size
+    data = view[offset:offset+size]
+    offset += size
+    buffers = []
+    for length in lengths:
+        offset += _padding(offset)
+        buffers.append(view[offset:offset+length])
+        offset += length
+    return pickle.loads(data, buffers=buffers)
+
+def _nullable(fn, string):
+    return None if string is None else fn(string)
+
+def _read_mapped(cache, key):
+    """
+    Return a copy-on-write memory map of the diskcache entry for *key*.
+
+    Large diskcache entries are stored in their own files, so the arrays
+    can be paged in as they are used rather than read up front.  Small
+    entries are stored in the database and returned as *bytes*.  Missing
+    entries return None.
+    """
+    import mmap
+    handle = cache.get(key, read=True)
+    if not hasattr(handle, 'fileno'):
+        return handle
+    with handle:
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_COPY)
+
 def memory_cache():
     from . import fakeredis
     return fakeredis.MemoryCache()
 
-def file_cache(cachedir="~/.reductus/cache"):
+def file_cache(cachedir="~/.reductus/cache", **kwargs):
     from . import fakeredis
-    return fakeredis.FileBasedCache(cachedir=cachedir)
+    return fakeredis.FileBasedCache(cachedir=cachedir, **kwargs)
 
 
 # port 6379 is the default port value for the python redis connection
@@ -75,21 +170,50 @@ class CacheManager(object):
         self._cache = None
         self._file_cache = None
         self._engine = None
+        self._cache_engine = None
         self._use_compression = False
         self._pickle_protocol = PICKLE_PROTOCOL
+        self._local_bytes = None
+        self._io = threading.local()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._lease_ttl = None
+        self._lease_poll = 0.2
+        self._lease_tokens = {}
+        self._lease_pool = None
 
     @property
     def engine(self):
         return self._engine
 
+    @property
+    def local_hits(self):
+        local = self._local_bytes
+        return local.cache.hits if local is not None else 0
+
+    @property
+    def local_misses(self):
+        local = self._local_bytes
+        return local.cache.misses if local is not None else 0
+
+    def io_bytes(self):
+        """
+        Return *(read, written)*, the total size of the cache entries
+        retrieved and stored by the current thread.
+        """
+        return getattr(self._io, 'read', 0), getattr(self._io, 'written', 0)
+
     def use_memory(self):
         """
         Set up cache for testing.
+
+        Downloaded files are kept in a temporary directory with no limit
+        on the number or size of the entries.
         """
         if self._cache is None:
             cachedir = os.path.join(tempfile.gettempdir(), "reductus_test")
             self._cache = memory_cache()
-            self._file_cache = file_cache(cachedir=cachedir)
+            self._file_cache = file_cache(cachedir=cachedir, size=None)
             self._cache_engine = "memory"
 
     def use_diskcache(self, **kwargs):
@@ -113,6 +237,22 @@ class CacheManager(object):
             self.use_memory()
         
 
+    def use_filecache(self, cachedir="~/.reductus/cache",
+                      file_cachedir="~/.reductus/files_cache",
+                      size=None, size_limit=int(4*2**30)):
+        """
+        Use a directory for the cache, which may be on a shared file system.
+
+        At most *size* entries and *size_limit* bytes are kept in each of
+        *cachedir* and *file_cachedir*, with the least recently used entries
+        removed first.  See :class:`.fakeredis.FileBasedCache` for details.
+        """
+        self._cache = file_cache(cachedir=cachedir, size=size,
+                                 maxbytes=size_limit)
+        self._file_cache = file_cache(cachedir=file_cachedir, size=size,
+                                      maxbytes=size_limit)
+        self._cache_engine = "file"
+
     def use_redis(self, **kwargs):
         """
         Use redis for managing the cache.
@@ -133,6 +273,138 @@ class CacheManager(object):
             warnings.warn(warning)
             self.use_memory()
 
+    def use_local_bytes(self, maxbytes=2**28):
+        """
+        Keep the encoded bytes of recently used cache entries in process
+        memory.
+
+        The local byte cache sits in front of the redis or diskcache store
+        so that repeated requests for the same node skip the round trip to
+        the server.  The entries are held as stored, so each retrieval
+        still decodes a new copy of the value, and callers may modify the
+        values they receive.  Up to *maxbytes* of encoded entries are kept,
+        with the least recently used entries dropped first.  Use
+        *maxbytes=None* to remove the local byte cache.
+
+        Entries deleted from the shared store by another process may still
+        be returned by the local byte cache.  Since the cache keys are content
+        fingerprints, this only matters when clearing cached values for
+        modules flagged *nocache*.
+        """
+        from . import fakeredis
+        if maxbytes is None:
+            self._local_bytes = None
+        else:
+            self._local_bytes = fakeredis.MemoryCache(maxbytes=maxbytes)
+
+    def use_lease(self, ttl=300, poll=0.2):
+        """
+        Share claims on entries between processes using the redis server.
+
+        A claim takes a lease on the entry with *SET NX* which expires
+        after *ttl* seconds, so that the entry is calculated again if the
+        claiming process dies.  Processes waiting on a lease check every
+        *poll* seconds whether it has been released.  Use *ttl=None* to
+        only share claims within the process.  Leases require the redis
+        cache engine.
+        """
+        self._lease_ttl = ttl if self._cache_engine == "redis" else None
+        self._lease_poll = poll
+
+    def claim(self, key):
+        """
+        Claim the entry *key* for calculation.
+
+        Returns None if the caller should calculate the entry, in which
+        case it must call :meth:`release` after storing it, or if the
+        calculation fails.  Otherwise the entry is already being calculated
+        and the return value is a future which completes when that
+        calculation is released.  The entry may still be missing at that
+        point if the calculation failed, so check the cache again.
+        """
+        from concurrent.futures import Future
+        with self._flights_lock:
+            flight = self._flights.get(key, None)
+            if flight is not None:
+                return flight
+            flight = self._flights[key] = Future()
+        if self._lease_ttl is None:
+            return None
+        import uuid
+        token = uuid.uuid4().hex
+        try:
+            leased = self._cache.set(b"lease:" + _bytes(key), token,
+                                     nx=True, ex=self._lease_ttl)
+        except Exception:
+            # Don't leave callers in this process waiting on a flight
+            # that nobody is calculating.
+            self._end_flight(key)
+            raise
+        if leased:
+            self._lease_tokens[key] = token
+            return None
+        # Another process holds the lease.  Callers in this process wait on
+        # the local flight, which completes when the lease is released.
+        waiter = self._lease_waiters().submit(self._wait_lease, key)
+        waiter.add_done_callback(lambda _: self._end_flight(key))
+        return flight
+
+    def release(self, key):
+        """
+        Release the claim on *key* returned by :meth:`claim`.
+        """
+        token = self._lease_tokens.pop(key, None)
+        if token is not None:
+            try:
+                self._release_lease(
+                    keys=[b"lease:" + _bytes(key)], args=[token])
+            except Exception as exc:
+                # The lease expires on its own.
+                warnings.warn("could not release lease: %s"%exc)
+        self._end_flight(key)
+
+    def _end_flight(self, key):
+        with self._flights_lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.set_result(None)
+
+    def _release_lease(self, keys, args):
+        # Only delete the lease if it is still ours.
+        script = getattr(self, '_release_script', None)
+        if script is None:
+            script = self._release_script = self._cache.register_script(
+                "if redis.call('get', KEYS[1]) == ARGV[1] then "
+                "return redis.call('del', KEYS[1]) else return 0 end")
+        return script(keys=keys, args=args)
+
+    def _lease_waiters(self):
+        with self._flights_lock:
+            if self._lease_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._lease_pool = ThreadPoolExecutor(
+                    max_workers=32, thread_name_prefix="lease")
+            return self._lease_pool
+
+    def _wait_lease(self, key):
+        lease = b"lease:" + _bytes(key)
+        deadline = time.time() + self._lease_ttl
+        while time.time() < deadline and self._cache.exists(lease):
+            time.sleep(self._lease_poll)
+
+    def cache_stats(self):
+        """
+        Return the local byte cache hit and miss counts and the bytes it
+        holds.
+        """
+        stats = {"engine": self._cache_engine,
+                 "hits": self.local_hits, "misses": self.local_misses}
+        if self._local_bytes is not None:
+            stats.update(bytes=self._local_bytes.cache.nbytes,
+                         maxbytes=self._local_bytes.cache.maxbytes,
+                         entries=len(self._local_bytes.cache))
+        return stats
+
     def get_cache(self):
         """
         Connect to the key-value cache.
@@ -170,30 +442,138 @@ class CacheManager(object):
             contents = lz4.frame.decompress(contents)
         return contents
 
-    def store(self, key, value):
-        string = pickle.dumps(value, protocol=self._pickle_protocol)
+    def _encode(self, value):
+        string = dumps(value, protocol=self._pickle_protocol)
         if self._use_compression:
             import lz4.frame
             string = lz4.frame.compress(string)
-        self._cache.set(key, string)
+        self._io.written = getattr(self._io, 'written', 0) + len(string)
+        return string
 
-    def retrieve(self, key):
-        string = self._cache.get(key)
+    def _decode(self, string):
+        self._io.read = getattr(self._io, 'read', 0) + len(string)
         if self._use_compression:
             import lz4.frame
-            string = lz4.frame.decompress(string)
-        value = pickle.loads(string)
-        return value
+            string = lz4.frame.decompress(string, return_bytearray=True)
+        return loads(string)
+
+    def _mapped(self):
+        # Uncompressed diskcache entries are memory mapped rather than read.
+        # The memory map is already served from the page cache, so it is
+        # not copied into the local byte cache.
+        return self._cache_engine == "diskcache" and not self._use_compression
+
+    def store(self, key, value):
+        string = self._encode(value)
+        self._cache.set(key, string)
+        if self._local_bytes is not None:
+            self._local_bytes.set(key, string)
+
+    def store_many(self, items):
+        """
+        Store a sequence of *(key, value)* pairs.
+
+        For redis, the values are sent to the server in a single pipeline.
+        """
+        items = [(key, self._encode(value)) for key, value in items]
+        if self._cache_engine == "redis":
+            pipe = self._cache.pipeline(transaction=False)
+            for key, string in items:
+                pipe.set(key, string)
+            pipe.execute()
+        else:
+            for key, string in items:
+                self._cache.set(key, string)
+        if self._local_bytes is not None:
+            for key, string in items:
+                self._local_bytes.set(key, string)
+
+    def _retrieve_local(self, key):
+        if self._local_bytes is None:
+            return None
+        try:
+            return self._local_bytes.get(key)
+        except KeyError:
+            return None
+
+    def retrieve(self, key):
+        string = self._retrieve_local(key)
+        if string is None:
+            if self._mapped():
+                return self._decode(_read_mapped(self._cache, key))
+            string = self._cache.get(key)
+            if self._local_bytes is not None:
+                self._local_bytes.set(key, string)
+        return self._decode(string)
+
+    def retrieve_many(self, keys):
+        """
+        Return the values for a sequence of keys.
+
+        Missing keys return None.  For redis, all the values that are not
+        held in the local byte cache are fetched with a single MGET.
+        """
+        strings = dict((key, self._retrieve_local(key)) for key in keys)
+        missing = [key for key, string in strings.items() if string is None]
+        if missing and self._mapped():
+            strings.update((key, _read_mapped(self._cache, key))
+                           for key in missing)
+        elif missing:
+            if self._cache_engine == "redis":
+                fetched = self._cache.mget(missing)
+            else:
+                fetched = [self._get_or_none(key) for key in missing]
+            for key, string in zip(missing, fetched):
+                strings[key] = string
+                if self._local_bytes is not None and string is not None:
+                    self._local_bytes.set(key, string)
+        return [_nullable(self._decode, strings[key]) for key in keys]
+
+    def _get_or_none(self, key):
+        # The memory and file caches raise KeyError for missing entries
+        # rather than returning None.
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            return None
 
     def delete(self, key):
+        if self._local_bytes is not None and self._local_bytes.exists(key):
+            self._local_bytes.delete(key)
         self._cache.delete(key)
 
     def file_exists(self, key):
         return self._file_cache.exists(key)
         
     def exists(self, key):
+        if self._local_bytes is not None and self._local_bytes.exists(key):
+            return True
         return self._cache.exists(key)
 
+    def exists_many(self, keys):
+        """
+        Return a list of flags indicating which keys are in the cache.
+
+        For redis, the keys that are not held in the local byte cache are
+        checked in a single pipeline.
+        """
+        local = self._local_bytes
+        found = dict((key, local is not None and local.exists(key))
+                     for key in keys)
+        missing = [key for key, hit in found.items() if not hit]
+        if missing and self._cache_engine == "redis":
+            pipe = self._cache.pipeline(transaction=False)
+            for key in missing:
+                pipe.exists(key)
+            found.update(zip(missing, pipe.execute()))
+        else:
+            found.update((key, self._cache.exists(key)) for key in missing)
+        return [bool(found[key]) for key in keys]
+
+
+def _bytes(key):
+    return key.encode('utf-8') if isinstance(key, str) else key
+
 
 # Singleton cache manager if you only need one cache
 CACHE_MANAGER = CacheManager()
@@ -201,6 +581,95 @@ CACHE_MANAGER = CacheManager()
 # direct access to singleton methods
 use_redis = CACHE_MANAGER.use_redis
 use_diskcache = CACHE_MANAGER.use_diskcache
+use_filecache = CACHE_MANAGER.use_filecache
 get_cache = CACHE_MANAGER.get_cache_manager
 get_file_cache = CACHE_MANAGER.get_file_cache
 set_test_cache = CACHE_MANAGER.use_memory
+use_local_bytes = CACHE_MANAGER.use_local_bytes
+use_lease = CACHE_MANAGER.use_lease
+
+
+def test_codec():
+    import numpy as np
+    a = np.arange(12.).reshape(3, 4)
+    value = {"a": a, "t": a.T, "i": np.arange(5), "s": "text", "n": 1}
+    string = dumps(value)
+    assert string.startswith(CODEC_MAGIC)
+    for data in (string, bytearray(string)):
+        result = loads(data)
+        assert (result["a"] == a).all() and (result["t"] == a.T).all()
+        assert result["s"] == "text" and result["n"] == 1
+        assert result["a"].flags.writeable
+        assert result["a"].flags.aligned
+    # arrays use the stored buffer without copying
+    data = bytearray(string)
+    result = loads(data)
+    result["i"][0] = 42
+    assert loads(data)["i"][0] == 42
+    # entries written as plain pickles can still be read
+    assert loads(pickle.dumps(value, protocol=4))["s"] == "text"
+
+def test_local_bytes():
+    import numpy as np
+    manager = CacheManager()
+    manager.use_memory()
+    manager.use_local_bytes(maxbytes=2**20)
+    manager.store("a", {"x": np.arange(10)})
+    # served from the local byte cache even if the shared store drops the
+    # entry, decoding a new copy each time
+    manager._cache.delete("a")
+    assert manager.exists("a")
+    value = manager.retrieve("a")
+    assert (value["x"] == np.arange(10)).all()
+    value["x"][0] = 42
+    assert manager.retrieve("a")["x"][0] == 0
+    manager.store("b", 1)
+    manager._local_bytes.delete("b")
+    assert manager.retrieve("b") == 1 and manager.retrieve("b") == 1
+    stats = manager.cache_stats()
+    assert stats["hits"] == 3 and stats["misses"] == 1
+    assert stats["entries"] == 2 and 0 < stats["bytes"] <= 2**20
+
+def test_batch():
+    manager = CacheManager()
+    manager.use_memory()
+    manager.store_many([("x", 1), ("y", [2])])
+    assert manager.exists_many(["x", "z", "y"]) == [True, False, True]
+    assert manager.retrieve_many(["y", "z", "x"]) == [[2], None, 1]
+    manager.use_local_bytes(maxbytes=2**20)
+    manager.store_many([("w", "local")])
+    assert manager.retrieve_many(["w", "x", "z"]) == ["local", 1, None]
+    assert manager.exists_many(["w", "x", "z"]) == [True, True, False]
+
+def test_claim():
+    manager = CacheManager()
+    manager.use_memory()
+    assert manager.claim("a") is None
+    flight = manager.claim("a")
+    assert flight is not None and not flight.done()
+    assert manager.claim("b") is None
+    manager.store("a", 1)
+    manager.release("a")
+    assert flight.done() and manager.retrieve("a") == 1
+    # released entries can be claimed again
+    assert manager.claim("a") is None
+    manager.release("a")
+    manager.release("b")
+
+def test_claim_lease_failure():
+    class FailingCache(object):
+        def set(self, key, value, nx=False, ex=None):
+            raise ConnectionError("lost connection")
+    manager = CacheManager()
+    manager.use_memory()
+    manager._cache = FailingCache()
+    manager._lease_ttl = 10
+    for _ in range(2):
+        try:
+            manager.claim("a")
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError("lease failure not raised")
+    # the failed claim does not leave a flight behind
+    assert "a" not in manager._flights
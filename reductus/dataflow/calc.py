@@ -15,13 +15,22 @@ import sys
 
 import hashlib
 import contextlib
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
 from inspect import getsource
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 
 from .anno_exc import annotate_exception
 from .cache import get_cache
-from .core import lookup_module, lookup_datatype
+from .core import lookup_module, lookup_datatype, module_digest
 from .core import Bundle
 from .automod import validate
+from .executor import get_executor, worker_context
+from . import trace
 
 IS_PY3 = sys.version_info[0] >= 3
 
@@ -33,11 +42,32 @@ def find_calculated(template, config):
     cache = get_cache()
 
     fingerprints = fingerprint_template(template, config)
-    return [cache.exists(fingerprints[node])
-            for node, _ in enumerate(template.modules)]
+    return cache.exists_many([fingerprints[node]
+                              for node, _ in enumerate(template.modules)])
+
+def scheduled_nodes(template, config, target=(None, None), lazy=False):
+    """
+    Returns the nodes that :func:`process_template` would evaluate or
+    retrieve from the cache given the current contents of the cache.
+    """
+    cache = get_cache()
+
+    pending = list(template.ordered(target=target[0]))
+    if not lazy:
+        return [node for node, _ in pending]
+    fingerprints = fingerprint_template(template, config)
+    sources = dict((node, set(wire["source"][0] for wire in input_wires))
+                   for node, input_wires in pending)
+    hits = cache.exists_many([fingerprints[node] for node, _ in pending])
+    cached = set(node for (node, _), hit in zip(pending, hits) if hit)
+    needed, _ = _lazy_nodes(template, cached, pending, sources, target)
+    return [node for node, _ in pending if node in needed]
 
 
-def process_template(template, config, target=(None, None)):
+# Number of process_template calls in progress on each thread.
+_nesting = threading.local()
+
+def process_template(template, config, target=(None, None), lazy=False):
     """
     Evaluate the template.
 
@@ -48,84 +78,440 @@ def process_template(template, config, target=(None, None)):
     the cached value and use it for subsequent nodes.  If not, then run
     the node action and place the results in the cache.
 
+    Nodes are evaluated as soon as all the nodes they depend upon are
+    available.  If a worker pool has been configured with
+    *executor.use_threads()* or *executor.use_processes()* then
+    independent nodes are evaluated concurrently; the results and the
+    values stored in the cache are the same as for serial evaluation.
+
+    If *lazy* is True, then cached nodes are only retrieved if they are
+    needed as inputs to nodes which must be calculated, and intermediate
+    bundles are released once all the nodes which use them have started.
+    This keeps fewer large datasets in memory at the same time.  Without a
+    target, the return value is a :class:`LazyResults` mapping, which
+    retrieves the values that are not in memory from the cache when
+    they are accessed.
+
+    Cached nodes for modules flagged *pure* are cached for each dataset in
+    the bundle, so adding a dataset to an input only calculates the action for
+    the new dataset.  Loader nodes have no inputs and are called once with
+    the whole file list, so adding a file runs the loader node again.  The
+    parsed entries for the unchanged files are then retrieved from the
+    cache by :func:`.fetch.url_load_many` rather than loaded again.
+
+    Nodes are claimed in the cache while they are being calculated, so
+    concurrent calls for the same node, in this process or in others
+    sharing a redis cache with leases enabled, wait for the first
+    calculation and retrieve its value.
+
     If *target* is specified, then return the target as a json serialized
     object containing the list of values on the specified output terminal.
     """
+    # Track nested evaluation, such as the VSANS load steps evaluating
+    # their own template, so that trace spans can be attributed to the
+    # outer template.
+    depth = getattr(_nesting, 'depth', 0)
+    _nesting.depth = depth + 1
+    try:
+        return _process_template(template, config, target, lazy)
+    finally:
+        _nesting.depth = depth
+
+def _process_template(template, config, target, lazy):
     cache = get_cache()
+    executor = get_executor()
 
     results = {}
+    element_fps = {}
     return_node, return_terminal = target
 
     fingerprints = fingerprint_template(template, config)
-    for node, input_wires in template.ordered(target=return_node):
-        node_info = template.modules[node]
-        module = lookup_module(node_info['module'])
-        node_id = "node %d, %s"%(node, node_info['module'])
-        input_terminals = module.inputs
-        module.outputs = module.outputs
-
-        # Build the inputs; if returning an input terminal, put it in the
-        # results set.   This is extra work for the case where the results
-        # have already been computed, but it simplifies the code for the
-        # case where the return target is an input terminal.
-        inputs = _get_inputs(results, input_wires, input_terminals)
-        if return_node == node and return_terminal in inputs:
-            # We are returning inputs, so treat them as if it were outputs.
-            # That means putting them into a bundle so that we can convert
-            # to and from JSON.  But we have to find the terminal first so
-            # that we know the datatype.  Since we are only returning the
-            # inputs, we don't need to compute the node outputs, and we
-            # can return immediately.
-            for terminal in input_terminals:
-                if terminal["id"] == return_terminal:
-                    return _bundle(terminal, inputs[return_terminal])
-
-        # If the module has been flagged "nocache" for debugging, then
-        # clear all cached entries that depend on it.  If we just ignore
-        # them for this evaluation, the cached values will simply pop
-        # back once we turn on caching again.
-        if not module.cached:
-            for child in template.dependents(node):
-                if cache.exists(fingerprints[child]):
-                    print("clearing cached value for node %d: %s"
-                          %(child, fingerprints[child]))
-                    cache.delete(fingerprints[child])
-
-        # Use cached value if it exists, skipping to the next loop iteration.
-        if cache.exists(fingerprints[node]):
-            print("retrieving cached value for node %d: %s"
-                  %(node, fingerprints[node]))
-            bundles = cache.retrieve(fingerprints[node])
-            results.update((_key(node, k), v) for k, v in bundles.items())
-            continue
-
-        # Fields set for the current node
-        template_fields = node_info.get('config', {})
-        user_fields = config.get(str(node), {})
-
-        # Evaluate the node
-        print("calculating %s %s"%(node, module.id))
-        outputs = _eval_node(node_id, module, inputs, template_fields, user_fields)
-
-        # Collect the outputs
-        bundles = {}
-        for terminal in module.outputs:
-            tid = terminal["id"]
-            bundles[tid] = _bundle(terminal, outputs[tid])
-        #print "caching", module.id, bundles
-        #print "caching",_serialize(bundles, module.outputs)
-        if module.cached:
-            print("caching %s %s %s"%(node, module.id, fingerprints[node]))
-            cache.store(fingerprints[node], bundles)
-        results.update((_key(node, k), v) for k, v in bundles.items())
+
+    # Each node waits for the nodes feeding its input terminals.
+    pending = list(template.ordered(target=return_node))
+    sources = dict((node, set(wire["source"][0] for wire in input_wires))
+                   for node, input_wires in pending)
+    # Check the cache for all the nodes at once rather than node by node.
+    hits = cache.exists_many([fingerprints[node] for node, _ in pending])
+    cached = set(node for (node, _), hit in zip(pending, hits) if hit)
+    # Content fingerprints of the node outputs are remembered by node
+    # fingerprint, except for nodes whose values can change without
+    # changing their fingerprints.
+    volatile = set()
+    for node, _ in pending:
+        if not lookup_module(template.modules[node]['module']).cached:
+            volatile.add(node)
+            volatile |= template.dependents(node)
+    stable_fps = dict((node, fp) for node, fp in fingerprints.items()
+                      if node not in volatile)
+    if lazy:
+        needed, retrieve_only = _lazy_nodes(
+            template, cached, pending, sources, target)
+        pending = [(node, input_wires) for node, input_wires in pending
+                   if node in needed]
+        for node in retrieve_only:
+            sources[node] = set()
+        # Count the nodes which will use each node as an input.  Nodes
+        # without a target are kept if their values can't be retrieved
+        # from the cache later.
+        consumers = dict((node, 0) for node in needed)
+        for node in needed - retrieve_only:
+            for source in sources[node]:
+                consumers[source] += 1
+        keep = set([return_node]) if return_node is not None else set(
+            node for node in needed
+            if not lookup_module(template.modules[node]['module']).cached)
+    done = set()
+    running = {}  # future => node
+    jobs = {}  # node => (module, [future, ...], [call fp, ...] or None)
+    waiting = {}  # future => (node, input_wires) claimed by another caller
+    claimed = set()  # fingerprints that this call must release
+    try:
+        while pending or running or waiting:
+            ready = [(node, input_wires) for node, input_wires in pending
+                     if sources[node] <= done]
+            if not ready and not running and not waiting:
+                raise RuntimeError("template nodes %s are unreachable"
+                                   % ", ".join(str(n) for n, _ in pending))
+            retrieved = False
+            for node, input_wires in ready:
+                pending.remove((node, input_wires))
+                node_info = template.modules[node]
+                module = lookup_module(node_info['module'])
+                node_id = "node %d, %s"%(node, node_info['module'])
+                input_terminals = module.inputs
+
+                # Nodes whose value is only needed as an input to other nodes
+                # are taken straight from the cache.  If some of the datasets
+                # have been dropped from the cache since the nodes were
+                # selected then evaluate the node in full.
+                if lazy and node in retrieve_only:
+                    print("retrieving cached value for node %d: %s"
+                          %(node, fingerprints[node]))
+                    start, (read, _) = time.time(), cache.io_bytes()
+                    bundles = _retrieve_node(
+                        cache, node, module, fingerprints[node], element_fps)
+                    if bundles is not None:
+                        _trace_node(node, module, fingerprints[node], "cached",
+                                    start, bundles,
+                                    bytes_read=cache.io_bytes()[0] - read)
+                    else:
+                        bundles = dict(
+                            (terminal["id"], process_template(
+                                template, config, target=(node, terminal["id"])))
+                            for terminal in module.outputs)
+                    results.update((_key(node, k), v) for k, v in bundles.items())
+                    done.add(node)
+                    retrieved = True
+                    continue
+
+                # Build the inputs; if returning an input terminal, put it in
+                # the results set.   This is extra work for the case where the
+                # results have already been computed, but it simplifies the
+                # code for the case where the return target is an input
+                # terminal.
+                inputs = _get_inputs(results, input_wires, input_terminals)
+                if return_node == node and return_terminal in inputs:
+                    # We are returning inputs, so treat them as if it were
+                    # outputs. That means putting them into a bundle so that
+                    # we can convert to and from JSON.  But we have to find
+                    # the terminal first so that we know the datatype.  Since
+                    # we are only returning the inputs, we don't need to
+                    # compute the node outputs, and we can return immediately.
+                    # The target node is the last node in the ordering, so
+                    # there are no other nodes still running.
+                    for terminal in input_terminals:
+                        if terminal["id"] == return_terminal:
+                            return _bundle(terminal, inputs[return_terminal])
+
+                # If the module has been flagged "nocache" for debugging, then
+                # clear all cached entries that depend on it.  If we just
+                # ignore them for this evaluation, the cached values will
+                # simply pop back once we turn on caching again.  Dependents
+                # are not started until this node completes, so they will not
+                # see the cleared entries.
+                if not module.cached:
+                    children = sorted(template.dependents(node))
+                    hits = cache.exists_many(
+                        [fingerprints[child] for child in children])
+                    for child, hit in zip(children, hits):
+                        if hit:
+                            print("clearing cached value for node %d: %s"
+                                  %(child, fingerprints[child]))
+                            cache.delete(fingerprints[child])
+                    cached.difference_update(children)
+
+                # Use cached value if it exists, skipping to the next node.
+                # Element indices are only usable if all the elements are
+                # still in the cache.
+                if node in cached:
+                    print("retrieving cached value for node %d: %s"
+                          %(node, fingerprints[node]))
+                    start, (read, _) = time.time(), cache.io_bytes()
+                    bundles = _retrieve_node(
+                        cache, node, module, fingerprints[node], element_fps)
+                    if bundles is not None:
+                        _trace_node(node, module, fingerprints[node], "cached",
+                                    start, bundles,
+                                    bytes_read=cache.io_bytes()[0] - read)
+                        results.update((_key(node, k), v)
+                                       for k, v in bundles.items())
+                        # Nodes cached by another caller while this one
+                        # waited still count as consumers of their sources.
+                        if lazy:
+                            _release_sources(
+                                results, consumers, keep, sources[node])
+                        done.add(node)
+                        retrieved = True
+                        continue
+
+                # If another request is already calculating the node then
+                # wait for it to finish and retrieve the node from the cache.
+                if module.cached:
+                    flight = cache.claim(fingerprints[node])
+                    if (flight is None and node not in cached
+                            and cache.exists(fingerprints[node])):
+                        # Stored by another caller since the cache was
+                        # checked, so retrieve it instead.
+                        cache.release(fingerprints[node])
+                        flight = _CachedFuture(None)
+                    if flight is not None:
+                        print("waiting for node %d: %s"
+                              %(node, fingerprints[node]))
+                        waiting[flight] = (node, input_wires)
+                        continue
+                    claimed.add(fingerprints[node])
+
+                # Fields set for the current node
+                template_fields = node_info.get('config', {})
+                user_fields = config.get(str(node), {})
+
+                # The inputs for this node have been gathered, so the
+                # sources can be released if nothing else needs them.
+                # Element fingerprints are computed from the inputs, so
+                # the fingerprints are needed before the release.
+                if module.pure and module.cached:
+                    input_fps = _get_input_fingerprints(
+                        results, element_fps, input_wires, input_terminals,
+                        stable_fps)
+                if lazy:
+                    _release_sources(results, consumers, keep, sources[node])
+
+                # Evaluate the node.  Cached pure modules are cached for each
+                # dataset in the bundle, so only the datasets that are new
+                # since the last evaluation need to be computed.
+                print("calculating %s %s"%(node, module.id))
+                start, (read, _) = time.time(), cache.io_bytes()
+                if module.pure and module.cached:
+                    call_fps = _call_fingerprints(
+                        node_id, module, input_fps,
+                        template_fields, user_fields)
+                    futures = _submit_elements(
+                        cache, executor, node_id, module, inputs,
+                        template_fields, user_fields, call_fps)
+                else:
+                    call_fps = None
+                    futures = _submit_node(
+                        executor, node_id, module, inputs,
+                        template_fields, user_fields)
+                read = cache.io_bytes()[0] - read
+                jobs[node] = (module, futures, call_fps, start, read)
+                running.update((future, node) for future in futures)
+
+            # Cache hits may have made more nodes ready, so check for them
+            # before waiting on the running nodes.
+            if retrieved or not (running or waiting):
+                continue
+
+            completed, _ = wait(list(running) + list(waiting),
+                                return_when=FIRST_COMPLETED)
+            # Nodes released by another caller are retried from the cache,
+            # and calculated here if they are still missing.
+            for future in completed:
+                if future in waiting:
+                    node, input_wires = waiting.pop(future)
+                    pending.append((node, input_wires))
+                    cached.add(node)
+            finished = set(running.pop(future) for future in completed
+                           if future in running)
+            # Collect the outputs in node order so that cache writes happen
+            # in the same sequence no matter which node finished first.
+            for node in sorted(finished):
+                module, futures, call_fps, start, read = jobs[node]
+                if not all(future.done() for future in futures):
+                    continue
+                del jobs[node]
+                # Other futures for the node may have completed since the
+                # wait returned.
+                for future in futures:
+                    running.pop(future, None)
+                task_results = [future.result() for future in futures]
+                action_results = [result for results, _ in task_results
+                                  for result in results]
+                usage = [usage for _, usage in task_results if usage is not None]
+                written = cache.io_bytes()[1]
+                outputs = _gather_outputs(module, action_results)
+                bundles = {}
+                for terminal in module.outputs:
+                    tid = terminal["id"]
+                    bundles[tid] = _bundle(terminal, outputs[tid])
+                #print "caching", module.id, bundles
+                #print "caching",_serialize(bundles, module.outputs)
+                if call_fps is not None:
+                    print("caching %s %s %s"%(node, module.id, fingerprints[node]))
+                    _store_elements(
+                        cache, node, module, fingerprints[node], call_fps,
+                        futures, action_results, element_fps)
+                elif module.cached:
+                    print("caching %s %s %s"%(node, module.id, fingerprints[node]))
+                    cache.store(fingerprints[node], bundles)
+                if module.cached:
+                    claimed.discard(fingerprints[node])
+                    cache.release(fingerprints[node])
+                status = ("calculated" if len(usage) == len(futures)
+                          else "cached" if not usage else "partial")
+                _trace_node(node, module, fingerprints[node], status,
+                            start, bundles, usage=usage, bytes_read=read,
+                            bytes_written=cache.io_bytes()[1] - written)
+                results.update((_key(node, k), v) for k, v in bundles.items())
+                done.add(node)
+    finally:
+        # Abandon queued nodes if one of the nodes failed.
+        for future in running:
+            future.cancel()
+        # Let any waiting callers calculate the nodes that did not finish.
+        for fingerprint in claimed:
+            cache.release(fingerprint)
 
     #print list(sorted(results.keys()))
 
     if return_node is None:
-        return results
+        return LazyResults(template, config, results) if lazy else results
     else:
         return results[_key(return_node, return_terminal)]
 
+
+def _trace_node(node, module, fingerprint, status, start, bundles,
+                usage=(), bytes_read=0, bytes_written=0):
+    """
+    Report the evaluation of the node to the tracer.
+    """
+    span = trace.NodeSpan(
+        node, module.id, fingerprint, status, start, time.time(),
+        depth=getattr(_nesting, 'depth', 1) - 1,
+        length=sum(len(bundle.values) for bundle in bundles.values()),
+        tasks=len(usage), cpu=sum(u.cpu for u in usage),
+        memory=max([u.memory for u in usage] or [0]),
+        bytes_read=bytes_read, bytes_written=bytes_written)
+    trace.emit(span)
+
+
+def _lazy_nodes(template, cached, pending, sources, target):
+    """
+    Select the nodes that need to be in memory for lazy evaluation.
+
+    *cached* is the set of nodes with values in the cache.
+
+    Returns *(needed, retrieve_only)*, where *needed* is the set of nodes
+    to be retrieved or calculated, and *retrieve_only* is the subset of
+    *needed* which are in the cache, and so do not need their inputs.
+
+    A cached node only needs to be retrieved if it is an input to a node
+    which must be calculated, or if it is the target.  Nodes downstream
+    of an uncached module are always recalculated since their cache
+    entries will be cleared when the uncached module is evaluated.
+    """
+    return_node, return_terminal = target
+    stale = set()
+    for node, _ in pending:
+        module = lookup_module(template.modules[node]['module'])
+        if not module.cached:
+            stale |= template.dependents(node)
+
+    needed, retrieve_only = set(), set()
+    def visit(node, as_input):
+        hit = node not in stale and node in cached
+        if hit and not as_input:
+            return
+        if node in needed and (hit or node not in retrieve_only):
+            return
+        needed.add(node)
+        if hit:
+            retrieve_only.add(node)
+            return
+        retrieve_only.discard(node)
+        for source in sources[node]:
+            visit(source, True)
+
+    if return_node is None:
+        for node, _ in pending:
+            visit(node, False)
+    else:
+        module = lookup_module(template.modules[return_node]['module'])
+        if any(t["id"] == return_terminal for t in module.inputs):
+            # Returning an input terminal, so the sources are needed.
+            needed.add(return_node)
+            for source in sources[return_node]:
+                visit(source, True)
+        else:
+            visit(return_node, True)
+    return needed, retrieve_only
+
+
+def _release_sources(results, consumers, keep, sources):
+    """
+    Count one less consumer for each of the *sources*, releasing the nodes
+    which are no longer needed unless they are in *keep*.
+    """
+    for source in sources:
+        consumers[source] -= 1
+        if consumers[source] == 0 and source not in keep:
+            _release_node(results, source)
+
+
+def _release_node(results, node):
+    """
+    Remove the output bundles for *node* from *results*.
+    """
+    prefix = _key(node, "")
+    for key in [key for key in results if key.startswith(prefix)]:
+        del results[key]
+
+
+class LazyResults(Mapping):
+    """
+    Results of a lazy :func:`process_template` evaluation of a template.
+
+    This maps *"node:terminal"* to the output bundle for each terminal of
+    each node.  Bundles which are not held in memory are retrieved from the
+    cache, or recalculated if they are no longer cached, each time they are
+    accessed.
+    """
+    def __init__(self, template, config, results):
+        self._template = template
+        self._config = config
+        self._results = results
+        self._keys = [
+            _key(node, terminal["id"])
+            for node, node_info in enumerate(template.modules)
+            for terminal in lookup_module(node_info['module']).outputs]
+
+    def __getitem__(self, key):
+        if key in self._results:
+            return self._results[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        node, terminal = key.split(":", 1)
+        return process_template(
+            self._template, self._config, target=(int(node), terminal),
+            lazy=True)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
 def _bundle(terminal, values):
     """
     Build a bundle for the terminal values.  The bundle has to carry the
@@ -173,15 +559,248 @@ def _get_inputs(results, input_wires, input_terminals):
     return inputs
 
 
-def _eval_node(node_id, module, inputs, template_fields, user_fields):
+def _node_task(node_id, module_id, inputs, template_fields, user_fields):
+    """
+    Run the action for every dataset in the node bundle on a worker.
+
+    The module is looked up by *module_id* so that only its name needs to
+    be sent to a worker process.  Templates evaluated by the module action
+    will run serially within the worker.
+
+    Returns the list of action results, to be combined with
+    :func:`_gather_outputs`, and the :class:`.trace.TaskUsage` for the task.
+    """
+    module = lookup_module(module_id)
+    with worker_context():
+        arguments = _action_arguments(
+            node_id, module, inputs, template_fields, user_fields)
+        return trace.measure(lambda: [_do_action(module, **action_args)
+                                      for action_args in arguments])
+
+
+def _action_task(module_id, action_args):
+    """
+    Run the action for one dataset in the node bundle on a worker.
+
+    Returns a list containing the action result, to be combined with
+    :func:`_gather_outputs`, and the :class:`.trace.TaskUsage` for the task.
+    """
+    module = lookup_module(module_id)
+    with worker_context():
+        return trace.measure(lambda: [_do_action(module, **action_args)])
+
+
+def _submit_node(executor, node_id, module, inputs, template_fields, user_fields):
+    """
+    Start evaluating the node on the *executor*, returning a list of futures.
+
+    Modules marked with *@pure* are mapped over the bundle with one task
+    for each dataset.  Other modules are evaluated by a single task.  The
+    concatenated future results, in order, are the action results for the
+    datasets in the bundle.
+    """
+    if module.pure:
+        arguments = _action_arguments(
+            node_id, module, inputs, template_fields, user_fields)
+        if len(arguments) > 1:
+            return [executor.submit(_action_task, module.id, action_args)
+                    for action_args in arguments]
+    return [executor.submit(
+        _node_task, node_id, module.id, inputs, template_fields, user_fields)]
+
+
+class ElementIndex(object):
+    """
+    Node cache entry for a module that is cached for each dataset.
+
+    *fingerprints* lists the cache keys of the action results for each
+    dataset in the bundle.  Only pure modules, which have a single input
+    dataset for each action call, are cached this way; loader nodes are
+    not.
+    """
+    def __init__(self, fingerprints):
+        self.fingerprints = fingerprints
+
+
+class _CachedFuture(Future):
+    """
+    Completed future holding a value retrieved from the cache.
+    """
+    def __init__(self, value):
+        Future.__init__(self)
+        self.set_result(value)
+
+
+def _submit_elements(cache, executor, node_id, module, inputs,
+                     template_fields, user_fields, call_fps):
+    """
+    Start evaluating a cached pure node, returning a list of futures.
+
+    Each dataset in the bundle is evaluated by its own task unless the
+    action result for its call fingerprint in *call_fps* is already in the
+    cache.  Futures for cached datasets are completed before they are
+    returned.
+    """
+    arguments = _action_arguments(
+        node_id, module, inputs, template_fields, user_fields)
+    futures = []
+    cached = cache.retrieve_many(call_fps)
+    for action_args, result in zip(arguments, cached):
+        if result is not None:
+            futures.append(_CachedFuture(([result], None)))
+        else:
+            futures.append(
+                executor.submit(_action_task, module.id, action_args))
+    hits = sum(isinstance(future, _CachedFuture) for future in futures)
+    if hits:
+        print("retrieved %d of %d cached datasets for %s"
+              % (hits, len(futures), node_id))
+    return futures
+
+
+def _store_elements(cache, node, module, node_fp, call_fps, futures,
+                    action_results, element_fps):
+    """
+    Cache the action results of a pure node for each dataset, with an
+    :class:`ElementIndex` stored under the node fingerprint.
+
+    Results which were retrieved from the cache are not stored again.
+    """
+    items = [(call_fp, result)
+             for call_fp, future, result in zip(call_fps, futures, action_results)
+             if not isinstance(future, _CachedFuture)]
+    items.append((node_fp, ElementIndex(call_fps)))
+    cache.store_many(items)
+    _record_element_fingerprints(
+        element_fps, node, module, call_fps, action_results)
+
+
+def _retrieve_node(cache, node, module, node_fp, element_fps):
+    """
+    Retrieve the cached output bundles for the node.
+
+    Returns None if the node is no longer in the cache, or if it was cached
+    by dataset and some of the datasets have since been dropped.
+    """
+    entry, = cache.retrieve_many([node_fp])
+    if not isinstance(entry, ElementIndex):
+        return entry
+    call_fps = entry.fingerprints
+    action_results = cache.retrieve_many(call_fps)
+    if any(result is None for result in action_results):
+        return None
+    outputs = _gather_outputs(module, action_results)
+    _record_element_fingerprints(
+        element_fps, node, module, call_fps, action_results)
+    return dict((terminal["id"], _bundle(terminal, outputs[terminal["id"]]))
+                for terminal in module.outputs)
+
+
+def _record_element_fingerprints(element_fps, node, module, call_fps,
+                                 action_results):
+    """
+    Record fingerprints for each dataset on the node output terminals.
+
+    Outputs of cached pure nodes are identified by the call that produced
+    them, so unchanged datasets keep their fingerprints when datasets are
+    added to or removed from the bundle.
+    """
+    for index, terminal in enumerate(module.outputs):
+        tid = terminal["id"]
+        fps = []
+        for call_fp, result in zip(call_fps, action_results):
+            if terminal["length"] == 0:
+                fps.extend(generate_fingerprint([call_fp, tid, str(j)])
+                           for j in range(len(result[index])))
+            else:
+                fps.append(generate_fingerprint([call_fp, tid]))
+        element_fps[_key(node, tid)] = fps
+
+
+def _get_input_fingerprints(results, element_fps, input_wires, input_terminals,
+                            node_fps):
+    """
+    Lookup the fingerprints of each dataset on the input terminals.
+
+    This is the same as :func:`_get_inputs`, but returns fingerprints
+    *{terminal: [fp, ...]}* rather than datasets.  Outputs of nodes which
+    are not cached for each dataset are fingerprinted by content.  The
+    content fingerprints are remembered for the nodes in *node_fps*, keyed
+    by node fingerprint, so each output is only pickled once.
+    """
+    inputs = dict((terminal["id"], []) for terminal in input_terminals)
+    for wire in input_wires:
+        source_node, source_terminal = wire["source"]
+        target_node, target_terminal = wire["target"]
+        key = _key(source_node, source_terminal)
+        if key not in element_fps:
+            memo_key = (_key(node_fps[source_node], source_terminal)
+                        if source_node in node_fps else None)
+            element_fps[key] = _content_fingerprints(
+                results[key].values, memo_key)
+        inputs[target_terminal].extend(element_fps[key])
+    return inputs
+
+
+def _call_fingerprints(node_id, module, input_fps, template_fields, user_fields):
+    """
+    Fingerprint each call to the action for a node.
+
+    The fingerprint depends on the module version, the field values for
+    the call and the fingerprints of the datasets sent to the call.
+    """
+    arguments = _action_arguments(
+        node_id, module, input_fps, template_fields, user_fields)
+    return [generate_fingerprint([
+                module.id, module.version, str(_format_ordered(action_args))])
+            for action_args in arguments]
+
+
+# Content fingerprints of the datasets on node outputs from previous calls,
+# keyed by node fingerprint and terminal.
+CONTENT_MEMO_SIZE = 1000
+_content_memo = OrderedDict()
+_content_memo_lock = threading.Lock()
+
+def _content_fingerprints(values, memo_key=None):
+    """
+    Fingerprint the datasets in *values* by content.
+
+    If *memo_key* is given, the fingerprints are remembered for the most
+    recent CONTENT_MEMO_SIZE keys.
+    """
+    if memo_key is not None:
+        with _content_memo_lock:
+            fps = _content_memo.get(memo_key, None)
+            if fps is not None and len(fps) == len(values):
+                _content_memo.move_to_end(memo_key)
+                return list(fps)
+    fps = [_content_fingerprint(v) for v in values]
+    if memo_key is not None:
+        with _content_memo_lock:
+            _content_memo[memo_key] = fps
+            while len(_content_memo) > CONTENT_MEMO_SIZE:
+                _content_memo.popitem(last=False)
+    return list(fps)
+
+def _content_fingerprint(value):
+    """
+    Fingerprint a dataset by the pickled value.
+    """
+    string = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.sha1(string).hexdigest()
+
+
+def _action_arguments(node_id, module, inputs, template_fields, user_fields):
     """
-    Run the action for the node.
+    Build the action arguments for each dataset in the node bundle.
 
-    *id* is a string identifier for the node, for errors and logging
+    *node_id* is a string identifier for the node, for errors and logging.
 
     *module* is the module activated by the node.
 
     *inputs* contains the input terminal values as *{terminal: [data, ...]}*.
+    When fingerprinting the calls, the values are the dataset fingerprints.
 
     *template_fields* contains the field values stored in the
     template as *{field: [value, ...]}*.
@@ -189,7 +808,12 @@ def _eval_node(node_id, module, inputs, template_fields, user_fields):
     *user_fields* contains the field values sent as part of the template
     config as *{field: [value, ...]}*.
 
-    Returns the output terminal bundle as *(terminal: [data, ...]}*.
+    This is used by :func:`_submit_node` and :func:`_node_task` to run the
+    action, and by :func:`_submit_elements` and :func:`_call_fingerprints`
+    for per-dataset caching of pure modules.
+
+    Returns a list of *{name: value}*, with one set of arguments for each
+    call to the module action.
     """
     # If the first input terminal is a multiple input terminal, then the
     # action needs to be called once with the bundle.
@@ -249,18 +873,19 @@ def _eval_node(node_id, module, inputs, template_fields, user_fields):
         else:
             raise ValueError("Need one value of %s for each dataset"%name)
 
-    # Allocate slots for results
-    outputs = dict((terminal["id"], []) for terminal in module.outputs)
+    return [dict((name, values[k]) for name, values in fields.items())
+            for k in range(bundle_length)]
 
-    for k in range(bundle_length):
-        # set up inputs
-        action_args = dict((name, values[k]) for name, values in fields.items())
 
-        # perform action
-        #print "args", node_id, k, action_args
-        result = _do_action(module, **action_args)
+def _gather_outputs(module, results):
+    """
+    Combine the action *results* for each dataset in the bundle into
+    output terminal bundles *{terminal: [data, ...]}*.
+    """
+    # Allocate slots for results
+    outputs = dict((terminal["id"], []) for terminal in module.outputs)
 
-        #print node_id,result
+    for result in results:
         # Gather outputs
         for terminal, data in zip(module.outputs, result):
             if terminal["length"] == 0:
@@ -328,10 +953,65 @@ def fingerprint_template(template, config):
     return fingerprints
 
 
+# Node fingerprints from previous calls, so that unchanged nodes need not
+# be formatted and hashed again when the template is polled from the GUI.
+FINGERPRINT_MEMO_SIZE = 10000
+_fingerprint_memo = OrderedDict()
+_fingerprint_memo_lock = threading.Lock()
+
+def _fingerprint_memo_key(module, node_config, inputs_fp):
+    """
+    Return a key for the node fingerprint memo, or None if the node config
+    is not plain json.
+
+    The json representation is much cheaper to compute than the formatted
+    config used for the fingerprint, but it doesn't distinguish lists from
+    tuples, integer dictionary keys from strings, or numpy scalars from
+    floats, so only use it for configs that came from json.
+    """
+    parts = [module.get('config', {}), node_config, inputs_fp]
+    if not _is_json(parts):
+        return None
+    try:
+        return json.dumps([module_digest(module['module'])] + parts,
+                          sort_keys=True, allow_nan=True)
+    except KeyError:
+        return None
+
+def _is_json(value):
+    """
+    Return True if *value* is built from the types returned by json.loads.
+    """
+    if isinstance(value, dict):
+        return all(type(k) is str and _is_json(v) for k, v in value.items())
+    elif type(value) is list:
+        return all(_is_json(v) for v in value)
+    else:
+        return value is None or type(value) in (str, int, float, bool)
+
 def fingerprint_node(module, node_config, inputs_fp):
     """
     Create a unique sha1 hash for a module based on its attributes and inputs.
+
+    Fingerprints are remembered for the most recent FINGERPRINT_MEMO_SIZE
+    nodes, keyed by module version, node config and input fingerprints.
     """
+    key = _fingerprint_memo_key(module, node_config, inputs_fp)
+    if key is not None:
+        with _fingerprint_memo_lock:
+            fp = _fingerprint_memo.get(key, None)
+            if fp is not None:
+                _fingerprint_memo.move_to_end(key)
+                return fp
+    fp = _fingerprint_node(module, node_config, inputs_fp)
+    if key is not None:
+        with _fingerprint_memo_lock:
+            _fingerprint_memo[key] = fp
+            while len(_fingerprint_memo) > FINGERPRINT_MEMO_SIZE:
+                _fingerprint_memo.popitem(last=False)
+    return fp
+
+def _fingerprint_node(module, node_config, inputs_fp):
     config = module.get('config', {}).copy()
     config.update(node_config)
     config_str = str(_format_ordered(config))
@@ -358,8 +1038,7 @@ def _format_ordered(value):
     elif isinstance(value, tuple):
         return tuple(_format_ordered(v) for v in value)
     elif callable(value):
-        print("fingerprinting function %s"%str(value))
-        return getsource(value)
+        return _callable_source(value)
     elif hasattr(value, '__getstate__'):
         value_state = value.__getstate__()
         if value_state is None:
@@ -374,6 +1053,22 @@ def _format_ordered(value):
         return value
 
 
+_source_memo = {}
+def _callable_source(value):
+    """
+    Return the source of the callable, looking it up only once per function.
+    """
+    key = getattr(value, '__code__', None)
+    if key is None:
+        print("fingerprinting function %s"%str(value))
+        return getsource(value)
+    source = _source_memo.get(key, None)
+    if source is None:
+        print("fingerprinting function %s"%str(value))
+        source = _source_memo[key] = getsource(value)
+    return source
+
+
 # ===== Test support ===
 @contextlib.contextmanager
 def push_seed(seed=None): # pragma no cover
@@ -476,6 +1171,15 @@ def run_example(template, config, seed=None, verbose=False): # pragma no cover
                 pass
 
 # internal tests
+def test_fingerprint_memo_key():
+    import numpy as np
+    assert _is_json([{'x': [1, 2.5, None, True, 'a']}, {}, ['fp']])
+    # configs that json would confuse are not memoized
+    module = {'module': 'test.memo', 'config': {}}
+    for node_config in ({'x': (1, 2)}, {1: 'a'}, {'x': np.float64(1.5)},
+                        {'x': {'y': (1,)}}):
+        assert _fingerprint_memo_key(module, node_config, ['fp']) is None
+
 def test_format_ordered():
     udict, odict = {'x': 2, 'a': 3}, [('a', 3), ('x', 2)]
     # Note: Leave the ufn function as a 1-liner.  The test relies on the format
@@ -500,3 +1204,328 @@ def test_format_ordered():
         actual = _format_ordered(u)
         print("%s => %r =? %r"%(str(u), actual, o))
         assert actual == o
+
+
+# Toy instrument for testing the template engine.  Each action records its
+# calls in _TOY_CALLS.  The scale action then waits for the events in
+# _TOY_GATE.
+_TOY_INSTRUMENT = "test.toy"
+_TOY_CALLS = []
+_TOY_GATE = []
+
+class _ToyData(object):
+    # Datasets in memory, including those retrieved from the cache.
+    live = None
+
+    def __new__(cls, *args):
+        import weakref
+        self = object.__new__(cls)
+        if cls.live is None:
+            cls.live = weakref.WeakSet()
+        cls.live.add(self)
+        return self
+
+    def __init__(self, name, value):
+        self.name, self.value = name, value
+
+    def todict(self):
+        return {"name": self.name, "value": self.value}
+
+    def get_plottable(self):
+        return self.todict()
+
+    def get_metadata(self):
+        return self.todict()
+
+def _toy_instrument():
+    from .core import Instrument, DataType, register_instrument
+    from .core import lookup_instrument
+    from .automod import make_modules, pure
+
+    try:
+        return lookup_instrument(_TOY_INSTRUMENT)
+    except KeyError:
+        pass
+
+    def load(names=None):
+        """
+        Load one dataset for each name.
+
+        **Inputs**
+
+        names (str[]): dataset names
+
+        **Returns**
+
+        output (toy[]): datasets
+
+        2024-01-01 Test
+        """
+        _TOY_CALLS.append(("load", tuple(names or ())))
+        return [_ToyData(name, float(len(name))) for name in names or []]
+
+    @pure
+    def scale(data, factor=2.0):
+        """
+        Scale the dataset.
+
+        **Inputs**
+
+        data (toy): dataset
+
+        factor (float): scale factor
+
+        **Returns**
+
+        output (toy): scaled dataset
+
+        2024-01-01 Test
+        """
+        _TOY_CALLS.append(("scale", data.name))
+        for gate in _TOY_GATE:
+            gate.wait(10)
+        return _ToyData(data.name, data.value*factor)
+
+    def combine(data):
+        """
+        Add the datasets.
+
+        **Inputs**
+
+        data (toy[]*): datasets
+
+        **Returns**
+
+        output (toy): sum
+
+        2024-01-01 Test
+        """
+        _TOY_CALLS.append(("combine", len(data)))
+        return _ToyData("+".join(d.name for d in data),
+                        sum(d.value for d in data))
+
+    modules = make_modules([load, scale, combine], prefix=_TOY_INSTRUMENT+'.')
+    instrument = Instrument(
+        id=_TOY_INSTRUMENT, name="toy", menu=[("steps", modules)],
+        datatypes=[DataType(_TOY_INSTRUMENT+".toy", _ToyData)])
+    register_instrument(instrument)
+    return instrument
+
+def _toy_template(branches=2):
+    """
+    Return a template with *branches* load => scale chains feeding combine,
+    and a config with names for the loaders.
+    """
+    from .automod import make_template
+    diagram, outputs, config = [], [], {}
+    for k in range(branches):
+        diagram.append(["load => load%d"%k, {}])
+        diagram.append(["scale => scale%d"%k, {"data": "load%d.output"%k}])
+        outputs.append("scale%d.output"%k)
+        config[str(2*k)] = {"names": ["a%d"%k, "bb%d"%k]}
+    diagram.append(["combine", {"data": ",".join(outputs)}])
+    template = make_template(
+        "toy", "toy template", diagram, _toy_instrument(), "1.0")
+    return template, config
+
+def _toy_cache():
+    """
+    Clear the memory cache used by the tests.
+    """
+    from .cache import CACHE_MANAGER, memory_cache
+    CACHE_MANAGER.use_memory()
+    CACHE_MANAGER._cache = memory_cache()
+    return CACHE_MANAGER
+
+def _toy_values(results):
+    return dict((key, [v.todict() for v in bundle.values])
+                for key, bundle in results.items())
+
+def test_executors():
+    from . import executor
+    template, config = _toy_template(branches=3)
+    _toy_cache()
+    serial = _toy_values(process_template(template, config))
+    assert serial["6:output"] == [{"name": "a0+bb0+a1+bb1+a2+bb2",
+                                   "value": 2.0*(2 + 3)*3}]
+    _toy_cache()
+    executor.use_threads(4)
+    try:
+        threaded = _toy_values(process_template(template, config))
+    finally:
+        executor.use_serial()
+    assert threaded == serial
+
+def test_pure_fan_out():
+    template, config = _toy_template(branches=1)
+    config["0"]["names"] = ["a", "bb", "ccc"]
+    _toy_cache()
+    spans = []
+    trace.add_listener(spans.append)
+    try:
+        process_template(template, config)
+    finally:
+        trace.remove_listener(spans.append)
+    tasks = dict((span.module_id, span.tasks) for span in spans)
+    # one task for each dataset in the scale bundle
+    assert tasks == {"test.toy.load": 1, "test.toy.scale": 3,
+                     "test.toy.combine": 1}
+
+def test_element_cache():
+    template, config = _toy_template(branches=1)
+    _toy_cache()
+    process_template(template, config)
+    # Adding a file only scales the new dataset.
+    config["0"]["names"].append("ccc")
+    del _TOY_CALLS[:]
+    results = process_template(template, config)
+    assert [call for call in _TOY_CALLS if call[0] == "scale"] == [("scale", "ccc")]
+    assert [v.value for v in results["1:output"].values] == [4., 6., 6.]
+    # Changing the field recalculates all of them, without fingerprinting
+    # the loaded datasets again.
+    config["1"] = {"factor": 3.0}
+    del _TOY_CALLS[:]
+    fingerprinted = []
+    def content_fingerprint(value):
+        fingerprinted.append(value)
+        return original(value)
+    original = globals()['_content_fingerprint']
+    globals()['_content_fingerprint'] = content_fingerprint
+    try:
+        process_template(template, config)
+    finally:
+        globals()['_content_fingerprint'] = original
+    assert sum(call[0] == "scale" for call in _TOY_CALLS) == 3
+    assert fingerprinted == []
+
+def test_lazy_release():
+    import gc
+    template, config = _toy_template(branches=2)
+    def count_loaded(span):
+        # When combine completes, the only datasets from the loaders that
+        # remain are those held in the results.
+        if span.module_id == "test.toy.combine":
+            loaded.append(sum(d.value == len(d.name) for d in _ToyData.live))
+    trace.add_listener(count_loaded)
+    try:
+        loaded = []
+        gc.collect()
+        _toy_cache()
+        results = process_template(template, config)
+        del results
+        gc.collect()
+        _toy_cache()
+        results = process_template(template, config, lazy=True)
+    finally:
+        trace.remove_listener(count_loaded)
+    assert loaded[0] == 4 and loaded[-1] == 0
+    assert isinstance(results, LazyResults) and len(results) == 5
+    # Only the nodes without dependents are held in memory, but the others
+    # are retrieved from the cache by key.
+    assert sorted(results._results) == ["4:output"]
+    assert results["1:output"].values[1].value == 6.0
+
+def test_claim_wait():
+    template, config = _toy_template(branches=1)
+    _toy_cache()
+    del _TOY_CALLS[:]
+    spans = []
+    def record(span):
+        spans.append((threading.current_thread().name, span.module_id,
+                      span.status))
+    results = {}
+    def run(name):
+        results[name] = _toy_values(process_template(template, config))
+    first = threading.Thread(target=run, args=("first",), name="first")
+    second = threading.Thread(target=run, args=("second",), name="second")
+    gate = threading.Event()
+    _TOY_GATE.append(gate)
+    trace.add_listener(record)
+    try:
+        first.start()
+        # Start the second caller once the first is calculating scale.
+        deadline = time.time() + 10
+        while ("scale", "a0") not in _TOY_CALLS and time.time() < deadline:
+            time.sleep(0.01)
+        second.start()
+        time.sleep(0.2)
+        gate.set()
+        first.join(10)
+        second.join(10)
+    finally:
+        del _TOY_GATE[:]
+        trace.remove_listener(record)
+    # The second caller waits for scale and retrieves it from the cache.
+    assert [call for call in _TOY_CALLS if call[0] == "scale"] == [
+        ("scale", "a0"), ("scale", "bb0")]
+    assert ("second", "test.toy.scale", "cached") in spans
+    assert results["first"] == results["second"]
+
+def test_lazy_wait_release():
+    import gc
+    template, config = _toy_template(branches=1)
+    cache = _toy_cache()
+    process_template(template, config)
+    # Hold the claim on scale while the lazy caller starts, then store it
+    # as if calculated by another caller.
+    fingerprints = fingerprint_template(template, config)
+    index = cache.retrieve(fingerprints[1])
+    cache.delete(fingerprints[1])
+    cache.delete(fingerprints[2])
+    assert cache.claim(fingerprints[1]) is None
+    gc.collect()
+    loaded, spans = [], []
+    def record(span):
+        spans.append(span.module_id)
+        if span.module_id == "test.toy.combine":
+            loaded.append(sum(d.value == len(d.name) for d in _ToyData.live))
+    trace.add_listener(record)
+    try:
+        thread = threading.Thread(target=process_template,
+                                  args=(template, config, (None, None), True))
+        thread.start()
+        deadline = time.time() + 10
+        while "test.toy.load" not in spans and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        cache.store(fingerprints[1], index)
+        cache.release(fingerprints[1])
+        thread.join(10)
+    finally:
+        trace.remove_listener(record)
+    # The loaded data is released once scale is retrieved.
+    assert spans == ["test.toy.load", "test.toy.scale", "test.toy.combine"]
+    assert loaded == [0]
+
+def test_scheduled_nodes():
+    template, config = _toy_template(branches=2)
+    _toy_cache()
+    # With the first branch cached, lazy evaluation of combine retrieves
+    # scale0 without its loader.
+    process_template(template, config, target=(1, "output"))
+    target = (4, "output")
+    assert sorted(scheduled_nodes(template, config, target)) == [0, 1, 2, 3, 4]
+    assert sorted(scheduled_nodes(template, config, target, lazy=True)) == [1, 2, 3, 4]
+
+def test_span_depth():
+    # Templates evaluated within a node, here from the span listener, are
+    # reported one level deeper than the template being processed.
+    template, config = _toy_template(branches=1)
+    inner, inner_config = _toy_template(branches=1)
+    inner_config["0"]["names"] = ["ccc"]
+    depths = []
+    def record(span):
+        depths.append((span.module_id, span.depth))
+        if len(depths) == 1:
+            process_template(inner, inner_config)
+    _toy_cache()
+    trace.add_listener(record)
+    try:
+        process_template(template, config)
+    finally:
+        trace.remove_listener(record)
+    assert depths == [
+        ("test.toy.load", 0),
+        ("test.toy.load", 1), ("test.toy.scale", 1), ("test.toy.combine", 1),
+        ("test.toy.scale", 0), ("test.toy.combine", 0),
+    ]
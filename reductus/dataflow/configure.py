@@ -3,6 +3,7 @@ import copy
 
 from .core import load_instrument
 from .cache import get_cache
+from . import executor
 from . import fetch
 from reductus.configurations import default
 
@@ -61,11 +62,38 @@ def apply_config(user_config=None, user_overrides=None):
             cache_manager.use_diskcache(**cache_params)
         elif cache_engine == "redis":
             cache_manager.use_redis(**cache_params)
+        elif cache_engine == "file":
+            cache_manager.use_filecache(**cache_params)
         else:
             cache_manager.use_memory()
 
         cache_manager._use_compression = cache_compression
 
+        local_config = cache_config.get("local_bytes", None)
+        if local_config and cache_engine in ("diskcache", "redis", "file"):
+            cache_manager.use_local_bytes(**local_config)
+
+        lease_config = cache_config.get("lease", None)
+        if lease_config and cache_engine == "redis":
+            cache_manager.use_lease(**lease_config)
+
+    executor_config = config.get('executor', False)
+    if executor_config:
+        executor_engine = executor_config.get("engine", None)
+        executor_params = executor_config.get("params", {})
+        if executor_engine == "threads":
+            executor.use_threads(**executor_params)
+        elif executor_engine == "processes":
+            # Each worker process needs the same instruments, data sources
+            # and cache as the server, but not its own worker pool.
+            worker_config = copy.deepcopy(config)
+            worker_config.pop('executor')
+            executor.use_processes(
+                initializer=apply_config, initargs=(worker_config,),
+                **executor_params)
+        else:
+            executor.use_serial()
+
     # Load refl instrument if nothing specified in config.
     # Note: instrument names do not match instrument ids.
     instruments = config.get('instruments', ['refl'])
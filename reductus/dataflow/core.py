@@ -5,6 +5,7 @@ from __future__ import print_function
 
 from dataclasses import dataclass
 import sys
+import hashlib
 import importlib
 import inspect
 import json
@@ -19,6 +20,7 @@ TEMPLATE_VERSION = '1.0'
 
 _instrument_registry = OrderedDict()
 _module_registry = {}
+_module_digests = {}
 _datatype_registry = {}
 
 _loaded_instruments = set() # previously loaded instruments
@@ -99,6 +101,8 @@ def register_module(module):
         #raise TypeError("Module already registered")
         return
     _module_registry[module.id] = module
+    key = ":".join((module.id, str(module.version))).encode('utf-8')
+    _module_digests[module.id] = hashlib.sha1(key).hexdigest()
 
 
 def lookup_module(id):
@@ -108,6 +112,14 @@ def lookup_module(id):
     return _module_registry[id]
 
 
+def module_digest(id):
+    """
+    Return a digest of the module id and version, computed when the module
+    was registered.
+    """
+    return _module_digests[id]
+
+
 def register_datatype(datatype):
     if (datatype.id in _datatype_registry
             and datatype != _datatype_registry[datatype.id]):
@@ -303,6 +315,10 @@ class Module(object):
     def cached(self):
         return not hasattr(self.action, 'cached') or self.action.cached
 
+    @property
+    def pure(self):
+        return getattr(self.action, 'pure', False)
+
     @property
     def visible(self):
         return not hasattr(self.action, 'visible') or self.action.visible
@@ -1,17 +1,47 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
+import threading
 
 import numpy as np
 
 from .lib.exporters import exports_json
 
+_transport = threading.local()
+
+@contextmanager
+def binary_arrays():
+    """
+    Leave numeric arrays as numpy arrays in *todict* and *get_plottable*.
+
+    Used by the server when the response is packed with
+    :mod:`reductus.dataflow.lib.msgpack_ndarray`, which sends the array
+    buffers directly rather than as lists of python numbers.  The setting
+    only applies to the current thread.
+    """
+    previous = getattr(_transport, 'binary', False)
+    _transport.binary = True
+    try:
+        yield
+    finally:
+        _transport.binary = previous
+
+def array_item(obj):
+    """
+    Return the array *obj* as a list, or unchanged if it is numeric and
+    :func:`binary_arrays` is active.
+    """
+    if getattr(_transport, 'binary', False) and obj.dtype.kind in 'biuf':
+        return obj
+    return obj.tolist()
+
 def todict(obj, convert_bytes=False):
     if isinstance(obj, np.integer):
         obj = int(obj)
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist()
+        obj = array_item(obj)
     elif isinstance(obj, datetime.datetime):
         obj = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second]
     elif isinstance(obj, (list, tuple)):
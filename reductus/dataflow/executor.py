@@ -0,0 +1,154 @@
+"""
+Template nodes can be evaluated concurrently on a worker pool.
+
+By default :func:`.calc.process_template` evaluates one node at a time.
+Call *executor.use_threads(max_workers)* or *executor.use_processes(...)*
+during program configuration to evaluate independent branches of the
+template at the same time.  For example, the ``++``, ``--``, ``back+``
+and ``back-`` load and normalize chains of a polarized reduction do not
+depend on each other, so they can all be running at once.
+
+A singleton :class:`ExecutorManager` is available for programs that only
+need a single shared pool.  The calculation library calls
+*executor.get_executor()* to retrieve the pool.
+
+Thread pools share the cache connection and the instrument registry with
+the caller, so they require no extra set up.  Process pools bypass the
+python global interpreter lock, but the instrument registry, the data
+sources and the cache must be configured in each worker.  Use the
+*initializer* argument of :meth:`ExecutorManager.use_processes` to do
+this; :func:`.configure.apply_config` sets it up automatically.
+
+Templates evaluated from within a worker (for example, by the VSANS load
+steps, which call *process_template* on a one node template for each
+file) are evaluated serially in that worker so that nested calls cannot
+deadlock waiting for a slot in the pool.
+"""
+import os
+import threading
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+_worker_state = threading.local()
+
+def in_worker():
+    """
+    Return True if the current thread is evaluating a template node.
+    """
+    return getattr(_worker_state, 'active', False)
+
+@contextlib.contextmanager
+def worker_context():
+    """
+    Mark the current thread as evaluating a template node.
+    """
+    previous = in_worker()
+    _worker_state.active = True
+    try:
+        yield
+    finally:
+        _worker_state.active = previous
+
+
+class SerialExecutor(object):
+    """
+    Executor which evaluates each submitted function immediately.
+
+    This has the same *submit* interface as the pools in
+    :mod:`concurrent.futures` so that the same scheduling code can be
+    used with and without a worker pool.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ExecutorManager(object):
+    """
+    Manage the worker pool used to evaluate template nodes.
+    """
+    def __init__(self):
+        self._executor = None
+        self._engine = "serial"
+        self._max_workers = 1
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    def _replace(self, executor, engine, max_workers):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = executor
+        self._engine = engine
+        self._max_workers = max_workers
+
+    def use_serial(self):
+        """
+        Evaluate one node at a time in the calling thread.
+        """
+        self._replace(None, "serial", 1)
+
+    def use_threads(self, max_workers=None):
+        """
+        Evaluate independent nodes on a pool of *max_workers* threads.
+
+        This only helps if the actions release the global interpreter
+        lock, such as when waiting for files to download or when working
+        on large numpy arrays.  The default is the same as for
+        :class:`concurrent.futures.ThreadPoolExecutor`.
+        """
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._replace(pool, "threads", max_workers)
+
+    def use_processes(self, max_workers=None, initializer=None, initargs=()):
+        """
+        Evaluate independent nodes on a pool of *max_workers* processes.
+
+        *initializer(\\*initargs)* is called when each worker process starts.
+        It should register the instruments and configure the data sources
+        and cache, for example using :func:`.configure.apply_config`.
+        The default *max_workers* is the number of processors.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=initializer, initargs=initargs)
+        self._replace(pool, "processes", max_workers)
+
+    def get_executor(self):
+        """
+        Return the pool for evaluating nodes.
+
+        Returns a :class:`SerialExecutor` if no pool is configured or if
+        called from within a worker.
+        """
+        if self._executor is None or in_worker():
+            return SerialExecutor()
+        return self._executor
+
+
+# Singleton executor manager if you only need one pool
+EXECUTOR_MANAGER = ExecutorManager()
+
+# direct access to singleton methods
+use_serial = EXECUTOR_MANAGER.use_serial
+use_threads = EXECUTOR_MANAGER.use_threads
+use_processes = EXECUTOR_MANAGER.use_processes
+get_executor = EXECUTOR_MANAGER.get_executor
@@ -3,13 +3,28 @@ Redis-like interface to an in-memory cache
 
 :class:`MemoryCache` provides a minimal redis-like interface to an in memory
 cache.  If the *pylru* package is available, then this provides a least
-recently used cache, otherwise the cache grows without bound.
+recently used cache, otherwise the cache grows without bound.  If the cache
+is limited by total size in bytes rather than by number of elements, then
+:class:`SizedLRUCache` is used instead.
+
+:class:`FileBasedCache` provides the same interface for a cache stored in
+a directory, which can be shared between processes.
 """
 from __future__ import print_function
 
 import os
+import re
+import sys
+import hashlib
+import tempfile
 import threading
 import warnings
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 def lrucache(size):
     try:
@@ -21,6 +36,68 @@ def lrucache(size):
         return {}
 
 
+class SizedLRUCache(object):
+    """
+    Least recently used cache limited by the total size of the values.
+
+    *maxbytes* is the total length of the stored values.  Values are
+    normally the serialized strings stored by the cache manager; other
+    values are measured by *sys.getsizeof*.  Values larger than *maxbytes*
+    are not stored.  *hits* and *misses* count the lookups.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        try:
+            return memoryview(value).nbytes
+        except TypeError:
+            return sys.getsizeof(value)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if size > self.maxbytes:
+                return
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.nbytes -= old_size
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.nbytes -= self._data.pop(key)[1]
+
+
 class MemoryCache(object):
     """
     In memory cache with redis interface.
@@ -28,10 +105,14 @@ class MemoryCache(object):
     Use this for running tests without having to start up the redis server.
 
     *size* is the number of elements to cache (ignored if the pylru package
-    is not available).
+    is not available).  If *maxbytes* is given, then the cache is limited
+    by the total size of the values instead.
     """
-    def __init__(self, size=1000):
-        self.cache = lrucache(size)
+    def __init__(self, size=1000, maxbytes=None):
+        if maxbytes is not None:
+            self.cache = SizedLRUCache(maxbytes)
+        else:
+            self.cache = lrucache(size)
 
     def exists(self, key):
         return key in self.cache
@@ -64,47 +145,253 @@ class MemoryCache(object):
         """Note: returned range includes high index, not high-1 like lists"""
         return self.cache[key][low:(high+1 if high != -1 else None)]
 
+class _FileLock(object):
+    """
+    Exclusive lock shared by threads and processes using the same cache.
+
+    Uses *fcntl.flock* on the lock file when available, which also works
+    on NFS mounts on recent linux kernels.  On other platforms only the
+    threads within the current process are excluded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fid = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            self._fid = open(self.path, "a+b")
+            fcntl.flock(self._fid.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self._depth -= 1
+        if self._depth == 0 and self._fid is not None:
+            fcntl.flock(self._fid.fileno(), fcntl.LOCK_UN)
+            self._fid.close()
+            self._fid = None
+        self._thread_lock.release()
+
+
 class FileBasedCache(object):
     """
     Disk-based cache with redis interface.
 
-    Use this for running tests without having to start up the redis server.
+    Use this for running tests without having to start up the redis server,
+    or to share cached values between processes on the same machine or on
+    a shared file system.
+
+    *size* is the maximum number of entries and *maxbytes* is the maximum
+    total size of the entries (unlimited if *None*).  When either is
+    exceeded, the least recently used entries are removed until the cache
+    is back below 90% of the limit.  Reading an entry marks it as used by
+    updating its modification time, so the cache does not depend on the
+    file system recording access times.
+
+    Entries are stored in two levels of subdirectories based on the hash
+    of the key, with at most 256 subdirectories at each level, in a file
+    named by the hash.  The first line of the file holds the quoted key so
+    that *keys* can list them.  Values are written to a temporary file and
+    renamed into place, so readers in other processes never see partially
+    written entries.  The running totals of entry count and size are kept
+    in the *state* file in *cachedir*, which is updated under a lock shared
+    between processes.  Entries left in *cachedir* by older versions, which
+    stored each fingerprint in a file of the same name, are removed when
+    the directory is first opened.  Other files are left alone.
+
+    Lists created by *rpush* are not counted toward the limits.
     """
-    def __init__(self, size=1000, cachedir='~/.reductus/cache'):
+    LOW_WATER = 0.9
+
+    def __init__(self, size=1000, cachedir='~/.reductus/cache', maxbytes=None):
         self.size = size
-        self.lock = threading.Lock()
+        self.maxbytes = maxbytes
         self.cachedir = os.path.expanduser(cachedir)
         if not os.path.exists(self.cachedir):
-            os.mkdir(self.cachedir)
+            os.makedirs(self.cachedir)
+        self.lock = _FileLock(os.path.join(self.cachedir, "lock"))
+        self._state_path = os.path.join(self.cachedir, "state")
+        with self.lock:
+            if not os.path.exists(self._state_path):
+                self._remove_flat_entries()
+                self._write_state(*self._scan_totals())
+
+    def _path(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, digest[:2], digest[2:4], digest)
+
+    # Entries are named by sha1 digest, as were the fingerprint keys stored
+    # directly in cachedir by older versions.
+    _DIGEST = re.compile(r"[0-9a-f]{40}\Z")
+    _LEVEL = re.compile(r"[0-9a-f]{2}\Z")
+
+    def _remove_flat_entries(self):
+        """
+        Remove entries stored directly in *cachedir* by older versions.
+        Only files named by a fingerprint are removed, in case *cachedir*
+        holds other files.  Called with the lock held.
+        """
+        for entry in os.scandir(self.cachedir):
+            if not self._DIGEST.match(entry.name):
+                continue
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+            except OSError:
+                pass  # removed by another process
+
+    def _entries(self):
+        """
+        Yield *(path, size, last used)* for every entry in the cache.
+
+        Only files named by a digest in the subdirectories for the digest
+        are entries, so eviction never removes other files.
+        """
+        for level1 in os.listdir(self.cachedir):
+            path1 = os.path.join(self.cachedir, level1)
+            if not self._LEVEL.match(level1) or not os.path.isdir(path1):
+                continue
+            for level2 in os.listdir(path1):
+                path2 = os.path.join(path1, level2)
+                if not self._LEVEL.match(level2) or not os.path.isdir(path2):
+                    continue
+                for entry in os.scandir(path2):
+                    if (not entry.name.startswith(level1 + level2)
+                            or not self._DIGEST.match(entry.name)
+                            or not entry.is_file()):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # removed by another process
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _scan_totals(self):
+        count = nbytes = 0
+        for _, entry_size, _ in self._entries():
+            count += 1
+            nbytes += entry_size
+        return count, nbytes
+
+    def _read_state(self):
+        try:
+            with open(self._state_path) as fid:
+                count, nbytes = (int(v) for v in fid.read().split())
+        except (IOError, ValueError):
+            count, nbytes = self._scan_totals()
+        return count, nbytes
+
+    def _write_state(self, count, nbytes):
+        self._replace(self._state_path, ("%d %d"%(count, nbytes)).encode())
+
+    def _replace(self, path, *chunks):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                for chunk in chunks:
+                    fid.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _over_limit(self, count, nbytes, scale=1.0):
+        return ((self.size is not None and count > scale*self.size)
+                or (self.maxbytes is not None and nbytes > scale*self.maxbytes))
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until below the low water
+        mark.  Called with the lock held.  Returns the new totals.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        count = len(entries)
+        nbytes = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if not self._over_limit(count, nbytes, self.LOW_WATER):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            count -= 1
+            nbytes -= entry_size
+        return count, nbytes
 
     def exists(self, key):
-        return os.path.exists(os.path.join(self.cachedir, key))
+        return os.path.isfile(self._path(key))
 
     def keys(self):
-        return os.listdir(self.cachedir)
+        keys = []
+        for path, _, _ in self._entries():
+            try:
+                with open(path, "rb") as fid:
+                    keys.append(unquote(fid.readline()[:-1].decode('utf-8')))
+            except (IOError, OSError):
+                continue  # removed by another process
+        return keys
 
     def delete(self, *key):
-        for k in key:
-            kp = os.path.join(self.cachedir, k)
-            if os.path.isdir(kp):
-                for f in os.listdir(kp):
-                    os.remove(os.path.join(kp, f))
-                os.rmdir(kp)
-            else:
-                os.remove(kp)
+        """
+        Remove the keys, returning the number of keys that were present.
+        """
+        removed = 0
+        with self.lock:
+            count, nbytes = self._read_state()
+            for k in key:
+                kp = self._path(k)
+                if os.path.isdir(kp):
+                    for f in os.listdir(kp):
+                        os.remove(os.path.join(kp, f))
+                    os.rmdir(kp)
+                    removed += 1
+                elif os.path.exists(kp):
+                    count -= 1
+                    nbytes -= os.path.getsize(kp)
+                    os.remove(kp)
+                    removed += 1
+            self._write_state(count, nbytes)
+        return removed
 
     def set(self, key, value):
-        #open(os.path.join(self.cachedir, key), "wb").write(pickle.dumps(value))
+        kp = self._path(key)
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        header = (quote(key, safe='') + '\n').encode('utf-8')
+        if not os.path.isdir(os.path.dirname(kp)):
+            os.makedirs(os.path.dirname(kp), exist_ok=True)
         with self.lock:
-            open(os.path.join(self.cachedir, key), "wb").write(value)
+            count, nbytes = self._read_state()
+            if os.path.isfile(kp):
+                count -= 1
+                nbytes -= os.path.getsize(kp)
+            self._replace(kp, header, value)
+            count += 1
+            nbytes += len(header) + len(value)
+            if self._over_limit(count, nbytes):
+                count, nbytes = self._evict()
+            self._write_state(count, nbytes)
 
     def get(self, key):
         """Note: doesn't provide default value for missing key like dict.get"""
+        kp = self._path(key)
         try:
-            #ret = pickle.loads(open(os.path.join(self.cachedir, key), "rb").read())
-            ret = open(os.path.join(self.cachedir, key), "rb").read()
-        except IOError:
+            with open(kp, "rb") as fid:
+                fid.readline()  # skip the key
+                ret = fid.read()
+        except (IOError, OSError):
             raise KeyError(key)
+        try:
+            os.utime(kp)  # mark as recently used
+        except OSError:
+            # Read-only or shared cache directory, or the entry was evicted
+            # after it was read.
+            pass
         return ret
 
     __delitem__ = delete
@@ -114,27 +401,29 @@ class FileBasedCache(object):
 
     def rpush(self, key, value):
         with self.lock:
-            keydir = os.path.join(self.cachedir, key)
+            keydir = self._path(key)
             if not os.path.isdir(keydir):
                 if os.path.exists(keydir):
                     raise KeyError(key)
-                os.mkdir(keydir)
+                os.makedirs(keydir)
                 new_filenum = 0
             else:
-                filenums = map(int, os.listdir(keydir))
+                filenums = [int(f) for f in os.listdir(keydir)
+                            if not f.startswith('.')]
                 if len(filenums) == 0:
                     new_filenum = 0
                 else:
                     new_filenum = max(filenums) + 1
-            open(os.path.join(keydir, str(new_filenum)), "wb").write(value)
+            self._replace(os.path.join(keydir, str(new_filenum)), value)
 
     def lrange(self, key, low, high):
         """Note: returned range includes high index, not high-1 like lists"""
-        keydir = os.path.join(self.cachedir, key)
+        keydir = self._path(key)
         if not os.path.isdir(keydir):
             raise KeyError(key)
         with self.lock:
-            filenums = sorted(map(int, os.listdir(keydir)))
+            filenums = sorted(int(f) for f in os.listdir(keydir)
+                              if not f.startswith('.'))
             lookups = filenums[low:(high+1 if high != -1 else None)]
             return [open(os.path.join(keydir, str(n)), "rb").read() for n in lookups]
 
@@ -179,6 +468,72 @@ def demo():
 
     print("=== cleanup of cache and cache2 can happen in any order")
 
+def test_sized_lru():
+    cache = MemoryCache(maxbytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    cache.get("a")  # "b" is now the least recently used
+    cache.set("c", b"1234")
+    assert cache.exists("a") and cache.exists("c") and not cache.exists("b")
+    assert cache.cache.nbytes == 8
+    cache.set("d", b"x"*11)  # too big to store
+    assert not cache.exists("d") and cache.cache.nbytes == 8
+    cache.delete("a")
+    assert cache.cache.nbytes == 4
+    try:
+        cache.get("a")
+    except KeyError:
+        pass
+    assert cache.cache.hits == 1 and cache.cache.misses == 1
+
+def test_file_cache():
+    import shutil
+    cachedir = tempfile.mkdtemp()
+    try:
+        # entries from the flat layout are removed on first open, but
+        # other files are kept
+        for name in ("0123456789abcdef0123456789abcdef01234567", "notes", "1"):
+            with open(os.path.join(cachedir, name), "wb") as fid:
+                fid.write(b"x")
+        os.mkdir(os.path.join(cachedir, "data"))
+        with open(os.path.join(cachedir, "data", "0"), "wb") as fid:
+            fid.write(b"x")
+        # each entry is 30 bytes plus 8 bytes for the "key%20k" line
+        cache = FileBasedCache(size=None, maxbytes=160, cachedir=cachedir)
+        assert sorted(os.listdir(cachedir)) == ["1", "data", "lock", "notes", "state"]
+        assert os.path.exists(os.path.join(cachedir, "data", "0"))
+        for k in range(4):
+            cache.set("key %d"%k, b"x"*30)
+            os.utime(cache._path("key %d"%k), (k, k))
+        cache.get("key 0")  # "key 1" is now the least recently used
+        assert cache.exists("key 0") and cache.exists("key 3")
+        cache.set("key 4", b"x"*30)  # 190 bytes => evict down to 90% of 160
+        assert sorted(cache.keys()) == ["key 0", "key 3", "key 4"]
+        assert cache._read_state() == (3, 114)
+        cache.set("key 4", b"y"*10)
+        assert cache.get("key 4") == b"y"*10
+        assert cache.delete("key 0") == 1 and cache.delete("key 0") == 0
+        assert not cache.exists("key 0") and cache._read_state() == (2, 56)
+        # a second handle on the same directory shares the totals
+        other = FileBasedCache(size=2, cachedir=cachedir)
+        other.set("key 5", b"z")
+        assert other._read_state()[0] <= 2 and cache.exists("key 5")
+        # file names do not depend on the length of the key
+        unlimited = FileBasedCache(size=None, cachedir=cachedir)
+        long_key = "k"*1000
+        unlimited.set(long_key, b"z")
+        assert unlimited.get(long_key) == b"z" and long_key in cache.keys()
+        # entries can be read even if they can't be marked as used
+        def utime(path, *args, **kw):
+            raise PermissionError(path)
+        saved, os.utime = os.utime, utime
+        try:
+            assert cache.get("key 5") == b"z"
+        finally:
+            os.utime = saved
+    finally:
+        shutil.rmtree(cachedir)
+
 if __name__ == "__main__":
     demo()
 
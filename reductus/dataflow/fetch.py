@@ -44,7 +44,10 @@ import datetime
 import time
 from posixpath import basename, join, sep
 import os
+import sys
 import hashlib
+import threading
+from io import BytesIO
 
 import urllib
 
@@ -79,56 +82,362 @@ def check_datasource(source):
     return source_url
 
 
-def url_get(fileinfo, mtime_check=True):
+# Number of files to download at the same time in url_get_many
+FETCH_WORKERS = 8
+
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+_sessions = threading.local()
+
+def get_session():
+    """
+    Return the keep-alive HTTP session for the current thread.
+
+    Sessions are kept per thread since *requests.Session* is not guaranteed
+    to be thread safe.  The download threads live for the life of the
+    process, so connections to the data sources are reused between calls.
+    """
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        import requests
+        session = _sessions.session = requests.Session()
+    return session
+
+def _get_fetch_pool():
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _fetch_pool = ThreadPoolExecutor(
+                max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+        return _fetch_pool
+
+def _is_local(fileinfo):
+    return fileinfo.get("source", DEFAULT_DATA_SOURCE) == 'local'
+
+def _file_fingerprint(fileinfo):
+    # fingerprint the get, leaving off entries information:
+    fileinfo_minimal = {'path': fileinfo['path'], 'mtime': fileinfo.get('mtime', None)}
+    config_str = str(_format_ordered(fileinfo_minimal))
+    return generate_fingerprint(("url_get", config_str))
+
+def _download(fileinfo, fp, mtime_check):
+    """
+    Fetch the file from its data source and store it in the file cache.
+    """
+    import requests
     source = fileinfo.get("source", DEFAULT_DATA_SOURCE)
-    path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-    isLocal = (source == 'local')
+    path, mtime = fileinfo['path'], fileinfo.get('mtime', None)
+    name = basename(path)
+    source_url = check_datasource(source)
+    full_url = join(source_url, urllib.parse.quote(path.strip(sep), safe='/:'))
+    print("loading", full_url, name)
+    req = None  # Need placeholder for req in case requests.get fails.
+    try:
+        req = get_session().get(full_url)
+        req.raise_for_status()
+        url_mtime = req.headers.get('last-modified', None)
+        url_time_struct = time.strptime(url_mtime, '%a, %d %b %Y %H:%M:%S %Z')
+        t_repo = datetime.datetime(*url_time_struct[:6], tzinfo=pytz.utc)
+
+        # Check timestamp if requested and if timestamp is provided
+        if mtime_check and mtime is not None:
+            t_request = datetime.datetime.fromtimestamp(mtime, pytz.utc)
+            if t_request != t_repo:
+                print("request mtime = %s, repo mtime = %s"%(t_request, t_repo))
+                compare = "older" if t_request < t_repo else "newer"
+                raise ValueError("Requested mtime is %s than repository mtime for %r"
+                                % (compare, path))
 
-    if isLocal:
+        ret = req.content
+        print("caching " + path)
+        get_cache().store_file(fp, ret)
+
+    except requests.HTTPError as exc:
+        raise ValueError("Could not open %r\n%s"%(path, str(exc)))
+    finally:
+        if req is not None:
+            req.close()
+
+    return ret
+
+def _download_many(fileinfos, mtime_check):
+    """
+    Download remote files that are not yet in the file cache.
+
+    The contents are only kept in the file cache, so at most FETCH_WORKERS
+    files are held in memory while they are being downloaded.
+    """
+    cache = get_cache()
+    remote = {}
+    for fileinfo in fileinfos:
+        if not _is_local(fileinfo):
+            remote.setdefault(_file_fingerprint(fileinfo), fileinfo)
+    missing = [(fp, fileinfo) for fp, fileinfo in remote.items()
+               if not cache.file_exists(fp)]
+    if not missing:
+        return
+    if len(missing) == 1:
+        fp, fileinfo = missing[0]
+        _download(fileinfo, fp, mtime_check)
+        return
+    pool = _get_fetch_pool()
+    futures = [pool.submit(_fetch, fileinfo, fp, mtime_check)
+               for fp, fileinfo in missing]
+    # Wait for all the downloads before raising any errors so that the
+    # successful ones are in the cache for the next attempt.
+    for future in futures:
+        future.exception()
+    for future in futures:
+        future.result()
+
+def _fetch(fileinfo, fp, mtime_check):
+    # Download on a pool thread without returning the contents, so that
+    # they are released once they are in the file cache.
+    _download(fileinfo, fp, mtime_check)
+
+def _read(fileinfo, mtime_check):
+    """
+    Return the contents of the file, from the file cache if it is remote.
+    """
+    path = fileinfo['path']
+    if _is_local(fileinfo):
         # no caching for local files.
         with open(path, 'rb') as localfile:
-            ret = localfile.read()
+            return localfile.read()
+    cache = get_cache()
+    fp = _file_fingerprint(fileinfo)
+    if cache.file_exists(fp):
+        print("getting " + path + " from cache!")
+        return cache.retrieve_file(fp)
+    # Dropped from the file cache since it was downloaded.
+    return _download(fileinfo, fp, mtime_check)
+
+def url_get(fileinfo, mtime_check=True):
+    """
+    Return the contents of the file described by *fileinfo*.
+
+    Remote files are retrieved from the file cache if they have been
+    fetched before.  See :func:`url_get_many`.
+    """
+    return url_get_many([fileinfo], mtime_check=mtime_check)[0]
 
+def url_get_many(fileinfos, mtime_check=True):
+    """
+    Return the contents of each of the files in *fileinfos*.
+
+    Remote files which are not yet in the file cache are downloaded at the
+    same time on a pool of FETCH_WORKERS threads, with each thread using a
+    keep-alive session.  If *mtime_check* is True then the modification
+    time on the data source must match the *mtime* in the fileinfo.
+    Files from the "local" source are read directly and are not cached.
+
+    Use :func:`url_open_many` to process the files one at a time without
+    holding all of them in memory.
+    """
+    _download_many(fileinfos, mtime_check)
+    return [_read(fileinfo, mtime_check) for fileinfo in fileinfos]
+
+def url_open_many(fileinfos, mtime_check=True):
+    """
+    Yield an open binary file object for each of the files in *fileinfos*.
+
+    Local files are opened directly, so readers such as h5py only read the
+    parts of the file they need.  Remote files are downloaded together as
+    for :func:`url_get_many`, then each is read from the file cache into
+    *BytesIO* when it is reached, so only one file need be open at a time.
+    """
+    _download_many(fileinfos, mtime_check)
+    for fileinfo in fileinfos:
+        if _is_local(fileinfo):
+            yield open(fileinfo['path'], 'rb')
+        else:
+            yield BytesIO(_read(fileinfo, mtime_check))
+
+# Bump this to discard all the parsed entries cached by url_load_many, for
+# example when the data classes change.  The reductus version is also part
+# of the key, so entries do not outlive an upgrade.  Changes to a single
+# loader bump the LOADER_VERSION of its module instead (see loader_id).
+LOADER_CACHE_VERSION = 1
+
+def loader_id(loader, options=""):
+    """
+    Return the id of the *loader* function for :func:`url_load_many`.
+
+    The id names the function, followed by any *options* which change its
+    output, and the *LOADER_VERSION* of the module defining it.  Bump the
+    module *LOADER_VERSION* when a change to the loader changes the entries
+    it returns, so that entries parsed by the earlier code are not reused.
+    """
+    module = sys.modules[loader.__module__]
+    version = getattr(module, 'LOADER_VERSION', None)
+    if version is None:
+        raise AttributeError("%s has no LOADER_VERSION"%loader.__module__)
+    return "%s.%s%s@%s"%(loader.__module__, loader.__name__, options, version)
+
+def _parsed_key(fileinfo, loader_id):
+    """
+    Return the cache key for the parsed entries of a file.
+
+    Local files are identified by path, modification time and size, so
+    changes to the file give a new key.  Remote files are identified by
+    source, path and the requested modification time, as for the file cache.
+    Remote files without an mtime return None and are not cached.
+    """
+    from reductus import __version__
+    entries = fileinfo.get('entries', None)
+    if _is_local(fileinfo):
+        path = os.path.realpath(fileinfo['path'])
+        stat = os.stat(path)
+        parts = {'path': path, 'mtime_ns': stat.st_mtime_ns,
+                 'size': stat.st_size, 'entries': entries}
+    elif fileinfo.get('mtime', None) is not None:
+        parts = {'source': fileinfo.get('source', DEFAULT_DATA_SOURCE),
+                 'path': fileinfo['path'], 'mtime': fileinfo['mtime'],
+                 'entries': entries}
     else:
-        import requests
-        # fingerprint the get, leaving off entries information:
-        cache = get_cache()
-        fileinfo_minimal = {'path': path, 'mtime': mtime}
-        config_str = str(_format_ordered(fileinfo_minimal))
-        fp = generate_fingerprint(("url_get", config_str))
-        if cache.file_exists(fp):
-            ret = cache.retrieve_file(fp)
-            print("getting " + path + " from cache!")
+        return None
+    version = "%s:%s"%(__version__, LOADER_CACHE_VERSION)
+    return generate_fingerprint(
+        ("parsed", version, loader_id, str(_format_ordered(parts))))
+
+def url_load_many(fileinfos, load, loader_id, mtime_check=True):
+    """
+    Return *[load(fileinfo, fid) for fileinfo in fileinfos]*, where *fid*
+    is the open file from :func:`url_open_many`.
+
+    The parsed results are stored in the cache under *loader_id* and the
+    file identity (see :func:`_parsed_key`), so loading an unchanged file
+    again reads neither the file nor its entries, even from a different
+    template or instrument.  *loader_id* should name the loader function
+    and any options that change its output, as returned by :func:`loader_id`,
+    or be a function returning that name for a fileinfo when the loader
+    depends on the file type.
+    """
+    cache = get_cache()
+    keys = [_parsed_key(fileinfo, loader_id(fileinfo) if callable(loader_id)
+                        else loader_id)
+            for fileinfo in fileinfos]
+    cacheable = [key for key in keys if key is not None]
+    cached = dict(zip(cacheable, cache.retrieve_many(cacheable)))
+    results = [cached.get(key, None) if key is not None else None
+               for key in keys]
+    missing = [k for k, result in enumerate(results) if result is None]
+    fids = url_open_many([fileinfos[k] for k in missing], mtime_check=mtime_check)
+    for k, fid in zip(missing, fids):
+        with fid:
+            results[k] = load(fileinfos[k], fid)
+        if keys[k] is not None:
+            cache.store(keys[k], results[k])
+    return results
+
+
+def test_url_get_many():
+    import shutil
+    import tempfile
+    from functools import partial
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    root = tempfile.mkdtemp()
+    requested = []
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            SimpleHTTPRequestHandler.do_GET(self)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=root))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    global DATA_SOURCES
+    saved_sources = DATA_SOURCES
+    DATA_SOURCES = [{"name": "standin", "url": "http://127.0.0.1:%d/"%server.server_port}]
+    try:
+        # unique names so that files cached by earlier runs are not used
+        tag = os.path.basename(root)
+        fileinfos = []
+        for k in range(5):
+            name = "%s_%d.dat"%(tag, k)
+            with open(os.path.join(root, name), "wb") as fid:
+                fid.write(b"file %d"%k)
+            os.utime(os.path.join(root, name), (1500000000+k, 1500000000+k))
+            fileinfos.append({"source": "standin", "path": name, "mtime": 1500000000+k})
+        fileinfos.append(fileinfos[0])
+        contents = url_get_many(fileinfos)
+        assert contents == [b"file %d"%k for k in (0, 1, 2, 3, 4, 0)]
+        assert len(requested) == 5
+        # second request comes from the file cache
+        assert url_get(fileinfos[3]) == b"file 3" and len(requested) == 5
+        # files dropped from the file cache are downloaded again when
+        # they are opened
+        from .cache import get_file_cache
+        get_file_cache().delete(_file_fingerprint(fileinfos[4]))
+        fids = url_open_many(fileinfos[3:5])
+        with next(fids) as fid:
+            assert fid.read() == b"file 3" and len(requested) == 6
+        with next(fids) as fid:
+            assert fid.read() == b"file 4"
+        assert len(requested) == 6
+        # stale mtime raises an error
+        stale = dict(fileinfos[1], mtime=1400000000)
+        try:
+            url_get_many([stale, fileinfos[2]])
+        except ValueError:
+            pass
         else:
-            name = basename(path)
-            source_url = check_datasource(source)
-            full_url = join(source_url, urllib.parse.quote(path.strip(sep), safe='/:'))
-            print("loading", full_url, name)
-            req = None  # Need placeholder for req in case requests.get fails.
-            try:
-                req = requests.get(full_url)
-                req.raise_for_status()
-                url_mtime = req.headers.get('last-modified', None)
-                url_time_struct = time.strptime(url_mtime, '%a, %d %b %Y %H:%M:%S %Z')
-                t_repo = datetime.datetime(*url_time_struct[:6], tzinfo=pytz.utc)
-
-                # Check timestamp if requested and if timestamp is provided
-                if mtime_check and mtime is not None:
-                    t_request = datetime.datetime.fromtimestamp(mtime, pytz.utc)
-                    if t_request != t_repo:
-                        print("request mtime = %s, repo mtime = %s"%(t_request, t_repo))
-                        compare = "older" if t_request < t_repo else "newer"
-                        raise ValueError("Requested mtime is %s than repository mtime for %r"
-                                        % (compare, path))
-
-                ret = req.content
-                print("caching " + path)
-                cache.store_file(fp, ret)
-
-            except requests.HTTPError as exc:
-                raise ValueError("Could not open %r\n%s"%(path, str(exc)))
-            finally:
-                if req is not None:
-                    req.close()
+            raise AssertionError("mtime check failed")
+    finally:
+        DATA_SOURCES = saved_sources
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
 
-    return ret
+def test_url_load_many():
+    import tempfile
+    calls = []
+    def load(fileinfo, fid):
+        calls.append(fileinfo['path'])
+        return [fid.read().decode()]
+    with tempfile.NamedTemporaryFile(suffix=".dat", delete=False) as fid:
+        fid.write(b"first")
+    path = fid.name
+    try:
+        fileinfos = [{"source": "local", "path": path}]
+        loader_id = "test_url_load_many.%s"%path
+        assert url_load_many(fileinfos, load, loader_id) == [["first"]]
+        assert url_load_many(fileinfos, load, loader_id) == [["first"]]
+        assert len(calls) == 1
+        # the parsed entries are shared by loaders with the same id
+        assert url_load_many(fileinfos, load, lambda fi: loader_id) == [["first"]]
+        assert len(calls) == 1
+        assert _parsed_key(fileinfos[0], loader_id + ".other") != _parsed_key(fileinfos[0], loader_id)
+        assert _parsed_key({"source": "ncnr", "path": path}, loader_id) is None
+        # changing the file changes the key
+        with open(path, "wb") as fid:
+            fid.write(b"second!")
+        assert url_load_many(fileinfos, load, loader_id) == [["second!"]]
+        assert len(calls) == 2
+    finally:
+        os.remove(path)
+
+def test_loader_id():
+    import types
+    module = types.ModuleType("test_loader_id")
+    exec("def load_entries(filename, file_obj=None):\n    return []",
+         module.__dict__)
+    sys.modules[module.__name__] = module
+    try:
+        # loaders must declare a version
+        try:
+            loader_id(module.load_entries)
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError("expected AttributeError")
+        module.LOADER_VERSION = 2
+        name = loader_id(module.load_entries, "(x=1)")
+        assert name == "test_loader_id.load_entries(x=1)@2"
+        module.LOADER_VERSION = 3
+        assert loader_id(module.load_entries, "(x=1)") != name
+    finally:
+        del sys.modules[module.__name__]
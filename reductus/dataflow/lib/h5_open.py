@@ -1,39 +1,349 @@
 import io
-from zipfile import ZipFile, is_zipfile
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+from zipfile import ZipFile, BadZipFile, ZIP_STORED
 
+import numpy as np
 import h5py
 
 from . import hzf_readonly_stripped as hzf
 
+#: Compressed members larger than this many bytes are decompressed to a
+#: temporary file rather than into memory.
+SPILL_SIZE = 64*1024*1024
+
 def h5_open_zip(filename, file_obj=None, **kw):
     """
     Open a NeXus file, even if it is in a zip file,
     or if it is a NeXus-zip file.
 
-    If the filename ends in '.zip', it will be unzipped to a temporary
-    directory before opening and deleted on :func:`closezip`.  If opened
-    for writing, then the file will be created in a temporary directory,
-    then zipped and deleted on :func:`closezip`.
+    If the file is a zip file containing a single HDF5 file, then the
+    member is opened in place if it is stored without compression,
+    otherwise it is decompressed into memory, or into a temporary file
+    if it is larger than *SPILL_SIZE*.
 
     If it is a zipfile but doesn't end in '.zip', it is assumed
     to be a NeXus-zip file and is opened with that library.
 
     Arguments are the same as for :func:`open`.
+
+    Files and buffers opened here are closed when the returned handle
+    is closed.
     """
+    resources = []
     if file_obj is None:
-        file_obj = io.BytesIO(open(filename, mode='rb', buffering=-1).read())
-    is_zip = is_zipfile(file_obj) # is_zipfile(file_obj) doens't work in py2.6
-    if is_zip and '.attrs' in ZipFile(file_obj).namelist():
-        # then it's a nexus-zip file, rather than
-        # a zipped hdf5 nexus file
-        f = hzf.File(filename, file_obj)
-    else:
-        if is_zip:
+        # h5py reads through the open file, so there is no need to load
+        # the whole file into memory first.
+        file_obj = open(filename, mode='rb', buffering=-1)
+        resources.append(file_obj)
+    try:
+        try:
             zf = ZipFile(file_obj)
-            members = zf.namelist()
-            assert len(members) == 1
-            file_obj = io.BytesIO(zf.read(members[0]))
-            filename = members[0]
+        except BadZipFile:
+            zf = None
+        if zf is not None and '.attrs' in zf.namelist():
+            # then it's a nexus-zip file, rather than
+            # a zipped hdf5 nexus file
+            f = hzf.File(filename, zf, resources=resources)
+        else:
+            if zf is not None:
+                members = zf.infolist()
+                assert len(members) == 1
+                file_obj = _open_member(zf, members[0], file_obj, resources)
+                filename = members[0].filename
 
-        f = h5py.File(file_obj, **kw)
+            f = _File(file_obj, resources, **kw)
+    except Exception:
+        _close_all(resources)
+        raise
     return f
+
+def _close_all(resources):
+    # Close in reverse order so views are released before their buffers.
+    for resource in reversed(resources):
+        # memoryviews are released rather than closed
+        close = getattr(resource, 'close', None)
+        (close if close is not None else resource.release)()
+    del resources[:]
+
+
+class _File(h5py.File):
+    """
+    HDF5 file which closes the files and buffers it is read from.
+    """
+    def __init__(self, file_obj, resources, **kw):
+        h5py.File.__init__(self, file_obj, **kw)
+        self._resources = resources
+
+    def close(self):
+        h5py.File.close(self)
+        _close_all(self._resources)
+
+
+def _open_member(zf, info, file_obj, resources):
+    """
+    Return a seekable file for the zip member *info* in *zf*, which was
+    opened from *file_obj*.
+
+    Any buffers or files that are opened are added to *resources*.
+    """
+    if info.compress_type == ZIP_STORED:
+        buffer = _file_buffer(file_obj)
+        if buffer is not None:
+            resources.append(buffer)
+            member = _BufferFile(buffer, _member_offset(file_obj, info),
+                                 info.file_size)
+            resources.append(member)
+            return member
+    if info.file_size > SPILL_SIZE:
+        spill = tempfile.TemporaryFile()
+        resources.append(spill)
+        with zf.open(info) as member:
+            shutil.copyfileobj(member, spill, 1024*1024)
+        spill.seek(0)
+        return spill
+    # BytesIO shares the bytes until written, so this is the only copy.
+    return io.BytesIO(zf.read(info))
+
+def _file_buffer(file_obj):
+    """
+    Return a read-only buffer for the contents of *file_obj* without copying,
+    or None if the file is neither in memory nor on disk.
+    """
+    if isinstance(file_obj, io.BytesIO):
+        return file_obj.getbuffer().toreadonly()
+    try:
+        fileno = file_obj.fileno()
+    except (AttributeError, OSError):
+        return None
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+def _member_offset(file_obj, info):
+    """
+    Return the offset of the data for zip member *info* in *file_obj*.
+    """
+    # The local header repeats the name and has its own extra field, which
+    # may differ in length from the central directory entry.
+    file_obj.seek(info.header_offset)
+    header = file_obj.read(30)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+class _BufferFile(io.RawIOBase):
+    """
+    Read-only file for the *size* bytes starting at *offset* in *buffer*.
+    """
+    def __init__(self, buffer, offset, size):
+        self._view = memoryview(buffer)[offset:offset+size]
+        self._pos = 0
+
+    def close(self):
+        # Release the window so that the underlying mmap can be closed.
+        if not self.closed:
+            self._view.release()
+        io.RawIOBase.close(self)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d"%offset)
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        data = self._view[self._pos:self._pos+len(b)]
+        n = len(data)
+        memoryview(b).cast('B')[:n] = data
+        self._pos += n
+        return n
+
+class LazyDataset(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Proxy for the dataset at *path* in the NeXus file described by *fileinfo*,
+    which is read on first access.
+
+    *shape* and *dtype* are available without reading the file.  The proxy
+    converts to an array with *np.asarray*, supports numpy arithmetic and
+    ufuncs, and forwards other array attributes such as *sum* to the data.
+    Only the file reference is pickled, so cached entries remain small until
+    the data is used.  Since changes to the data would be lost when pickled,
+    in-place operations such as *d \*= 2* raise *TypeError*; use
+    *np.array(d)* for a copy that can be modified.
+
+    The data must come from the same version of the file.  Remote files are
+    checked against the *mtime* in *fileinfo* when they are fetched, and the
+    modification time of local files is recorded when the proxy is created.
+    A *ValueError* is raised if the file has changed.
+    """
+    def __init__(self, fileinfo, path, shape, dtype):
+        from ..fetch import _is_local
+        self.fileinfo = fileinfo
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.mtime_ns = (os.stat(fileinfo['path']).st_mtime_ns
+                         if _is_local(fileinfo) else None)
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._load()
+        return self._value
+
+    def _load(self):
+        from ..fetch import url_open_many
+        path = self.fileinfo['path']
+        if (self.mtime_ns is not None
+                and os.stat(path).st_mtime_ns != self.mtime_ns):
+            raise ValueError("%r changed after it was loaded"%path)
+        fid = next(url_open_many([self.fileinfo], mtime_check=True))
+        with fid:
+            handle = h5_open_zip(os.path.basename(path), fid)
+            try:
+                return handle[self.path][()]
+            finally:
+                handle.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_value'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.value, dtype=dtype, copy=copy)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(v, LazyDataset) for v in kwargs.get('out', ())):
+            raise TypeError("LazyDataset %s is read-only"%self.path)
+        inputs = [v.value if isinstance(v, LazyDataset) else v for v in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # Only reached for attributes not defined on the proxy.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __getitem__(self, index):
+        return self.value[index]
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError("len() of unsized object")
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<LazyDataset %s%s %s in %s>"%(
+            self.path, self.shape, self.dtype, self.fileinfo['path'])
+
+
+def test_lazy_dataset():
+    import pickle
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix=".h5", delete=False) as fid:
+        path = fid.name
+    try:
+        with h5py.File(path, 'w') as handle:
+            handle['entry/counts'] = np.arange(6.).reshape(2, 3)
+        fileinfo = {'source': 'local', 'path': path}
+        counts = LazyDataset(fileinfo, '/entry/counts', (2, 3), 'float64')
+        assert len(counts) == 2 and counts._value is None
+        assert (np.asarray(counts) == np.arange(6.).reshape(2, 3)).all()
+        assert (counts*2 + 1)[1, 2] == 11. and counts.sum() == 15.
+        restored = pickle.loads(pickle.dumps(counts))
+        assert restored._value is None and restored[0, 1] == 1.
+        # in-place operations are refused, but copies can be modified
+        try:
+            restored *= 2
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("expected TypeError")
+        try:
+            np.multiply(2, counts, out=counts)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("expected TypeError")
+        copy = np.array(counts)
+        copy *= 2
+        assert counts[1, 2] == 5. and copy[1, 2] == 10.
+        assert np.asarray(counts, dtype='float32').dtype == np.float32
+        # scalars have no length, like numpy
+        scalar = LazyDataset(fileinfo, '/entry/scalar', (), 'float64')
+        try:
+            len(scalar)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("expected TypeError")
+        # the file must not change before the data is read
+        stale = pickle.loads(pickle.dumps(counts))
+        os.utime(path, ns=(0, counts.mtime_ns + 10**9))
+        try:
+            stale.value
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+        assert counts[1, 0] == 3.
+    finally:
+        os.remove(path)
+
+
+def test_open_zip():
+    import zipfile
+    global SPILL_SIZE
+    root = tempfile.mkdtemp()
+    h5path = os.path.join(root, 'run.nxs')
+    with h5py.File(h5path, 'w') as handle:
+        handle['entry/counts'] = np.arange(1000.)
+    spill_size = SPILL_SIZE
+    try:
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            zippath = os.path.join(root, 'run.nxz')
+            with ZipFile(zippath, 'w', compression=compression) as zf:
+                zf.write(h5path, 'run.nxs')
+            with open(zippath, 'rb') as fid:
+                content = fid.read()
+            for spill in (spill_size, 0):
+                SPILL_SIZE = spill
+                for file_obj in (None, io.BytesIO(content)):
+                    handle = h5_open_zip(zippath, file_obj)
+                    assert handle['entry/counts'][-1] == 999.
+                    resources = list(handle._resources)
+                    assert resources or file_obj is not None
+                    handle.close()
+                    # Files and buffers opened for the handle are closed,
+                    # but not the caller's file.
+                    assert all(getattr(r, 'closed', True) for r in resources)
+                    assert file_obj is None or not file_obj.closed
+    finally:
+        SPILL_SIZE = spill_size
+        shutil.rmtree(root)
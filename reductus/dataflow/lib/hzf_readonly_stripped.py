@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import sys
+import io
 import posixpath
 import zipfile
 import json
@@ -105,16 +106,34 @@ class Node(object):
 
 
 class File(Node):
-    def __init__(self, filename, file_obj=None):
+    def __init__(self, filename, file_obj=None, resources=None):
         self.readonly = True
         Node.__init__(self, parent_node=None, path="/")
+        # files opened on behalf of this handle, closed along with it
+        self._resources = list(resources) if resources is not None else []
         if file_obj is None:
             file_obj = builtin_open(filename, mode='rb')
-        self.zipfile = zipfile.ZipFile(file_obj)
+            self._resources.append(file_obj)
+        # reuse the zip directory if the caller has already read it
+        if isinstance(file_obj, zipfile.ZipFile):
+            self.zipfile = file_obj
+        else:
+            self.zipfile = zipfile.ZipFile(file_obj)
+        self._index()
         self.attrs = self.makeAttrs()
         self.filename = filename
         self.mode = "r"
 
+    def _index(self):
+        # Index the names once rather than scanning the namelist on each
+        # lookup, since NeXus-zip files have an entry for every field.
+        self._names = set(self.zipfile.namelist())
+        self._children = {}
+        for fn in self.zipfile.namelist():
+            fn = fn.rstrip("/")
+            self._children.setdefault(posixpath.dirname(fn), []).append(
+                posixpath.basename(fn))
+
     def flush(self):
         # might make this do writezip someday.
         pass
@@ -126,21 +145,17 @@ class File(Node):
         if path == "":
             return True # root path
         else:
-            filenames = self.root.zipfile.namelist()
-            return (path.rstrip("/") + "/") in filenames
+            return (path.rstrip("/") + "/") in self._names
 
     def listdir(self, path):
         """ abstraction for looking up paths:
         should work for unpacked directories and packed zip archives """
         path = path.strip("/")
-        return [posixpath.basename(fn.rstrip("/"))
-                for fn in self.zipfile.namelist()
-                if posixpath.dirname(fn.rstrip("/")) == path]
+        return list(self._children.get(path, []))
 
     def exists(self, path):
         path = path.strip("/")
-        filenames = self.root.zipfile.namelist()
-        return path in filenames or self.isdir(path)
+        return path in self._names or self.isdir(path)
 
     def read(self, path):
         return self.open(path, "r").read()
@@ -159,6 +174,9 @@ class File(Node):
     def close(self):
         # there seems to be only one read-only mode
         self.zipfile.close()
+        for resource in reversed(self._resources):
+            resource.close()
+        self._resources = []
 
 
 class Group(Node):
@@ -250,17 +268,13 @@ class FieldFile(object):
                     # this is only possible with empty string being written.
                     d = numpy.array([''], dtype=dtype)
                 elif dtype.kind == 'S':
-                    data = [[v for v in line[:-1].split(b'\t')]
-                            for line in infile]
-                    d = numpy.squeeze(numpy.array(data))
+                    d = numpy.squeeze(_split_text(infile.read()))
                     d = _unescape_str(d)
                 elif dtype.kind == 'U':
-                    data = [[v.decode('utf-8') for v in line[:-1].split(b'\t')]
-                            for line in infile]
-                    d = numpy.squeeze(numpy.array(data))
+                    d = numpy.squeeze(_split_text(infile.read().decode('utf-8')))
                     d = _unescape_str(d)
                 else:
-                    d = numpy.loadtxt(infile, dtype=dtype, delimiter='\t')
+                    d = _parse_numbers(infile.read(), dtype, attrs.get('shape', None))
             finally:
                 infile.close()
             if 'shape' in attrs:
@@ -272,6 +286,50 @@ class FieldFile(object):
             self._value = d
         return self._value
 
+def _split_text(text):
+    """
+    Split tab separated lines into an array with one row per line.
+    """
+    newline, tab = ('\n', '\t') if isinstance(text, str) else (b'\n', b'\t')
+    lines = text.split(newline)
+    # Each line ends in a newline, which is dropped from the last line.
+    if lines[-1]:
+        lines[-1] = lines[-1][:-1]
+    else:
+        del lines[-1]
+    columns = lines[0].count(tab) + 1
+    if all(line.count(tab) + 1 == columns for line in lines):
+        # Split all the lines at once when they have the same length.
+        fields = tab.join(lines).split(tab)
+        return numpy.array(fields).reshape(len(lines), columns)
+    return numpy.array([line.split(tab) for line in lines])
+
+def _parse_numbers(text, dtype, shape=None):
+    """
+    Parse the tab separated numbers in *text*, which should give an array
+    of *shape* if it is known.
+    """
+    if dtype.kind in 'fiu':
+        # Split on tabs and newlines together.  If the text doesn't parse
+        # or the size check fails then loadtxt reports the error.
+        try:
+            d = numpy.array(text.split(), dtype=dtype)
+        except ValueError:
+            d = numpy.empty(0, dtype=dtype)
+        if shape is not None:
+            size = 1
+            for n in shape:
+                size *= n
+            if d.size == size:
+                return d
+        else:
+            rows = text.count(b'\n') + (not text.endswith(b'\n'))
+            columns = text.split(b'\n', 1)[0].count(b'\t') + 1
+            if d.size == rows*columns:
+                # match the shape that loadtxt would return
+                return d.reshape(rows, columns).squeeze()
+    return numpy.loadtxt(io.BytesIO(text), dtype=dtype, delimiter='\t')
+
 def _unescape_str(data):
     if data.size:
         # Hide the \\ in \1 so that it doesn't get processed twice.  At the
@@ -299,3 +357,41 @@ def makeSoftLink(parent, path):
 group = Group
 field = FieldFile
 open = File
+
+def test_field_decoding():
+    # compare against the line by line parsers
+    def reference(text, dtype):
+        if dtype.kind == 'U':
+            data = [[v.decode('utf-8') for v in line[:-1].split(b'\t')]
+                    for line in io.BytesIO(text)]
+            return _unescape_str(numpy.squeeze(numpy.array(data)))
+        return numpy.loadtxt(io.BytesIO(text), dtype=dtype, delimiter='\t')
+    cases = [
+        (b'1.5\t2\tnan\n-4e3\t5\t6\n', '<f8', [2, 3]),
+        (b'1.5\n', '<f8', [1]),
+        (b'1\t2\t3\n', '<i4', None),
+        (b'1\n2\n3\n', '<i8', None),
+        (b'1\t2\n3\n', '<f8', None),  # ragged falls back to loadtxt errors
+        (b'a\tb\\tc\nd\te\n', 'U8', None),
+        (b'single\n', 'U8', None),
+        (b'x\ty\nz\n', 'U8', None),
+    ]
+    for text, dtype_str, shape in cases:
+        dtype = numpy.dtype(dtype_str)
+        try:
+            expected = reference(text, dtype)
+        except ValueError:
+            expected = None
+        try:
+            if dtype.kind == 'U':
+                actual = _unescape_str(numpy.squeeze(_split_text(text.decode('utf-8'))))
+            else:
+                actual = _parse_numbers(text, dtype, shape)
+        except ValueError:
+            actual = None
+        if expected is None:
+            assert actual is None, text
+        else:
+            assert actual.dtype == expected.dtype, text
+            assert numpy.array_equal(actual.reshape(expected.shape), expected,
+                                     equal_nan=dtype.kind == 'f'), text
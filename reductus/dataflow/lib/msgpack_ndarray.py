@@ -0,0 +1,131 @@
+"""
+Msgpack encoding with numpy arrays sent as binary buffers.
+
+Numeric arrays are packed as msgpack extension type *NDARRAY_EXT* rather
+than as lists of numbers, with the extension data::
+
+    dtype length (uint8)
+    dtype (ascii, e.g. "<f8")
+    ndim (uint8)
+    shape (ndim x uint32, little endian)
+    array data (little endian, C order)
+
+*iter_packb* produces the encoding in pieces for a streamed response,
+with the array data sent straight from the numpy buffer.  *unpackb*
+restores the arrays when decoding.
+"""
+import struct
+
+import numpy as np
+import msgpack
+
+#: Msgpack extension type code for numpy arrays.
+NDARRAY_EXT = 1
+
+#: Approximate size of the pieces yielded by :func:`iter_packb`.
+CHUNK_SIZE = 1024*1024
+
+def _default(obj):
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("cannot pack %r"%type(obj))
+
+def _array_header(array):
+    dtype = array.dtype.str.encode('ascii')
+    return b"".join((
+        struct.pack('<B', len(dtype)), dtype,
+        struct.pack('<B%dI'%array.ndim, array.ndim, *array.shape),
+    ))
+
+def iter_packb(obj, chunk_size=CHUNK_SIZE):
+    """
+    Yield the msgpack encoding of *obj* as a sequence of byte strings.
+
+    Numeric arrays within *obj* are packed as *NDARRAY_EXT*; other arrays
+    and numpy scalars are converted to python values.
+    """
+    packer = msgpack.Packer(default=_default, use_bin_type=True,
+                            autoreset=False)
+    for piece in _pack(obj, packer, chunk_size):
+        yield piece
+    tail = packer.bytes()
+    if tail:
+        yield tail
+
+def _pack(obj, packer, chunk_size):
+    if isinstance(obj, dict):
+        packer.pack_map_header(len(obj))
+        for key, value in obj.items():
+            packer.pack(key)
+            for piece in _pack(value, packer, chunk_size):
+                yield piece
+    elif isinstance(obj, (list, tuple)):
+        packer.pack_array_header(len(obj))
+        for value in obj:
+            for piece in _pack(value, packer, chunk_size):
+                yield piece
+    elif isinstance(obj, np.ndarray) and obj.dtype.kind in 'biuf':
+        array = np.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder('<'))
+        header = _array_header(array)
+        data = memoryview(array.reshape(-1).view(np.uint8))
+        # ext 32 format, written directly so the data is not copied into
+        # the packer.
+        yield packer.bytes() + struct.pack(
+            '>BIb', 0xc9, len(header) + len(data), NDARRAY_EXT) + header
+        packer.reset()
+        for start in range(0, len(data), chunk_size):
+            yield bytes(data[start:start+chunk_size])
+    else:
+        packer.pack(obj)
+        with packer.getbuffer() as buffer:
+            full = len(buffer) >= chunk_size
+        if full:
+            yield packer.bytes()
+            packer.reset()
+
+def _ext_hook(code, data):
+    if code != NDARRAY_EXT:
+        return msgpack.ExtType(code, data)
+    length = data[0]
+    dtype = np.dtype(data[1:1+length].decode('ascii'))
+    offset = 1 + length
+    ndim = data[offset]
+    shape = struct.unpack_from('<%dI'%ndim, data, offset+1)
+    offset += 1 + 4*ndim
+    return np.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+def unpackb(packed):
+    """
+    Decode *packed*, returning *NDARRAY_EXT* values as numpy arrays.
+    """
+    return msgpack.unpackb(packed, ext_hook=_ext_hook, raw=False)
+
+
+def test_iter_packb():
+    from collections import OrderedDict
+    z = np.arange(12.).reshape(3, 4)
+    content = OrderedDict([
+        ("type", "2d"), ("z", [z.T]), ("counts", np.arange(5, dtype='>i4')),
+        ("mask", z > 4), ("empty", np.zeros((0, 2))), ("dims", {"xmin": np.float64(1.5)}),
+        ("labels", np.array(["a", "b"])), ("n", np.int32(3)),
+    ])
+    pieces = list(iter_packb(content, chunk_size=16))
+    assert max(len(piece) for piece in pieces[1:-1]) <= 32
+    result = unpackb(b"".join(pieces))
+    assert list(result.keys()) == list(content.keys())
+    assert (result["z"][0] == z.T).all() and result["z"][0].shape == (4, 3)
+    assert result["counts"].dtype == np.dtype('<i4')
+    assert (result["counts"] == np.arange(5)).all()
+    assert result["mask"].dtype == bool and result["mask"].sum() == 7
+    assert result["empty"].shape == (0, 2)
+    assert result["dims"] == {"xmin": 1.5} and result["n"] == 3
+    assert result["labels"] == ["a", "b"]
+    # Without arrays the encoding matches packb.
+    plain = {"a": [1, 2.5, "x"], "b": None}
+    assert b"".join(iter_packb(plain)) == msgpack.packb(plain, use_bin_type=True)
@@ -0,0 +1,358 @@
+"""
+Reduced resolution plottables for large 2D datasets.
+
+:func:`template_plottable` returns the plottable for a template node with
+each 2D image reduced to about *pixels* values, optionally cropped to a
+*window* of the data.  It is used by *calc_terminal* for
+*return_type='plottable'* when the client requests a level of detail.
+
+The images are reduced by powers of two.  The first request for a node
+builds every level of this pyramid from the full resolution plottable
+and stores it in the cache under the node fingerprint, so later requests
+for other windows or sizes are served from the cache without retrieving
+the node output or calling *get_plottable* again.  Levels dropped from
+the cache are rebuilt when they are next requested.  Nodes which depend
+on a module flagged *nocache* can change without changing fingerprint,
+so their pyramids are not cached.
+
+Images are the *z* arrays of "2d" plottables and the *data* (and *mask*)
+arrays of the "2d_multi" datasets, flattened from arrays of shape
+*(xdim, ydim)*, with *dims* giving the outer edges of the image in data
+coordinates.  Other plottables are returned unchanged.
+"""
+import numpy as np
+
+from .cache import get_cache
+from .calc import process_template, fingerprint_template, generate_fingerprint
+from .core import lookup_module
+from .data import binary_arrays, todict
+
+#: Target number of pixels when none is given.
+DEFAULT_PIXELS = 512*512
+
+#: The pyramid stops at the first level with at most this many pixels.
+MIN_PIXELS = 64*64
+
+#: Change this when the stored levels change form.
+PYRAMID_VERSION = 1
+
+def block_reduce(image, factor, method="mean"):
+    """
+    Combine *factor* x *factor* blocks of the 2D *image*.
+
+    *method* is "mean", "max" or "min".  Blocks at the upper edges may be
+    smaller than *factor*.
+    """
+    nx, ny = image.shape
+    if factor == 1 or image.size == 0:
+        return image
+    xstart, ystart = np.arange(0, nx, factor), np.arange(0, ny, factor)
+    if method == "mean":
+        sums = np.add.reduceat(image, xstart, axis=0, dtype=float)
+        sums = np.add.reduceat(sums, ystart, axis=1)
+        counts = np.outer(np.diff(np.append(xstart, nx)),
+                          np.diff(np.append(ystart, ny)))
+        return sums/counts
+    elif method in ("max", "min"):
+        ufunc = np.maximum if method == "max" else np.minimum
+        return ufunc.reduceat(ufunc.reduceat(image, xstart, axis=0),
+                              ystart, axis=1)
+    raise ValueError("unknown reduction method %r"%method)
+
+def _panels(plottable):
+    """
+    Return the images in *plottable* as a list of *(dims, arrays)*, with
+    *arrays* mapping the field name to the image of shape *(xdim, ydim)*.
+    """
+    def panel(dims, fields):
+        shape = (int(dims['xdim']), int(dims['ydim']))
+        return dims, dict((name, np.asarray(value).reshape(shape))
+                          for name, value in fields)
+    kind = plottable.get('type', None)
+    if kind == '2d':
+        return [panel(plottable['dims'], enumerate(plottable['z']))]
+    elif kind == '2d_multi':
+        return [panel(dataset['dims'],
+                      [(name, dataset[name]) for name in ('data', 'mask')
+                       if name in dataset])
+                for dataset in plottable['datasets']]
+    return []
+
+def _replace_panels(plottable, panels):
+    """
+    Return a copy of *plottable* with the images from *panels*.  Datasets
+    whose panel is None are dropped.
+    """
+    plottable = dict(plottable)
+    if plottable['type'] == '2d':
+        dims, arrays = panels[0]
+        plottable['dims'] = dims
+        plottable['z'] = [arrays[k].ravel() for k in range(len(arrays))]
+    else:
+        datasets = []
+        for dataset, panel in zip(plottable['datasets'], panels):
+            if panel is not None:
+                dims, arrays = panel
+                dataset = dict(dataset, dims=dims)
+                dataset.update((name, value.ravel())
+                               for name, value in arrays.items())
+                datasets.append(dataset)
+        plottable['datasets'] = datasets
+    return plottable
+
+def _reduce_panel(panel, factor, method):
+    dims, arrays = panel
+    dims = dict(dims)
+    for axis in 'xy':
+        n = int(dims[axis + 'dim'])
+        step = (dims[axis + 'max'] - dims[axis + 'min'])/max(n, 1)
+        reduced = -(-n//factor)
+        dims[axis + 'dim'] = reduced
+        dims[axis + 'max'] = dims[axis + 'min'] + step*factor*reduced
+    arrays = dict((name, block_reduce(
+        value, factor, method if name != 'mask' else 'max'))
+                  for name, value in arrays.items())
+    return dims, arrays
+
+def _window_range(dims, axis, low, high):
+    """
+    Return the index range of the pixels on *axis* covering [low, high].
+    """
+    n = int(dims[axis + 'dim'])
+    start = dims[axis + 'min']
+    step = (dims[axis + 'max'] - start)/max(n, 1)
+    if step == 0:
+        return 0, n
+    ends = sorted(((low - start)/step, (high - start)/step))
+    return max(int(np.floor(ends[0])), 0), min(int(np.ceil(ends[1])), n)
+
+def _crop_panel(panel, window):
+    """
+    Return *panel* cropped to *window = [xmin, xmax, ymin, ymax]*, or None
+    if the panel is outside the window.
+    """
+    dims, arrays = panel
+    (x0, x1), (y0, y1) = (_window_range(dims, 'x', *window[:2]),
+                          _window_range(dims, 'y', *window[2:]))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    dims = dict(dims)
+    for axis, (i0, i1) in (('x', (x0, x1)), ('y', (y0, y1))):
+        start = dims[axis + 'min']
+        step = (dims[axis + 'max'] - start)/max(int(dims[axis + 'dim']), 1)
+        dims[axis + 'min'] = start + step*i0
+        dims[axis + 'max'] = start + step*i1
+        dims[axis + 'dim'] = i1 - i0
+    arrays = dict((name, value[x0:x1, y0:y1])
+                  for name, value in arrays.items())
+    return dims, arrays
+
+def _window_shapes(all_dims, window):
+    """
+    Return the image shape within *window* for the images with *all_dims*.
+    """
+    shapes = []
+    for dims in all_dims:
+        if window is None:
+            shapes.append((int(dims['xdim']), int(dims['ydim'])))
+        else:
+            (x0, x1), (y0, y1) = (_window_range(dims, 'x', *window[:2]),
+                                  _window_range(dims, 'y', *window[2:]))
+            shapes.append((max(x1 - x0, 0), max(y1 - y0, 0)))
+    return shapes
+
+def _pixels(shapes, level):
+    factor = 2**level
+    return sum(-(-nx//factor) * -(-ny//factor) for nx, ny in shapes)
+
+def reduce_plottable(plottable, factor, method="mean"):
+    """
+    Return *plottable* with its images reduced by *factor*.
+    """
+    panels = _panels(plottable)
+    if not panels:
+        return plottable
+    return _replace_panels(
+        plottable, [_reduce_panel(panel, factor, method) for panel in panels])
+
+def crop_plottable(plottable, window):
+    """
+    Return *plottable* with its images cropped to *window*.
+    """
+    panels = _panels(plottable)
+    if not panels:
+        return plottable
+    panels = [_crop_panel(panel, window) for panel in panels]
+    if plottable['type'] == '2d' and panels[0] is None:
+        # Keep the empty image so that the plot type doesn't change.
+        dims, arrays = _panels(plottable)[0]
+        panels = [(dict(dims, xdim=0, ydim=0),
+                   dict((k, v[:0, :0]) for k, v in arrays.items()))]
+    return _replace_panels(plottable, panels)
+
+def build_pyramid(values, method="mean"):
+    """
+    Return the reduced levels for the plottable *values* of a bundle.
+
+    Level *k* has the images reduced by *2\\*\\*k*.  The levels continue
+    until the images have at most *MIN_PIXELS* between them.
+    """
+    shapes = [(int(dims['xdim']), int(dims['ydim']))
+              for plottable in values for dims, _ in _panels(plottable)]
+    levels = []
+    level = 0
+    while shapes and _pixels(shapes, level) > MIN_PIXELS:
+        level += 1
+        levels.append([reduce_plottable(plottable, 2**level, method)
+                       for plottable in values])
+    return levels
+
+def _pyramid_key(node_key, method, level):
+    return generate_fingerprint(
+        ("pyramid", str(PYRAMID_VERSION), node_key, method, str(level)))
+
+def _build_pyramid(cache, node_key, compute, method):
+    """
+    Return *(full, index, levels)* for the plottable from *compute()*,
+    storing the index and levels in the cache unless *node_key* is None.
+    """
+    full = compute()
+    values = full['values']
+    levels = build_pyramid(values, method=method)
+    index = {
+        "datatype": full['datatype'], "levels": len(levels),
+        "dims": [[dims for dims, _ in _panels(plottable)]
+                 for plottable in values],
+    }
+    if node_key is not None:
+        items = [(_pyramid_key(node_key, method, k+1), level_values)
+                 for k, level_values in enumerate(levels)]
+        items.append((_pyramid_key(node_key, method, "index"), index))
+        cache.store_many(items)
+    return full, index, levels
+
+def lod_plottable(node_key, compute, pixels=DEFAULT_PIXELS, window=None,
+                  method="mean"):
+    """
+    Return the bundle plottable from *compute()* reduced to *pixels*.
+
+    *node_key* identifies the plottable in the cache, or None if the
+    reduced levels should not be cached.  *window*, if given, is
+    *[xmin, xmax, ymin, ymax]* in data coordinates.  Each reduced image
+    plottable gets a *lod* entry with the *level*, the reduction *factor*
+    and the *window*.
+    """
+    cache = get_cache()
+    full = index = levels = None
+    if node_key is not None:
+        index, = cache.retrieve_many([_pyramid_key(node_key, method, "index")])
+    if index is None:
+        full, index, levels = _build_pyramid(cache, node_key, compute, method)
+
+    shapes = _window_shapes(
+        [dims for value_dims in index['dims'] for dims in value_dims], window)
+    level = 0
+    while level < index['levels'] and _pixels(shapes, level) > pixels:
+        level += 1
+    if level == 0:
+        values = (full if full is not None else compute())['values']
+    elif levels is not None:
+        values = levels[level-1]
+    else:
+        # The level may have been evicted while the index is still cached.
+        values, = cache.retrieve_many([_pyramid_key(node_key, method, level)])
+        if values is None:
+            full, index, levels = _build_pyramid(
+                cache, node_key, compute, method)
+            values = levels[level-1]
+
+    result = []
+    for plottable, value_dims in zip(values, index['dims']):
+        if value_dims:
+            if window is not None:
+                plottable = crop_plottable(plottable, window)
+            plottable = dict(plottable, lod={
+                "level": level, "factor": 2**level, "window": window})
+        result.append(plottable)
+    return todict({"datatype": index['datatype'], "values": result})
+
+def template_plottable(template, config, target, pixels=DEFAULT_PIXELS,
+                       window=None, method="mean"):
+    """
+    Return the plottable for the *target=(node, terminal)* of *template*
+    reduced to *pixels*.  See :func:`lod_plottable`.
+    """
+    nodenum, terminal_id = target
+    node_fp = fingerprint_template(template, config)[nodenum]
+    def compute():
+        with binary_arrays():
+            retval = process_template(template, config, target=target,
+                                      lazy=True)
+            return retval.get_plottable()
+    cached = all(lookup_module(template.modules[node]['module']).cached
+                 for node, _ in template.ordered(target=nodenum))
+    node_key = ":".join((node_fp, terminal_id)) if cached else None
+    return lod_plottable(node_key, compute,
+                         pixels=pixels, window=window, method=method)
+
+
+def test_block_reduce():
+    image = np.arange(35.).reshape(7, 5)
+    reduced = block_reduce(image, 2)
+    assert reduced.shape == (4, 3)
+    assert reduced[0, 0] == image[:2, :2].mean()
+    assert reduced[3, 2] == image[6, 4] and reduced[3, 0] == image[6, :2].mean()
+    peaks = block_reduce(image, 3, "max")
+    assert peaks.shape == (3, 2) and peaks[0, 0] == image[2, 2] and peaks[2, 1] == image[6, 4]
+    assert block_reduce(image, 8, "min")[0, 0] == 0.
+
+
+def test_lod_plottable():
+    from .cache import set_test_cache
+    set_test_cache()
+    calls = []
+    image = np.arange(64*32.).reshape(64, 32)
+    def compute():
+        calls.append(1)
+        return {"datatype": "test", "values": [
+            {"type": "2d", "z": [image.ravel()],
+             "dims": {"xmin": 0., "xmax": 64., "xdim": 64,
+                      "ymin": 0., "ymax": 32., "ydim": 32,
+                      "zmin": 0., "zmax": image.max()}},
+            {"type": "1d", "data": [[0, 1]]},
+        ]}
+    global MIN_PIXELS
+    min_pixels = MIN_PIXELS
+    MIN_PIXELS = 16
+    try:
+        full = lod_plottable("node", compute, pixels=4096)
+        assert len(calls) == 1 and full["values"][0]["lod"]["factor"] == 1
+        assert len(full["values"][0]["z"][0]) == 64*32
+        assert full["values"][1] == {"type": "1d", "data": [[0, 1]]}
+        small = lod_plottable("node", compute, pixels=128)
+        assert len(calls) == 1, "reduced levels come from the cache"
+        value = small["values"][0]
+        assert value["lod"]["factor"] == 4
+        assert (value["dims"]["xdim"], value["dims"]["ydim"]) == (16, 8)
+        assert value["z"][0][0] == image[:4, :4].mean()
+        zoom = lod_plottable("node", compute, pixels=32,
+                             window=[8., 23.5, 4., 12.])
+        value = zoom["values"][0]
+        assert value["lod"]["factor"] == 2 and len(calls) == 1
+        dims = value["dims"]
+        assert (dims["xmin"], dims["xmax"], dims["ymin"], dims["ymax"]) == (8., 24., 4., 12.)
+        assert (dims["xdim"], dims["ydim"]) == (8, 4)
+        assert value["z"][0][0] == image[8:10, 4:6].mean()
+        assert dims["zmax"] == image.max()
+        # Evicted levels are rebuilt and stored again.
+        get_cache().delete(_pyramid_key("node", "mean", 2))
+        again = lod_plottable("node", compute, pixels=128)
+        assert len(calls) == 2 and again == small
+        lod_plottable("node", compute, pixels=128)
+        assert len(calls) == 2
+        # Uncached plottables are computed every time.
+        assert lod_plottable(None, compute, pixels=128) == small
+        assert lod_plottable(None, compute, pixels=128) == small
+        assert len(calls) == 4
+    finally:
+        MIN_PIXELS = min_pixels
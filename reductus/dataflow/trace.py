@@ -0,0 +1,252 @@
+"""
+Trace the evaluation of template nodes.
+
+:func:`.calc.process_template` reports a :class:`NodeSpan` for every node
+that it retrieves from the cache or calculates, giving the module, the
+cache status, the time and memory used and the number of bytes moved to
+and from the cache.  Spans are logged to the *reductus.dataflow.trace*
+logger at debug level, passed to any listeners registered with
+*trace.add_listener(fn)*, and summarized by module in the report returned
+from *trace.get_report()*.
+
+Span attributes use dotted names so that listeners can forward them
+directly to a tracing system such as OpenTelemetry::
+
+    from opentelemetry import trace as otel
+    tracer = otel.get_tracer("reductus")
+    def forward(span):
+        otel_span = tracer.start_span(span.name, start_time=int(span.start*1e9),
+                                      attributes=span.attributes())
+        otel_span.end(end_time=int(span.end*1e9))
+    trace.add_listener(forward)
+
+A singleton :class:`TraceManager` collects the spans for the process.
+"""
+import sys
+import time
+import logging
+import threading
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+LOGGER = logging.getLogger(__name__)
+
+def _peak_rss():
+    """
+    Return the peak resident memory of the process in bytes, or zero if it
+    is not available on this platform.
+    """
+    if resource is None:
+        return 0
+    # linux reports kilobytes, macOS reports bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+
+class TaskUsage(object):
+    """
+    Resources used by a task on a worker.
+
+    *cpu* is the cpu time in seconds for the thread running the task, and
+    *memory* is the increase in peak resident memory of the worker process
+    while the task was running.  Peak memory only increases, so *memory*
+    is zero for tasks that fit within the previous peak.
+    """
+    def __init__(self, cpu=0.0, memory=0):
+        self.cpu = cpu
+        self.memory = memory
+
+
+def measure(fn, *args, **kwargs):
+    """
+    Call *fn(\\*args, \\*\\*kwargs)*, returning *(result, usage)* where
+    *usage* is a :class:`TaskUsage`.
+    """
+    cpu, rss = time.thread_time(), _peak_rss()
+    result = fn(*args, **kwargs)
+    usage = TaskUsage(cpu=time.thread_time() - cpu, memory=_peak_rss() - rss)
+    return result, usage
+
+
+class NodeSpan(object):
+    """
+    Record of the evaluation of one template node.
+
+    *status* is "cached" if the node was retrieved from the cache,
+    "calculated" if it was evaluated, or "partial" if some of the datasets
+    of a pure node were retrieved from the cache and the rest were evaluated.
+
+    *start* and *end* are the wall clock times that the node started and
+    finished, including time spent waiting for a worker.  *cpu* is the total
+    cpu time for the tasks evaluating the node, and *memory* is the largest
+    :class:`TaskUsage` memory increase for those tasks.
+    *length* is the number of datasets on the node outputs.  *bytes_read*
+    and *bytes_written* are the size of the cache entries retrieved and
+    stored for the node.  *depth* is zero for nodes of the template being
+    evaluated, and one more for each level of template evaluated within a
+    node on the same thread, such as by the VSANS load steps.
+    """
+    def __init__(self, node, module_id, fingerprint, status, start, end,
+                 length=0, tasks=0, cpu=0.0, memory=0,
+                 bytes_read=0, bytes_written=0, depth=0):
+        self.node = node
+        self.module_id = module_id
+        self.fingerprint = fingerprint
+        self.status = status
+        self.start = start
+        self.end = end
+        self.length = length
+        self.tasks = tasks
+        self.cpu = cpu
+        self.memory = memory
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.depth = depth
+
+    @property
+    def name(self):
+        return "node %d, %s"%(self.node, self.module_id)
+
+    @property
+    def wall(self):
+        return self.end - self.start
+
+    def attributes(self):
+        """
+        Return the span attributes as a flat dictionary.
+        """
+        return {
+            "reductus.node": self.node,
+            "reductus.module": self.module_id,
+            "reductus.fingerprint": self.fingerprint,
+            "reductus.cache.status": self.status,
+            "reductus.bundle.length": self.length,
+            "reductus.tasks": self.tasks,
+            "reductus.cpu_time": self.cpu,
+            "reductus.memory.peak_delta": self.memory,
+            "reductus.cache.bytes_read": self.bytes_read,
+            "reductus.cache.bytes_written": self.bytes_written,
+            "reductus.depth": self.depth,
+        }
+
+    def todict(self):
+        keys = ['node', 'module_id', 'fingerprint', 'status', 'start', 'end',
+                'wall', 'length', 'tasks', 'cpu', 'memory',
+                'bytes_read', 'bytes_written', 'depth']
+        return dict((k, getattr(self, k)) for k in keys)
+
+    def __repr__(self):
+        return "<NodeSpan %s %s %.3fs>"%(self.name, self.status, self.wall)
+
+
+class TraceManager(object):
+    """
+    Collect the node spans reported by the calculation engine.
+
+    *history* is the number of recent spans included in the report.
+    """
+    SUMMED = ('wall', 'cpu', 'length', 'tasks', 'bytes_read', 'bytes_written')
+
+    def __init__(self, history=100):
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=history)
+        self._modules = {}
+
+    def add_listener(self, fn):
+        """
+        Call *fn(span)* for each :class:`NodeSpan` as it completes.
+
+        Listeners are called from the thread evaluating the template.
+        """
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self._listeners.remove(fn)
+
+    def emit(self, span):
+        """
+        Record the span and send it to the listeners.
+        """
+        LOGGER.debug("%s %s wall=%.3fs cpu=%.3fs read=%d written=%d",
+                     span.name, span.status, span.wall, span.cpu,
+                     span.bytes_read, span.bytes_written)
+        with self._lock:
+            self._recent.append(span)
+            summary = self._modules.get(span.module_id, None)
+            if summary is None:
+                summary = self._modules[span.module_id] = dict(
+                    (k, 0) for k in self.SUMMED + ('nodes', 'memory'))
+                summary.update(cached=0, calculated=0, partial=0)
+            summary['nodes'] += 1
+            summary[span.status] += 1
+            for k in self.SUMMED:
+                summary[k] += getattr(span, k)
+            summary['memory'] = max(summary['memory'], span.memory)
+        for fn in self._listeners:
+            try:
+                fn(span)
+            except Exception:
+                LOGGER.exception("trace listener failed for %s", span.name)
+
+    def get_report(self):
+        """
+        Return a summary of the spans recorded since the last reset.
+
+        The report contains *modules*, the totals for each module id,
+        *totals*, the totals over all modules, with *hit_ratio* the fraction
+        of nodes retrieved from the cache, and *recent*, the most recent
+        spans as dictionaries.
+        """
+        with self._lock:
+            modules = dict((k, dict(v)) for k, v in self._modules.items())
+            recent = [span.todict() for span in self._recent]
+        totals = dict((k, sum(v[k] for v in modules.values()))
+                      for k in self.SUMMED
+                      + ('nodes', 'cached', 'calculated', 'partial'))
+        totals['memory'] = max([v['memory'] for v in modules.values()] or [0])
+        totals['hit_ratio'] = (
+            totals['cached']/totals['nodes'] if totals['nodes'] else 0.0)
+        return {"modules": modules, "totals": totals, "recent": recent}
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._modules.clear()
+
+
+# Singleton trace manager for the process
+TRACE_MANAGER = TraceManager()
+
+# direct access to singleton methods
+add_listener = TRACE_MANAGER.add_listener
+remove_listener = TRACE_MANAGER.remove_listener
+emit = TRACE_MANAGER.emit
+get_report = TRACE_MANAGER.get_report
+reset = TRACE_MANAGER.reset
+
+
+def test_report():
+    manager = TraceManager(history=2)
+    seen = []
+    manager.add_listener(seen.append)
+    manager.emit(NodeSpan(0, "a.load", "fp0", "calculated", 0., 2.,
+                          length=3, tasks=1, cpu=1.5, bytes_written=10))
+    manager.emit(NodeSpan(1, "a.scale", "fp1", "cached", 2., 2.5,
+                          length=3, bytes_read=10))
+    manager.emit(NodeSpan(0, "a.load", "fp0", "cached", 3., 3.5,
+                          length=3, bytes_read=10))
+    report = manager.get_report()
+    assert len(seen) == 3 and len(report["recent"]) == 2
+    load = report["modules"]["a.load"]
+    assert load["nodes"] == 2 and load["cached"] == load["calculated"] == 1
+    assert load["wall"] == 2.5 and load["bytes_read"] == 10
+    totals = report["totals"]
+    assert totals["nodes"] == 3 and abs(totals["hit_ratio"] - 2/3) < 1e-12
+    assert seen[0].attributes()["reductus.cache.status"] == "calculated"
+    manager.reset()
+    assert manager.get_report()["totals"]["nodes"] == 0
@@ -17,6 +17,10 @@ def _b(s):
 
 from reductus.dataflow.lib import octave
 from reductus.dataflow.lib.exporters import exports_HDF5, exports_text
+from reductus.dataflow.data import array_item
+
+# Bump when a change to the loader changes the entries it returns.
+LOADER_VERSION = 1
 
 class RawData(object):
     def __init__(self, name, data):
@@ -77,7 +81,7 @@ class EfTwoThetaData(object):
             "type": "2d",
             "xlabel": self.xaxis["label"],
             "ylabel": self.yaxis["label"],
-            "z": [self.data.flatten().tolist()]
+            "z": [array_item(self.data.ravel())]
         }
         return output
     
@@ -123,7 +127,7 @@ class EQData(object):
             "type": "2d",
             "xlabel": self.xaxis["label"],
             "ylabel": self.yaxis["label"],
-            "z": [self.data.flatten().tolist()]
+            "z": [array_item(self.data.ravel())]
         }
         return output
 
@@ -210,7 +214,7 @@ def _toDictItem(obj):
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist()
+        obj = array_item(obj)
     elif isinstance(obj, datetime.datetime):
         obj = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second]
     elif isinstance(obj, list):
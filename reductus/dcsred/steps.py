@@ -72,17 +72,13 @@ def LoadDCS(filelist=None, check_timestamps=True):
 
     2018-04-25 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .dcsdata import readDCS
     if filelist is None:
         filelist = []
-    data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entry = readDCS(name, fid)
-        data.append(entry)
+    data = url_load_many(
+        filelist, lambda fileinfo, fid: readDCS(basename(fileinfo['path']), fid),
+        loader_id(readDCS), mtime_check=check_timestamps)
 
     return data
 
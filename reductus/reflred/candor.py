@@ -11,8 +11,13 @@ from .refldata import ReflData, Intent, Group, Detector, set_fields
 from .nexusref import load_nexus_entries, nexus_common, get_pol
 from .nexusref import data_as, str_data
 from .nexusref import TRAJECTORY_INTENTS
+from .nexusref import LOADER_VERSION as NEXUS_LOADER_VERSION
 from .resolution import FWHM2sigma
 
+# Bump when a change to the loader changes the entries it returns.  The
+# nexusref version is included since it does most of the loading.
+LOADER_VERSION = "%d.%d"%(NEXUS_LOADER_VERSION, 1)
+
 def load_metadata(filename, file_obj=None):
     """
     Load the summary info for all entries in a NeXus file.
@@ -530,25 +535,29 @@ def nobin(data):
     return datasets[0]
 
 def rebin(data, q, average="poisson"):
+    # Only look at bank 0 for now
+    return rebin_banks(data, q, average)[0]
+
+def rebin_banks(data, q, average="poisson"):
+    """
+    Rebin each detector bank in *data* onto *q*, returning one QData per bank.
+    """
     if average not in ("poisson", "gauss"):
         raise ValueError("expected average to be 'poisson' or 'gauss'")
     if average == "poisson" and data.normbase not in ("monitor", "time", "none"):
         raise ValueError("expected norm to be time, monitor or none for poisson average")
     q_edges = edges(q, extended=True)
-    datasets = []
-    for bank in range(data.v.shape[2]):
-        qz, dq, v, dv, Ti, dT, L, dL = _rebin_bank(data, bank, q_edges, average)
-        #output = ReflData()
-        #output.v, output.dv = v, dv
-        #output.x, output.dx = q, dq
-        datasets.append(QData(data, qz, dq, v, dv, Ti, dT, L, dL))
-
-    # Only look at bank 0 for now
-    return datasets[0]
+    return [QData(data, *columns)
+            for columns in _rebin_banks(data, q_edges, average)]
 
-def _rebin_bank(data, bank, q_edges, average):
+def _rebin_banks(data, q_edges, average):
     """
-    Merge q points across channels and angles, returning q, dq, v, dv.
+    Merge q points across channels and angles for each detector bank,
+    returning a list of (q, dq, v, dv, T, dT, L, dL) for each bank.
+
+    All banks are binned together, with each point labelled by its
+    (bank, bin) pair, so each moment is accumulated for every bank in a
+    single pass over the data.
 
     Intensities (v, dv) are combined using poisson averaging.
 
@@ -608,50 +617,80 @@ def _rebin_bank(data, bank, q_edges, average):
     In these situations measure fewer angles for longer without binning the
     data so that you can ignore wavelength variation within each theory value.
     """
-    # Make all data have the same shape
-    columns = (
-        data.Qz, data.dQ, data.v, data.dv,
-        data.Ti, data.angular_resolution, data.Ld, data.dL)
-    columns = [np.broadcast_to(p, data.v.shape) for p in columns]
-    columns = [p[:, :, bank].flatten() for p in columns]
-    q, dq, y, dy, T, dT, L, dL = columns
-
-    # Sort q values into bins
+    # Make all data have the same shape.  Points are ordered by
+    # (angle, wavelength, bank), so bank varies fastest.
+    shape = data.v.shape
+    nbanks = shape[2]
+    def flat(p):
+        return np.broadcast_to(p, shape).ravel()
+    q, dq, y, dy = [flat(p) for p in (data.Qz, data.dQ, data.v, data.dv)]
+    L, dL, dT = data.Ld, data.dL, data.angular_resolution
+
+    # Sort q values into bins, with a separate set of bins for each bank.
     nbins = len(q_edges) - 1
     bin_index = np.searchsorted(q_edges, q) - 1
+    bank_offset = np.broadcast_to(nbins*np.arange(nbanks), shape).ravel()
+    labels = bank_offset + bin_index
+    # Points with q outside the bins, such as NaN, would otherwise be
+    # counted in the first bin of the next bank.
+    valid = np.isfinite(q) & (bin_index >= 0) & (bin_index < nbins)
+    if not valid.all():
+        labels = labels[valid]
+
+    # The following is cribbed from util.poisson_average, with the sums
+    # taken over each bin.
+    norm = data.normbase
+    if average == "gauss":
+        dy = dy + (dy == 0) # protect against zero uncertainty
+        intensity = (y/dy**2, dy**-2)
+    elif norm == "none":
+        intensity = (y, dy**2)
+    else:
+        # Counts must be positive for poisson averaging...
+        y = y.copy()
+        y[y < 0] = 0.
+        dy = dy + (dy == 0) # protect against zero uncertainty
+        monitors = y*(y+1)/dy**2 if norm == "monitor" else y/dy**2 # if "time"
+        monitors[y == 0] = 1./dy[y == 0] # protect against zero counts
+        counts = y*monitors
+        intensity = (monitors, counts)
+
+    # Weights must be positive; use equal weights for now.  For intensity
+    # weighting when finding q centers, multiply the q, L and dT moments
+    # by w = y and replace the point count with the sum of w.
+    # The L and dT moments are computed before broadcasting since they
+    # only vary with wavelength or angle.
+    moments = intensity + (q, dq**2 + q**2) + tuple(
+        flat(p) for p in (1/L, L, dL**2 + L**2, dT**2))
+
+    if not valid.all():
+        moments = [m[valid] for m in moments]
+
+    # Accumulate each moment for all banks at once.
+    nlabels = nbanks*nbins
+    sums = [np.bincount(labels, minlength=nlabels)]
+    sums.extend(np.bincount(labels, weights=m, minlength=nlabels) for m in moments)
+    sums = np.reshape(sums, (-1, nbanks, nbins))
+    points_per_bin, S0, S1 = sums[:3]
+    sum_q, sum_dqsq, sum_Linv, sum_L, sum_dLsq, sum_dT = sums[3:]
 
     # Some bins may not have any points contributing, such as those before
     # and after, or those in the middle if the q-step is too fine. These
     # will be excluded from the final result.
-    points_per_bin = np.bincount(bin_index, minlength=nbins)
     # Note: we add empty_q to the divisor in a number of places to protect
     # against divide by zero in those bins. Since we are excluding these at
     # the end, this removes the spurious warnings without changing results.
     empty_q = (points_per_bin == 0)
-    # The following is cribbed from util.poisson_average, replacing
-    # np.sum with np.bincount.
-    # TODO: update poisson average so it handles grouping
-    norm = data.normbase
     if average == "gauss":
-        dy = dy + (dy == 0) # protect against zero uncertainty
-        Swx = np.bincount(bin_index, weights=y/dy**2, minlength=nbins)
-        Sw = np.bincount(bin_index, weights=dy**-2, minlength=nbins)
+        Swx, Sw = S0, S1
         Sw += empty_q  # Protect against division by zero
         bar_y = Swx / Sw
         bar_dy = 1/np.sqrt(Sw)
     elif norm == "none":
-        bar_y = np.bincount(bin_index, weights=y, minlength=nbins)
-        bar_dy = np.sqrt(np.bincount(bin_index, weights=dy**2, minlength=nbins))
+        bar_y = S0
+        bar_dy = np.sqrt(S1)
     else:
-        # Counts must be positive for poisson averaging...
-        y = y.copy()
-        y[y < 0] = 0.
-        dy = dy + (dy == 0) # protect against zero uncertainty
-        monitors = y*(y+1)/dy**2 if norm == "monitor" else y/dy**2 # if "time"
-        monitors[y == 0] = 1./dy[y == 0] # protect against zero counts
-        counts = y*monitors
-        combined_monitors = np.bincount(bin_index, weights=monitors, minlength=nbins)
-        combined_counts = np.bincount(bin_index, weights=counts, minlength=nbins)
+        combined_monitors, combined_counts = S0, S1
         combined_monitors += empty_q  # Protect against division by zero
         bar_y = combined_counts/combined_monitors
         if norm == "time":
@@ -662,42 +701,27 @@ def _rebin_bank(data, bank, q_edges, average):
             bar_dy[idx] = bar_y[idx] * np.sqrt(1./combined_counts[idx]
                                                + 1./combined_monitors[idx])
 
-    # Find Q center and resolution, weighting by intensity
-    w = np.ones_like(y)  # Weights must be positive; use equal weights for now
-    #w = y # use intensity weighting when finding q centers
-    sum_w = np.bincount(bin_index, weights=w, minlength=nbins)
-    #assert ((sum_w == 0) == empty_q).all()
-    sum_w += empty_q  # protect against divide by zero
-    sum_q = np.bincount(bin_index, weights=q*w, minlength=nbins)
+    # Find Q center and resolution
+    sum_w = points_per_bin + empty_q  # protect against divide by zero
     bar_q = sum_q / sum_w
     # Combined dq according to mixture distribution.
-    sum_dqsq = np.bincount(bin_index, weights=w*(dq**2 + q**2), minlength=nbins)
     bar_dq = np.sqrt(sum_dqsq/sum_w - bar_q**2)
-    ## Combined dq according average of variance.
-    #bar_dq = np.sqrt(np.bincount(bin_index, weights=dq*w, minlength=nbins)/bar_w)
-    # Set dq to 1% for now...
-    #bar_dq = bar_q*0.01
 
     # Combine wavelengths
-    sum_Linv = np.bincount(bin_index, weights=w/L, minlength=nbins)
-    #assert ((sum_Linv == 0) == empty_q).all()
     sum_Linv += empty_q  # protect against divide by zero
     bar_Linv = sum_w/sum_Linv  # Not the first moment of L
-    sum_L = np.bincount(bin_index, weights=w*L, minlength=nbins)
-    sum_dLsq = np.bincount(bin_index, weights=w*(dL**2+L**2), minlength=nbins)
     bar_dL = np.sqrt(sum_dLsq/sum_w - (sum_L/sum_w)**2)
 
     # Combine angles
     bar_T = np.degrees(np.arcsin(bar_q*bar_Linv / 4 / np.pi))
-    sum_dT = np.bincount(bin_index, weights=w*dT**2, minlength=nbins)
     bar_dT = np.sqrt(sum_dT/sum_w)
 
     # Need to drop catch-all bins before and after q edges.
     # Also need to drop q bins which don't contain any values.
     keep = ~empty_q
-    keep[0] = keep[-1] = False
+    keep[:, 0] = keep[:, -1] = False
     columns = (bar_q, bar_dq, bar_y, bar_dy, bar_T, bar_dT, bar_Linv, bar_dL)
-    return [p[keep] for p in columns]
+    return [[p[bank][keep[bank]] for p in columns] for bank in range(nbanks)]
 
 def edges(c, extended=False):
     r"""
@@ -713,6 +737,35 @@ def edges(c, extended=False):
     else:
         return np.hstack((left, midpoints, right))
 
+def test_rebin_banks():
+    from types import SimpleNamespace
+    # Two angles, three wavelengths, two banks with bank 1 twice as bright.
+    T = np.array([1., 2.])[:, None, None]
+    L = np.array([4., 5., 6.])[None, :, None]
+    Q = 4*np.pi/L*np.sin(np.radians(T))*np.ones((1, 1, 2))
+    v = np.arange(1., 7.).reshape(2, 3, 1)*np.array([1., 2.])
+    data = SimpleNamespace(
+        Qz=Q, dQ=0.01*Q, v=v, dv=np.ones_like(v), Ti=T,
+        angular_resolution=np.full_like(T, 0.01), Ld=L, dL=0.01*L,
+        normbase="none")
+    # Put all points in one bin.
+    q_edges = edges(np.array([0., 1., 2.]), extended=True)
+    for average in ("gauss", "poisson"):
+        bank0, bank1 = _rebin_banks(data, q_edges, average)
+        assert len(bank0[0]) == len(bank1[0]) == 1
+        assert np.allclose(bank0[0], Q[..., 0].mean())
+        assert np.allclose(bank1[0], bank0[0]) and np.allclose(bank1[1], bank0[1])
+        total = 21. if average == "poisson" else 3.5
+        assert np.allclose(bank0[2], total) and np.allclose(bank1[2], 2*total)
+        assert np.allclose(bank0[6], 1/np.mean(1/L))
+    # Points with undefined q are dropped, even in the last bank.
+    data.Qz = Q.copy()
+    data.Qz[0, 0, 1] = np.nan
+    bank0, bank1 = _rebin_banks(data, q_edges, "gauss")
+    assert np.allclose(bank0[2], 3.5)
+    assert np.allclose(bank1[2], 2*np.mean(np.arange(2., 7.)))
+    assert np.allclose(bank1[0], Q[..., 1].ravel()[1:].mean())
+
 if __name__ == "__main__":
     from .nexusref import demo
     demo(loader=load_entries)
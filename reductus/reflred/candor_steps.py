@@ -3,7 +3,7 @@ from copy import copy
 
 import numpy as np
 
-from reductus.dataflow.automod import cache, nocache, module, copy_module
+from reductus.dataflow.automod import cache, nocache, module, copy_module, pure
 # Note: do not load symbols from .steps directly into the file scope
 # or they will be defined twice as reduction modules.
 from . import steps
@@ -297,6 +297,7 @@ def candor_select_xy(data, x_range=[None, None], y_range=[None, None]):
     return xy_data
 
 
+@pure
 @module("candor")
 def spectral_efficiency(data, spectrum=()):
     r"""
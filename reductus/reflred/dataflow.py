@@ -1,6 +1,5 @@
 from reductus.dataflow import core as df
 from reductus.dataflow.automod import make_modules, make_template, auto_module, get_modules
-from reductus.dataflow.calc import process_template
 from reductus.dataflow.data import Plottable
 from reductus.dataflow.lib.exporters import exports_json
 
@@ -42,9 +41,14 @@ class FluxData(object):
 
 def make_cached_subloader_module(load_action, prefix=""):
     """
-    This assumes that the load_action can be run with a single fileinfo
-    in any of the fields of datatype 'fileinfo',
-    and collates the results of running them one at a time.
+    This assumes that the load_action can be run with any of the fields
+    of datatype 'fileinfo', and collates the results of running it
+    on each of them in turn.
+
+    The parsed entries of each file are cached by
+    :func:`reductus.dataflow.fetch.url_load_many`, which also downloads the
+    files that are needed together, so changing one file in the list only
+    reads that file.
     """
     # Read the module defintion from the docstring
     module_description = auto_module(load_action)
@@ -53,18 +57,7 @@ def make_cached_subloader_module(load_action, prefix=""):
 
     # Tag module ids with prefix
     module_description['name'] += " (cached)"
-    mod_id = module_description['id'] = prefix + module_description['id']
-    template_def = {
-        "name": "loader_template",
-        "description": "cached remote loader",
-        "modules": [
-            {"module": mod_id, "version": "0.1", "config": {}}
-        ],
-        "wires": [],
-        "instrument": INSTRUMENT,
-        "version": "0.0"
-    }
-    template = df.Template(**template_def)
+    module_description['id'] = prefix + module_description['id']
 
     # Tag each terminal data type with the data type prefix, if it is
     # not already a fully qualified name
@@ -80,17 +73,11 @@ def make_cached_subloader_module(load_action, prefix=""):
             # replace fileinfos with empty lists
             kwargs[ff['id']] = []
         for field_id in fileinfos:
-            fileinfo = fileinfos[field_id]
-            for fi in fileinfo:
-                # put a single fileinfo into the hopper
-                kwargs[field_id] = [fi]
-                config = {"0": kwargs}
-                nodenum = 0
-                terminal_id = "output"
-                retval = process_template(template, config, target=(nodenum, terminal_id))
-                outputs.extend(retval.values)
-                # take it back out before continuing the loop(s)
-                kwargs[field_id] = []
+            # put the fileinfos for one field into the hopper
+            kwargs[field_id] = fileinfos[field_id]
+            outputs.extend(load_action(**kwargs))
+            # take them back out before continuing the loop
+            kwargs[field_id] = []
         return outputs
 
     new_action.cached = True
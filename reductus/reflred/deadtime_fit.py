@@ -281,35 +281,9 @@ def estimate_incident(observed_rate, tau_NP, tau_P, above=False):
     # Paralyzing and mixed dead time
     R, dR = observed_rate
     Ipeak, Rpeak = peak_rate(tau_NP[0], tau_P[0])
-    if above:
-        # Use bisection for intensity above Ipeak.  This was stable enough
-        # for the problems tried.  We haven't put effort into improving
-        # performance this capability isn't likely to be used in production.
-        n, p = tau_NP[0]*DEADTIME_SCALE, tau_P[0]*DEADTIME_SCALE
-        I = [_invert_above(Ipeak, Rpeak, rk, n, p) for rk in R]
-        # We can probably get Newton-Raphson iteration to work if we start
-        # it in the right place.  The first try with Io = Ipeak*Rpeak/r
-        # gave numerical problems, presumably because it was starting too
-        # far out in I.  If this capability becomes important this problem
-        # can be solved for reasonable values of r.
-        I = np.array(I)
-    else:
-        # Use solver for P and mixed P-NP problems.
-        n, p = tau_NP[0]*DEADTIME_SCALE, tau_P[0]*DEADTIME_SCALE
-        r = np.asarray(observed_rate[0], 'd')
-        # Use Newton-Raphson iteration starting from the observed rate.
-        # It converges quickly and stably away from Rpeak.  Near Rpeak
-        # it may give numerical problems, but these points are handled
-        # elsewhere, so the errors and warnings are suppressed.
-        with np.errstate(all='ignore'):
-            I = r.copy()
-            I -= _forward(I, n, p, r) / _dforward(I, n, p)
-            I -= _forward(I, n, p, r) / _dforward(I, n, p)
-            I -= _forward(I, n, p, r) / _dforward(I, n, p)
-        # Use bisection near Rpeak since the slope approaches zero and
-        # Newton-Raphson may fail.  These should be rare.
-        index = (r > 0.9*Rpeak)
-        I[index] = [_invert_below(Ipeak, Rpeak, rk, n, p) for rk in r[index]]
+    n, p = tau_NP[0]*DEADTIME_SCALE, tau_P[0]*DEADTIME_SCALE
+    r = np.asarray(R, 'd')
+    I = _invert(r.flatten(), n, p, Ipeak, Rpeak, above=above).reshape(r.shape)
 
     return I, (I/R)*dR
 
@@ -327,13 +301,53 @@ def estimate_attenuation(observed_rate, tau_NP, tau_P, above=False):
     A = I/uarray(*observed_rate)
     return A
 
-def _invert_below(Ipeak, Rpeak, r, n, p):
-    from scipy.optimize import bisect
-    return bisect(_forward, r, Ipeak, args=(n, p, r)) if r < Rpeak else Ipeak
-
-def _invert_above(Ipeak, Rpeak, r, n, p):
-    from scipy.optimize import bisect
-    return bisect(_forward, Ipeak, 1e6*Ipeak, args=(n, p, r)) if r < Rpeak else Ipeak
+def _invert(r, n, p, Ipeak, Rpeak, above=False, maxiter=200):
+    """
+    Return incident rate *I* for each observed rate in the vector *r*.
+
+    Inverts the mixed dead time model for all points at once using
+    Newton-Raphson iteration safeguarded by bisection.  The root for each
+    point is kept in a bracket, either [r, Ipeak] or [Ipeak, 1e6 Ipeak]
+    if *above*, within which the model is monotonic.  Newton steps which
+    leave the bracket are replaced by bisection, so the iteration remains
+    stable near Rpeak where the slope approaches zero.  Rates at or above
+    Rpeak return Ipeak.
+    """
+    tol = 4*np.finfo('d').eps
+    saturated = (r >= Rpeak)
+    if above:
+        # The model is decreasing above Ipeak; flip it so it increases.
+        sign = -1.
+        lo, hi = np.full_like(r, Ipeak), np.full_like(r, 1e6*Ipeak)
+        # Start from the paralyzing model for large I, where r ~ I exp(-I p).
+        with np.errstate(all='ignore'):
+            I = np.clip(-np.log(r/Rpeak)/p + Ipeak, lo, hi)
+    else:
+        sign = 1.
+        lo, hi = r.copy(), np.full_like(r, Ipeak)
+        I = r.copy()
+    I[saturated] = Ipeak
+    active = ~saturated
+    with np.errstate(all='ignore'):
+        for _ in range(maxiter):
+            if not active.any():
+                break
+            Ik, rk, lok, hik = I[active], r[active], lo[active], hi[active]
+            f = _forward(Ik, n, p, rk)
+            below = (sign*f < 0)
+            lok = np.where(below, Ik, lok)
+            hik = np.where(below, hik, Ik)
+            step = f/_dforward(Ik, n, p)
+            Inew = Ik - step
+            bisect = ~((Inew > lok) & (Inew < hik)) & (f != 0)
+            Inew[bisect] = 0.5*(lok[bisect] + hik[bisect])
+            # Stop when the step or the bracket is within tolerance.  NaN
+            # rates also stop.
+            done = ~((abs(Inew - Ik) > tol*abs(Inew))
+                     & (hik - lok > tol*abs(Inew)))
+            I[active], lo[active], hi[active] = Inew, lok, hik
+            active[active] = ~done
+    return I
 
 def _forward(I, n, p, r):
     return I*exp(-I*p)/(I*n + 1.) - r
@@ -426,14 +440,20 @@ def estimate_deadtime(datasets, mode='auto'):
             return 1000*y
         return _rate_estimate(p[0], p[1], p[2:2+num_atten], p[2+num_atten:])
 
-    p, s = masked_curve_fit(prediction, x, y, p0, sigma=dy, fixed=fixed)
     if mode == 'auto':
-        # Pick the better fit from pure np, pure p or both
+        # Fit pure np, pure p and the combined model, then pick the best.
         # Note: spurious P components can appear, even in truncated ranges
-        pn, sn = masked_curve_fit(prediction, x, y, p0, sigma=dy, fixed=[1])
-        p0[0], p0[1] = 0., T
-        pp, sp = masked_curve_fit(prediction, x, y, p0, sigma=dy, fixed=[0])
+        p0_P = p0.copy()
+        p0_P[0], p0_P[1] = 0., T
+        fits = [(p0, None), (p0, [1]), (p0_P, [0])]
+    else:
+        fits = [(p0, fixed)]
+    results = [masked_curve_fit(prediction, x, y, p_init, sigma=dy, fixed=fix)
+               for p_init, fix in fits]
 
+    p, s = results[0]
+    if mode == 'auto':
+        (pn, sn), (pp, sp) = results[1:]
         chisq_np = _chisq(pn, prediction, x, y, dy)
         chisq_p = _chisq(pp, prediction, x, y, dy)
         if chisq_np <= chisq_p:
@@ -804,6 +824,26 @@ def _show_inversion(wo, tau_P_f, tau_NP_f):
     pylab.grid(True)
 
 
+def test_estimate_incident():
+    for tau_NP, tau_P in ((1., 2.), (0., 3.), (5., 0.5)):
+        Ipeak, Rpeak = peak_rate(tau_NP, tau_P)
+        # Detector array of rates below the peak, including the peak itself.
+        I = np.linspace(0., Ipeak, 2*54*3).reshape(2, 54, 3)
+        R = expected_rate(I, tau_NP, tau_P)
+        Iest, dI = estimate_incident((R, np.sqrt(R)), (tau_NP, 0), (tau_P, 0))
+        assert Iest.shape == I.shape
+        assert np.allclose(Iest, I, rtol=1e-10, atol=1e-8)
+        # Rates beyond the peak are inverted using the saturated branch.
+        I = np.linspace(Ipeak, 20*Ipeak, 50)
+        R = expected_rate(I, tau_NP, tau_P)
+        Iest, dI = estimate_incident((R, np.sqrt(R)), (tau_NP, 0), (tau_P, 0),
+                                     above=True)
+        assert np.allclose(Iest, I, rtol=1e-10)
+        # Observed rates above the peak return the peak incident rate.
+        Iest, dI = estimate_incident(([2*Rpeak], [1.]), (tau_NP, 0), (tau_P, 0))
+        assert Iest[0] == Ipeak
+
+
 if __name__ == "__main__":
     #TAU_NP, TAU_P = 0.001, 30
     #TAU_NP, TAU_P = 0., 30
@@ -10,6 +10,9 @@ from typing import Tuple
 from .refldata import ReflData
 from .resolution import FWHM2sigma
 
+# Bump when a change to the loader changes the entries it returns.
+LOADER_VERSION = 1
+
 WAVELENGTH = 2.35
 WAVELENGTH_DISPERSION = 0.02
 
@@ -14,10 +14,11 @@ from .util import poisson_average, extend
 from .resolution import divergence_simple, dTdL2dQ, TiTdL2Qxz
 
 try:
-    #from typing import List, Dict, Union, Sequence
+    #from typing import List, Dict, Union, Sequence, Tuple
     #Columns = Dict[str, List[np.ndarray]]
     #StackedColumns = Dict[str, np.ndarray]
     #IndexSet = List[int]
+    #Groups = Tuple[np.ndarray, np.ndarray]
     pass
 except ImportError:
     pass
@@ -437,59 +438,125 @@ def _target_dT(data):
 
 
 def group_by_target_angles(columns):
-    # type: (StackedColumns) -> List[IndexSet]
+    # type: (StackedColumns) -> np.ndarray
     """
     Given columns of target values, group together exactly matching points.
-    """
-    Ti, Td, dT = columns['Ti'], columns['Td'], columns['dT']
-    Ld, dL = columns['Ld'], columns['dL']
-    points = {}
-    for index, point in enumerate(zip(Ti, Td, dT, Ld, dL)):
-        points.setdefault(point, []).append(index)
-    return list(points.values())
+
+    Returns the group number for each point, with groups numbered in order
+    of their first point.
+    """
+    keys = [np.asarray(columns[k]) for k in ('Ti', 'Td', 'dT', 'Ld', 'dL')]
+    n = len(keys[0])
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    # Sort on all keys at once then break wherever any key changes.  NaN
+    # never matches, so each NaN point is a group of its own.
+    order = np.lexsort(keys[::-1])
+    change = np.zeros(n - 1, dtype=bool)
+    for key in keys:
+        key = key[order]
+        change |= key[1:] != key[:-1]
+    labels = np.empty(n, dtype=int)
+    labels[order] = np.hstack(([0], np.cumsum(change)))
+    # Number the groups by first appearance.
+    first = np.full(labels.max() + 1, n)
+    np.minimum.at(first, labels, np.arange(n))
+    rank = np.empty_like(first)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[labels]
 
 
 def group_by_actual_angles(columns, Qtol, dQtol):
-    # type: (StackedColumns, float, float) -> List[IndexSet]
+    # type: (StackedColumns, float, float) -> np.ndarray
     """
     Given instrument geometry columns group points by angles and wavelength.
+
+    Returns the group number for each point.
     """
     Ti, Td, dT = columns['Ti'], columns['Td'], columns['dT']
     Ld, dL = columns['Ld'], columns['dL']
     #print "joining", Qtol, dQtol, Ti, Td, dT
-    groups = [list(range(len(Ti)))]
+    groups = _single_group(len(Ti))
     groups = _group_by_dim(groups, Td, Qtol*dT)
-    #print("Td groups", groups)
+    #print("Td groups", _index_sets(groups))
     groups = _group_by_dim(groups, Ti, Qtol*dT)
-    #print("Ti groups", groups)
+    #print("Ti groups", _index_sets(groups))
     groups = _group_by_dim(groups, Ld, Qtol*dL)
-    #print("Ld groups", groups)
+    #print("Ld groups", _index_sets(groups))
     groups = _group_by_dim(groups, dT, dQtol*dT)
-    #print("dT groups", groups)
+    #print("dT groups", _index_sets(groups))
     groups = _group_by_dim(groups, dL, dQtol*dL)
-    #print("dL groups", groups)
-    return groups
+    #print("dL groups", _index_sets(groups))
+    return _group_labels(groups)
 
 
 def group_by_Q(columns, Qtol, dQtol):
-    # type: (StackedColumns, float, float) -> List[IndexSet]
+    # type: (StackedColumns, float, float) -> np.ndarray
     """
     Given instrument geometry columns group points by Q and resolution.
+
+    Returns the group number for each point.
     """
     Qx, Qz, dQ = columns['Qx'], columns['Qz'], columns['dQ']
-    groups = [list(range(len(Qz)))]
+    groups = _single_group(len(Qz))
     groups = _group_by_dim(groups, dQ, dQtol*dQ)
     groups = _group_by_dim(groups, Qz, Qtol*dQ)
     groups = _group_by_dim(groups, Qx, Qtol*dQ)
-    return groups
+    return _group_labels(groups)
+
 
+# Groups are represented by a pair *(order, starts)*, where *order* lists
+# the point indices with the points of each group together and *starts*
+# flags the first point of each group within *order*.
 
-def _group_by_dim(index_sets, data, width):
-    # type: (List[IndexSet], np.ndarray, np.ndarray) -> List[IndexSet]
+def _single_group(n):
+    # type: (int) -> Groups
+    """
+    Return a grouping with all *n* points in one group.
+    """
+    return np.arange(n), np.arange(n) == 0
+
+
+def _index_sets(groups):
+    # type: (Groups) -> List[IndexSet]
+    """
+    Convert *(order, starts)* to a list of index sets.
     """
-    Given a list of index groups, split each subgroup according to the
-    dimension given in data, making sure points in the group lie within
-    width of each other.
+    order, starts = groups
+    return [part.tolist() for part in np.split(order, np.flatnonzero(starts)[1:])]
+
+
+def _group_labels(groups):
+    # type: (Groups) -> np.ndarray
+    """
+    Return the group number for each point, with groups numbered in order.
+    """
+    order, starts = groups
+    labels = np.empty(len(order), dtype=int)
+    labels[order] = np.cumsum(starts) - 1
+    return labels
+
+
+def _from_index_sets(index_sets):
+    # type: (List[IndexSet]) -> Groups
+    """
+    Convert a list of index sets to *(order, starts)*.
+    """
+    order = np.array([k for subgroup in index_sets for k in subgroup], dtype=int)
+    starts = np.zeros(len(order), dtype=bool)
+    starts[np.cumsum([0] + [len(subgroup) for subgroup in index_sets[:-1]])] = True
+    return order, starts
+
+
+def _group_by_dim(groups, data, width):
+    # type: (Groups, np.ndarray, np.ndarray) -> Groups
+    """
+    Given a grouping, split each group according to the dimension given
+    in data, making sure points in the group lie within width of each other.
+
+    The groups are the same as splitting each group in turn with
+    :func:`_split_subgroup`, but most of the splits are found for all
+    groups at once.
 
     Note that the resolution dimensions must be split before the angle
     and wavelength dimensions, otherwise there can be weirdness. When points
@@ -498,10 +565,73 @@ def _group_by_dim(index_sets, data, width):
     splitting up a series of points with loose resolution that would otherwise
     be joined.
     """
-    refinement = []
-    for subgroup in index_sets:
-        refinement.extend(_split_subgroup(subgroup, data, width))
-    return refinement
+    order, starts = groups
+    data, width = np.asarray(data), np.asarray(width)
+    if np.isnan(width[order]).any():
+        # A NaN width stops the group range from shrinking; leave these
+        # to the point by point split.
+        refinement = []
+        for subgroup in _index_sets(groups):
+            refinement.extend(_split_subgroup(subgroup, data, width))
+        return _from_index_sets(refinement)
+
+    # Sort by data within each group.
+    parent = np.cumsum(starts)
+    sort = np.lexsort((data[order], parent))
+    sorted_order, parent = order[sort], parent[sort]
+    value = data[sorted_order]
+    # The order of tied points can change the groups, so groups with ties
+    # are sorted with the same argsort as _split_subgroup.
+    tied = parent[1:] == parent[:-1]
+    tied &= (value[1:] == value[:-1]) | (np.isnan(value[1:]) & np.isnan(value[:-1]))
+    if tied.any():
+        bounds = np.hstack((np.flatnonzero(starts), len(order)))
+        for group in np.unique(parent[1:][tied]):
+            a, b = bounds[group-1], bounds[group]
+            indices = order[a:b]
+            sorted_order[a:b] = indices[np.argsort(data[indices])]
+        value = data[sorted_order]
+    order, width = sorted_order, width[sorted_order]
+    end = value + width
+    n = len(order)
+
+    # A point beyond the range of the previous point always starts a group.
+    new = np.ones(n, dtype=bool)
+    new[1:] = (parent[1:] != parent[:-1]) | (value[1:] > end[:-1])
+
+    # Between these breaks a run forms a single group if its last point is
+    # in range of all the others, and no point is too wide to reach the
+    # first.  Only the remaining runs are walked point by point.
+    first = np.flatnonzero(new)
+    last = np.hstack((first[1:], n)) - 1
+    if n:
+        run = np.cumsum(new) - 1
+        too_wide = (value - width > value[first][run]) & ~new
+        limit = end.copy()
+        limit[last] = np.inf
+        single = ((np.minimum.reduceat(limit, first) >= value[last])
+                  & ~np.logical_or.reduceat(too_wide, first))
+        for a, b in zip(first[~single], last[~single] + 1):
+            _split_run(value, width, end, a, b, new)
+    return order, new
+
+
+def _split_run(value, width, end, start, stop, new):
+    # type: (np.ndarray, np.ndarray, np.ndarray, int, int, np.ndarray) -> None
+    """
+    Flag the group starts in *new* for the sorted points *start:stop*,
+    using the same rules as :func:`_split_subgroup`.
+    """
+    # Python floats are much faster than numpy scalars for the point by
+    # point walk.
+    value, width, end = (v[start:stop].tolist() for v in (value, width, end))
+    start_point, end_point = value[0], end[0]
+    for k in range(1, stop - start):
+        if value[k] > end_point or value[k] - width[k] > start_point:
+            new[start + k] = True
+            start_point, end_point = value[k], end[k]
+        else:
+            end_point = min(end_point, end[k])
 
 
 def _split_subgroup(indices, data, width):
@@ -547,10 +677,11 @@ def _split_subgroup(indices, data, width):
     return groups
 
 
-def merge_points(index_sets, columns, normbase):
-    # type: (List[IndexSet], StackedColumns, str) -> StackedColumns
+def merge_points(labels, columns, normbase):
+    # type: (np.ndarray, StackedColumns, str) -> StackedColumns
     """
-    Join points together according to groups.
+    Join points together according to the group number for each point
+    in *labels*, with groups numbered from zero in output order.
 
     Points are weighted according to normbase, which could be 'monitor'
     or 'time'.
@@ -558,6 +689,16 @@ def merge_points(index_sets, columns, normbase):
     Note: we do not yet increase divergence when points with slightly
     different incident angles are mixed.
     """
+    # Put the points of each group together, keeping their order.
+    order = np.argsort(labels, kind='stable')
+    if len(order) == 0 or len(np.unique(labels)) == len(labels):
+        # Nothing to join
+        return dict((k, v[order]) for k, v in columns.items())
+    columns = dict((k, v[order]) for k, v in columns.items())
+    labels = labels[order]
+    first = np.flatnonzero(np.hstack(([True], labels[1:] != labels[:-1])))
+    single = np.diff(np.hstack((first, len(labels)))) == 1
+
     # Weight each point by monitor/time/counts
     if normbase == "none":
         # if weighting by counts then use the counts across the entire
@@ -565,39 +706,32 @@ def merge_points(index_sets, columns, normbase):
         # weighting but using the measured data, assuming the same conditions
         # give the same count rate.
         counts = columns['v']
-        ndim = counts[0].ndim
-        if ndim == 1:
-            weight = counts
-        else:
-            axis = tuple(range(1, ndim))
-            weight = [np.sum(v, axis=axis) for v in counts]
+        weight = np.sum(counts, axis=tuple(range(1, counts.ndim)))
     else:
         weight = columns[normbase]
-
-    # build a structure to hold the results
-    results = dict((k, []) for k in columns.keys())
-
-    #for k,v in columns.items(): print k, len(v), v
-    for group in index_sets:
-        if len(group) == 1:
-            index = group[0]
-            for key, value in columns.items():
-                results[key].append(value[index])
-        else:
-            v, dv = poisson_average(
-                columns['v'][group], columns['dv'][group], norm=normbase)
-            results['v'].append(v)
-            results['dv'].append(dv)
-            results['time'].append(np.sum(columns['time'][group]))
-            results['monitor'].append(np.sum(columns['monitor'][group]))
-            # TODO: dQ should increase when points are mixed (see MERGE below)
-            w = weight[group]
-            for key, value in columns.items():
-                if key not in ['v', 'dv', 'time', 'monitor']:
-                    results[key].append(np.average(value[group], weights=w, axis=0))
-
-    # Turn lists into arrays
-    results = dict((k, np.array(v)) for k, v in results.items())
+    total_weight = np.add.reduceat(weight, first)
+    if (total_weight[~single] == 0).any():
+        raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+    total_weight[single] = 1  # single points are copied below
+
+    def weighted_mean(value):
+        w = weight.reshape((-1,) + (1,)*(value.ndim - 1))
+        tw = total_weight.reshape((-1,) + (1,)*(value.ndim - 1))
+        return np.add.reduceat(value*w, first, axis=0)/tw
+
+    results = {}
+    results['v'], results['dv'] = poisson_average(
+        columns['v'], columns['dv'], norm=normbase, groups=first)
+    results['time'] = np.add.reduceat(columns['time'], first)
+    results['monitor'] = np.add.reduceat(columns['monitor'], first)
+    # TODO: dQ should increase when points are mixed (see MERGE below)
+    for key, value in columns.items():
+        if key not in results:
+            results[key] = weighted_mean(value)
+
+    # Points that are not joined are copied unchanged.
+    for key, value in columns.items():
+        results[key][single] = value[first[single]]
     return results
 
 # MERGE variance
@@ -627,6 +761,104 @@ def sort_columns(columns, keys):
     return dict((k, v[index]) for k, v in columns.items())
 
 
+def test_grouping():
+    # Differential test of the grouping against the point by point
+    # algorithm on data with clusters, ties, NaN values and NaN widths.
+    def split_by_dim(index_sets, data, width):
+        return [part for subgroup in index_sets
+                for part in _split_subgroup(subgroup, data, width)]
+    def index_sets(labels):
+        return [np.flatnonzero(labels == k).tolist()
+                for k in range(labels.max() + 1 if len(labels) else 1)]
+    def by_target(columns):
+        points = {}
+        for index, point in enumerate(zip(*(columns[k] for k in 'Ti Td dT Ld dL'.split()))):
+            points.setdefault(point, []).append(index)
+        return list(points.values())
+    rng = np.random.RandomState(7)
+    for trial in range(40):
+        n = rng.randint(0, 300)
+        # clustered points with jitter comparable to the width
+        centers = rng.uniform(0, 5, size=max(n//rng.randint(1, 20), 1))
+        columns = {}
+        for k, key in enumerate(('Ti', 'Td', 'dT', 'Ld', 'dL')):
+            v = centers[rng.randint(0, len(centers), size=n)] + (k+1)*0.01
+            v = v + rng.normal(scale=10**rng.uniform(-4, -1), size=n)
+            if trial % 3 == 0:
+                v = np.round(v, 1)  # ties
+            if trial % 5 == 0 and n:
+                v[rng.randint(0, n, size=3)] = np.nan
+            columns[key] = v
+        columns['dT'], columns['dL'] = abs(columns['dT']), abs(columns['dL'])
+        if trial % 7 == 0 and n:
+            columns['dT'][rng.randint(0, n)] = np.nan
+        columns = set_QdQ(columns)
+        Qtol, dQtol = rng.uniform(0, 2), rng.uniform(0, 0.1)
+        dims = [('Td', Qtol, 'dT'), ('Ti', Qtol, 'dT'), ('Ld', Qtol, 'dL'),
+                ('dT', dQtol, 'dT'), ('dL', dQtol, 'dL')]
+        expected = [list(range(n))]
+        for key, tol, scale in dims:
+            expected = split_by_dim(expected, columns[key], tol*columns[scale])
+        # Labels lose the order of the points within the groups
+        expected = [sorted(g) for g in expected]
+        assert index_sets(group_by_actual_angles(columns, Qtol, dQtol)) == expected
+        expected = [list(range(n))]
+        for key, tol in (('dQ', dQtol), ('Qz', Qtol), ('Qx', Qtol)):
+            expected = split_by_dim(expected, columns[key], tol*columns['dQ'])
+        expected = [sorted(g) for g in expected]
+        assert index_sets(group_by_Q(columns, Qtol, dQtol)) == expected
+        expected = by_target(columns) if n else [[]]
+        assert index_sets(group_by_target_angles(columns)) == expected
+
+
+def test_merge_points():
+    # Compare against merging one group at a time.
+    def merge_groups(index_sets, columns, normbase):
+        results = dict((k, []) for k in columns.keys())
+        for group in index_sets:
+            if len(group) == 1:
+                for key, value in columns.items():
+                    results[key].append(value[group[0]])
+                continue
+            v, dv = poisson_average(
+                columns['v'][group], columns['dv'][group], norm=normbase)
+            results['v'].append(v)
+            results['dv'].append(dv)
+            results['time'].append(np.sum(columns['time'][group]))
+            results['monitor'].append(np.sum(columns['monitor'][group]))
+            for key, value in columns.items():
+                if key not in ['v', 'dv', 'time', 'monitor']:
+                    results[key].append(np.average(
+                        value[group], weights=columns[normbase][group], axis=0))
+        return dict((k, np.array(v)) for k, v in results.items())
+    rng = np.random.RandomState(3)
+    n = 200
+    labels = rng.randint(0, 120, size=n)
+    labels = np.unique(labels, return_inverse=True)[1]
+    index_sets = [np.flatnonzero(labels == k).tolist() for k in range(labels.max()+1)]
+    for normbase in ('monitor', 'time'):
+        for shape in ((n,), (n, 5)):
+            counts = rng.poisson(3, size=shape).astype(float)
+            monitor = rng.uniform(50, 100, size=n)
+            norm = monitor if normbase == 'monitor' else monitor/10
+            scale = norm.reshape((-1,) + (1,)*(len(shape)-1))
+            columns = {
+                'v': counts/scale, 'dv': np.sqrt(counts + (counts == 0))/scale,
+                'time': monitor/10, 'monitor': monitor,
+                'Ti': rng.uniform(size=n), 'dT': rng.uniform(size=(n, 3)),
+            }
+            expected = merge_groups(index_sets, columns, normbase)
+            actual = merge_points(labels, columns, normbase)
+            for key in columns:
+                assert actual[key].shape == expected[key].shape
+                assert np.allclose(actual[key], expected[key], rtol=1e-12, atol=0), key
+    # Without joined points the columns are only reordered.
+    columns = {'v': np.arange(3), 'dv': np.ones(3), 'time': np.arange(3),
+               'monitor': np.ones(3)}
+    merged = merge_points(np.array([2, 0, 1]), columns, 'monitor')
+    assert (merged['v'] == [1, 2, 0]).all() and merged['time'].dtype == int
+
+
 def demo():
     import sys
     import matplotlib.pyplot as plt
@@ -1,7 +1,7 @@
 from os.path import basename
 from io import BytesIO
 
-from reductus.dataflow.fetch import url_get
+from reductus.dataflow.fetch import url_load_many, loader_id
 
 
 def load_from_string(filename, data, entries=None, loader=None):
@@ -13,36 +13,52 @@ def load_from_string(filename, data, entries=None, loader=None):
     return entries
 
 def url_load(fileinfo, check_timestamps=True, loader=None):
-    path, entries = fileinfo['path'], fileinfo.get('entries', None)
-    filename = basename(path)
-    content = url_get(fileinfo, mtime_check=check_timestamps)
-    if loader is not None:
-        return load_from_string(filename, content, entries=entries,
-                                loader=loader)
-    elif filename.endswith('.raw') or filename.endswith('.ras') or filename.endswith('.xrdml'):
-        from . import xrawref
-        return load_from_string(filename, content, entries=entries,
-                                loader=xrawref.load_entries)
+    return url_load_list([fileinfo], check_timestamps=check_timestamps,
+                         loader=loader)
+
+def default_loader(filename):
+    """
+    Return the entries loader for *filename* based on its extension.
+    """
+    if filename.endswith('.raw') or filename.endswith('.ras') or filename.endswith('.xrdml'):
+        from .xrawref import load_entries as loader
     elif filename.endswith('.nxs.cdr'):
-        from . import candor
-        return load_from_string(filename, content, entries=entries,
-                                loader=candor.load_entries)
+        from .candor import load_entries as loader
     else:
-        from . import nexusref
-        return load_from_string(filename, content, entries=entries,
-                                loader=nexusref.load_entries)
+        from .nexusref import load_entries as loader
+    return loader
+
+def file_load(fileinfo, fd, loader=None):
+    """
+    Load the entries from the open file *fd* described by *fileinfo*.
+
+    If *loader* is not given, it is chosen from the file extension.
+    """
+    path, entries = fileinfo['path'], fileinfo.get('entries', None)
+    filename = basename(path)
+    if loader is None:
+        loader = default_loader(filename)
+    return loader(filename, fd, entries=entries)
 
 def url_load_list(files=None, check_timestamps=True, loader=None):
+    """
+    Load the entries for each of the *files*.
+
+    If *loader* is not given, it is chosen from the file extension.
+    """
     if files is None:
         return []
-    result = [
-        entry
-        for fileinfo in files
-        for entry in url_load(
-            fileinfo, check_timestamps=check_timestamps, loader=loader,
-            )
-        ]
-    return result
+    # Key the parsed entries on the loader actually used so that they are
+    # shared between the generic and the instrument specific load steps.
+    if loader is not None:
+        name = loader_id(loader)
+    else:
+        name = lambda fileinfo: loader_id(
+            default_loader(basename(fileinfo['path'])))
+    results = url_load_many(
+        files, lambda fileinfo, fd: file_load(fileinfo, fd, loader=loader),
+        name, mtime_check=check_timestamps)
+    return [entry for entries in results for entry in entries]
 
 def setup_fetch():
     #from web_gui import default_config
@@ -6,6 +6,11 @@ from reductus.dataflow.lib import iso8601
 from .refldata import ReflData
 from .nexusref import data_as, str_data
 from .nexusref import NCNRNeXusRefl, load_nexus_entries
+from .nexusref import LOADER_VERSION as NEXUS_LOADER_VERSION
+
+# Bump when a change to the loader changes the entries it returns.  The
+# nexusref version is included since it does most of the loading.
+LOADER_VERSION = "%d.%d"%(NEXUS_LOADER_VERSION, 1)
 
 def load_entries(filename, file_obj=None, entries=None):
     #print("loading", filename, file_obj)
@@ -14,6 +14,9 @@ from reductus.dataflow.lib.strings import _s, _b
 from .refldata import ReflData
 from .resolution import FWHM2sigma
 
+# Bump when a change to the loader changes the entries it returns.
+LOADER_VERSION = 1
+
 TRAJECTORY_INTENTS = {
     'SPEC': 'specular',
     'SLIT': 'intensity',
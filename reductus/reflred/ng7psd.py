@@ -7,8 +7,13 @@ from .refldata import ReflData, PSDData
 from .nexusref import load_nexus_entries, nexus_common
 from .nexusref import data_as, str_data
 from .nexusref import TRAJECTORY_INTENTS
+from .nexusref import LOADER_VERSION as NEXUS_LOADER_VERSION
 from .resolution import FWHM2sigma
 
+# Bump when a change to the loader changes the entries it returns.  The
+# nexusref version is included since it does most of the loading.
+LOADER_VERSION = "%d.%d"%(NEXUS_LOADER_VERSION, 1)
+
 def load_metadata(filename, file_obj=None):
     """
     Load the summary info for all entries in a NeXus file.
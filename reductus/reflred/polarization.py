@@ -168,7 +168,7 @@ import numpy as np
 #def U(x,dx): return Uncertainty(x,dx**2)
 #def nominal_values(u): return u.x
 #def std_devs(u): return u.dx
-from uncertainties.unumpy import uarray as U, nominal_values, std_devs, ulinalg
+from uncertainties.unumpy import uarray as U, nominal_values, std_devs
 from uncertainties import ufloat
 
 from reductus.dataflow.lib.errutil import interp
@@ -223,11 +223,16 @@ def correct(data_in, spinflip, beam, Imin=0.0, Emin=0.0, FRbal=0.5, clip=False):
     use_pm = spinflip and '+-' in data
     use_mp = spinflip and '-+' in data
 
-    Hinv = _correction_matrix(beta, fp, rp, x, y, use_pm, use_mp)
-    _apply_correction(data, dtheta, Hinv, use_pm, use_mp)
+    Hinv, dHinv = _correction_matrix(beta, fp, rp, x, y, use_pm, use_mp)
+    _apply_correction(data, dtheta, Hinv, dHinv, use_pm, use_mp)
 
-def _apply_correction(data, dtheta, Hinv, use_pm, use_mp):
-    """Apply the efficiency correction in eff to the data."""
+def _apply_correction(data, dtheta, Hinv, dHinv, use_pm, use_mp):
+    """
+    Apply the efficiency correction to the data.
+
+    *Hinv* and *dHinv* are the correction matrices and their sensitivity
+    to the beam measurements from :func:`_correction_matrix`.
+    """
 
     # Identify active cross sections
     if use_pm and use_mp:
@@ -245,38 +250,124 @@ def _apply_correction(data, dtheta, Hinv, use_pm, use_mp):
     # in which case the interpolation does nothing.
     assert parts[0] == '++'
     x = data['++'].Qz
-    y = [U(data['++'].v, data['++'].dv)]
+    y, dy2 = [data['++'].v], [data['++'].dv**2]
     for p in parts[1:]:
-        px = data[p].Qz
-        py = U(data[p].v, data[p].dv)
-        y.append(interp(x, px, py, left=np.nan, right=np.nan))
-    Y = np.vstack(y)
-    Y = U(nominal_values(Y), std_devs(Y))
+        py, pdy2 = _interp(x, data[p].Qz, data[p].v, data[p].dv**2)
+        y.append(py)
+        dy2.append(pdy2)
+    # Points are along the first axis: Y[point, part]
+    Y, varY = np.asarray(y).T, np.asarray(dy2).T
 
     # Look up correction matrix for each point using the ++ cross section
     correction_index = util.nearest(data['++'].angular_resolution, dtheta)
+    H, dH = Hinv[correction_index], dHinv[correction_index]
 
-    # Apply the correction at each point
-    X, dX = np.zeros(Y.shape), np.zeros(Y.shape)
-    for point, polarization in enumerate(correction_index):
-        x = Hinv[polarization] @ Y[:, point].T
-        X[:, point], dX[:, point] = nominal_values(x).flat, std_devs(x).flat
+    # Apply the correction at all points at once.  The data points are
+    # independent of each other and of the beam measurements, so the
+    # first order variance is the sum of the variance from each.
+    X = np.einsum('pij,pj->pi', H, Y)
+    varX = (np.einsum('pij,pj->pi', H**2, varY)
+            + np.sum(np.einsum('pvij,pj->pvi', dH, Y)**2, axis=1))
 
     # Put the corrected intensities back into the datasets
     # interpolate back to the original Qz in that dataset:
     for k, xs in enumerate(parts):
         x = data[xs].Qz
         px = data['++'].Qz
-        py = U(X[k, :], dX[k, :])
-        y = interp(x, px, py, left=np.nan, right=np.nan)
-        data[xs].v, data[xs].dv = nominal_values(y), std_devs(y)
+        v, dv2 = _interp(x, px, X[:, k], varX[:, k])
+        data[xs].v, data[xs].dv = v, np.sqrt(dv2)
         data[xs].vlabel = 'counts per incident count'
         data[xs].vunits = None
 
+def _interp(x, xp, fp, varfp):
+    """
+    Interpolate *fp* with variance *varfp* at *x*, returning NaN with zero
+    variance outside the range of *xp*.
+
+    This is :func:`reductus.dataflow.lib.errutil.interp` for uncertain
+    values, but operating on the value and variance arrays directly.
+    """
+    x, xp = np.asarray(x), np.asarray(xp)
+    if len(xp) == 1:
+        idx = np.zeros_like(x, dtype='i')
+        f, varf = fp[idx], varfp[idx]
+    else:
+        if np.any(np.diff(xp) < 0.):
+            raise ValueError("interp needs a sorted list")
+        idx = np.searchsorted(xp[1:-1], x)
+        p = (xp[idx+1]-x)/(xp[idx+1]-xp[idx])
+        f = p*fp[idx] + (1-p)*fp[idx+1]
+        varf = p**2*varfp[idx] + (1-p)**2*varfp[idx+1]
+    outside = (x < xp[0]) | (x > xp[-1])
+    f[outside], varf[outside] = np.nan, 0.
+    return f, varf
 
 def _correction_matrix(beta, fp, rp, x, y, use_pm, use_mp):
     """
     Generate polarization correction matrices for each slit configuration *dT*.
+
+    Returns *Hinv[k]*, the inverse of the efficiency matrix for slit
+    configuration *k*, and *dHinv[k, v]*, its derivative with respect to
+    the *v*-th beam measurement contributing to the efficiencies for *k*,
+    scaled by the uncertainty in that measurement.  The first order
+    variance of *Hinv[k] @ Y* from the uncertainty in the efficiencies is
+    then the sum over *v* of the square of *dHinv[k, v] @ Y*.
+    """
+    values, jacobian = _linearize([beta, fp, rp, x, y])
+    H = _efficiency_matrix(*values, use_pm=use_pm, use_mp=use_mp)
+    # H is a polynomial in the efficiencies, so its derivatives can be
+    # computed exactly with a complex step along each direction.
+    step = 1e-20
+    dH = np.stack([
+        _efficiency_matrix(*(values + 1j*step*jacobian[:, :, v]),
+                           use_pm=use_pm, use_mp=use_mp).imag/step
+        for v in range(jacobian.shape[2])], axis=1)
+
+    # Derivative of the pseudo-inverse from Golub and Pereyra (1973),
+    # eqn 4.12, which is also used by uncertainties.unumpy.ulinalg.pinv.
+    Hinv = np.linalg.pinv(H)
+    HinvT, dHT = np.swapaxes(Hinv, -1, -2), np.swapaxes(dH, -1, -2)
+    eye = np.eye(H.shape[-1])
+    Hinv, HinvT = Hinv[:, None], HinvT[:, None]
+    dHinv = (-Hinv @ dH @ Hinv
+             + Hinv @ HinvT @ dHT @ (eye - H[:, None] @ Hinv)
+             + (eye - Hinv @ H[:, None]) @ dHT @ HinvT @ Hinv)
+    return Hinv[:, 0], dHinv
+
+def _linearize(params):
+    """
+    Return the nominal values of the uncertain vectors in *params* and
+    their derivatives with respect to the independent variables for each
+    element, scaled by the uncertainty in each variable.
+
+    The values are returned as an array *[param, k]* and the derivatives
+    as *[param, k, variable]*, with the variables numbered separately for
+    each element *k*.
+    """
+    values = np.array([nominal_values(p) for p in params], dtype='d')
+    components = [[_error_components(pk) for pk in p] for p in params]
+    # Number the variables for each element in order of appearance.
+    # Variables hash by identity, so they can be used as dictionary keys.
+    variables = [{} for _ in range(values.shape[1])]
+    for p_components in components:
+        for k, terms in enumerate(p_components):
+            for v in terms:
+                variables[k].setdefault(v, len(variables[k]))
+    jacobian = np.zeros(values.shape + (max(len(v) for v in variables),))
+    for i, p_components in enumerate(components):
+        for k, terms in enumerate(p_components):
+            for v, term in terms.items():
+                jacobian[i, k, variables[k][v]] = term
+    return values, jacobian
+
+def _error_components(value):
+    # Signed contribution of each variable; error_components() drops the sign.
+    derivatives = getattr(value, 'derivatives', {})
+    return dict((v, d*v.std_dev) for v, d in derivatives.items())
+
+def _efficiency_matrix(beta, fp, rp, x, y, use_pm, use_mp):
+    """
+    Return the efficiency matrix *H[k]* for each slit configuration.
     """
     Fp, Fm = 1+fp, 1-fp
     Rp, Rm = 1+rp, 1-rp
@@ -309,8 +400,7 @@ def _correction_matrix(beta, fp, rp, x, y, use_pm, use_mp):
             [Fm  *Rm  , Fp  *Rp    ],
             ])
 
-    #print("H:", UM(H[:,:,0]), UM(H[:,:,0]).I)
-    return [ulinalg.pinv(H[:, :, k]*Bk) for k, Bk in enumerate(beta)]
+    return np.moveaxis(H*beta, -1, 0)
 
 def plot_efficiency(beam, Imin=0.0, Emin=0.0, FRbal=0.5, clip=False):
     eff = polarization_efficiency(beam, Imin=Imin, Emin=Emin, FRbal=FRbal, clip=clip)
@@ -521,3 +611,57 @@ if 'Uncertainty' in globals():
     _clip_data = clip_reflred_err1d
 else:
     _clip_data = clip_pypi_uncertainties
+
+
+def _reference_correction(data, dtheta, beta, fp, rp, x, y, use_pm, use_mp):
+    # Correction with the uncertainties package, applied point by point.
+    from uncertainties.unumpy import ulinalg
+    parts = (ALL_XS if use_pm and use_mp else PM_XS if use_pm
+             else MP_XS if use_mp else NSF_XS)
+    H = _efficiency_matrix(beta, fp, rp, x, y, use_pm, use_mp)
+    Hinv = [ulinalg.pinv(Hk) for Hk in H]
+    Y = [U(data['++'].v, data['++'].dv)]
+    Y.extend(interp(data['++'].Qz, data[p].Qz, U(data[p].v, data[p].dv),
+                    left=np.nan, right=np.nan) for p in parts[1:])
+    Y = np.vstack(Y)
+    Y = U(nominal_values(Y), std_devs(Y))
+    index = util.nearest(data['++'].angular_resolution, dtheta)
+    X = np.array([Hinv[k] @ Y[:, point] for point, k in enumerate(index)]).T
+    X = U(nominal_values(X), std_devs(X))
+    return [interp(data[xs].Qz, data['++'].Qz, X[k], left=np.nan, right=np.nan)
+            for k, xs in enumerate(parts)]
+
+def test_correct():
+    from types import SimpleNamespace
+    rng = np.random.RandomState(3)
+    dtheta = np.array([0.01, 0.02, 0.03, 0.05])
+    # Beam with a bad flipper measurement in the last slit setting.
+    intensity = {'++': 1000., '+-': 60., '-+': 50., '--': 980.}
+    beam = {}
+    for xs, v in intensity.items():
+        v = v*(1 + 0.02*rng.randn(len(dtheta)))
+        beam[xs] = SimpleNamespace(angular_resolution=dtheta, v=v, dv=np.sqrt(v))
+    beam['+-'].v[-1] = 400.
+    for clip in (False, True):
+        beta, fp, rp, x, y, _ = _calc_efficiency(
+            beam=beam, dtheta=dtheta, Imin=0., Emin=0., FRbal=0.5, clip=clip)
+        for use_pm, use_mp in ((True, True), (True, False), (False, True), (False, False)):
+            data = {}
+            for k, xs in enumerate(ALL_XS):
+                n = 40 + k
+                Qz = np.linspace(0.01*k, 0.2, n)
+                v = 100*np.exp(-20*Qz)*(1 + 0.1*rng.rand(n))
+                data[xs] = SimpleNamespace(
+                    polarization=xs, Qz=Qz, v=v, dv=np.sqrt(v),
+                    angular_resolution=dtheta[rng.randint(len(dtheta), size=n)])
+            expected = _reference_correction(
+                data, dtheta, beta, fp, rp, x, y, use_pm, use_mp)
+            Hinv, dHinv = _correction_matrix(beta, fp, rp, x, y, use_pm, use_mp)
+            _apply_correction(data, dtheta, Hinv, dHinv, use_pm, use_mp)
+            parts = [xs for xs in ALL_XS if hasattr(data[xs], 'vlabel')]
+            assert len(parts) == len(expected)
+            for xs, target in zip(parts, expected):
+                assert np.allclose(data[xs].v, nominal_values(target), equal_nan=True)
+                assert np.allclose(data[xs].dv, std_devs(target), equal_nan=True)
+            # Points beyond the interpolated cross sections are undefined.
+            assert np.isnan(data['++'].v[0]) == (len(parts) > 1)
@@ -88,6 +88,7 @@ from numpy import inf, arctan2, sqrt, sin, cos, pi, radians
 
 from reductus.dataflow.lib.exporters import exports_text, exports_json, exports_HDF5, NumpyEncoder
 from reductus.dataflow.lib.strings import _s, _b
+from reductus.dataflow.data import array_item
 from .resolution import calc_Qx, calc_Qz, dTdL2dQ
 
 IS_PY3 = sys.version_info[0] >= 3
@@ -1581,7 +1582,7 @@ class PSDData(ReflData):
             "ymin": ymin, "ymax": ymax, "ydim": ny,
             "zmin": zmin, "zmax": zmax,
         }
-        z = data.T.ravel('C').tolist()
+        z = array_item(data.T.ravel('C'))
         plottable = {
             #'type': '2d_multi',
             #'dims': {'zmin': zmin, 'zmax': zmax},
@@ -1661,7 +1662,7 @@ def _toDictItem(obj, maxsize=None):
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist() if obj.size < maxsize else [] #[float(obj.min()), float(obj.max())]
+        obj = array_item(obj) if obj.size < maxsize else [] #[float(obj.min()), float(obj.max())]
     elif isinstance(obj, datetime.datetime):
         obj = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second]
     elif isinstance(obj, (list, tuple)):
@@ -3,7 +3,7 @@ import os
 import numpy as np
 from copy import copy
 
-from reductus.dataflow.automod import cache, nocache, module
+from reductus.dataflow.automod import cache, nocache, module, pure
 
 # TODO: maybe bring back formula to show the math of each step
 # TODO: what about polarized data?
@@ -166,6 +166,7 @@ def fit_dead_time(data, source='detector', mode='auto'):
 
 
 
+@pure
 @module
 def monitor_dead_time(data, dead_time, nonparalyzing=0.0, paralyzing=0.0):
     """
@@ -216,6 +217,7 @@ def monitor_dead_time(data, dead_time, nonparalyzing=0.0, paralyzing=0.0):
     return data
 
 
+@pure
 @module
 def detector_dead_time(data, dead_time, nonparalyzing=0.0, paralyzing=0.0):
     """
@@ -317,6 +319,7 @@ def detector_saturation(data):
     return data
 
 
+@pure
 @module
 def theta_offset(data, offset=0.0):
     """
@@ -346,6 +349,7 @@ def theta_offset(data, offset=0.0):
     return data
 
 
+@pure
 @module
 def back_reflection(data):
     """
@@ -372,6 +376,7 @@ def back_reflection(data):
     return data
 
 
+@pure
 @module
 def absolute_angle(data):
     """
@@ -397,6 +402,7 @@ def absolute_angle(data):
     apply_absolute_angle(data)
     return data
 
+@pure
 @module
 def sample_broadening(data, width=0):
     r"""
@@ -425,6 +431,7 @@ def sample_broadening(data, width=0):
         apply_sample_broadening(data, width)
     return data
 
+@pure
 @module
 def divergence_fb(data, sample_width=None):
     r"""
@@ -450,6 +457,7 @@ def divergence_fb(data, sample_width=None):
         apply_divergence_front_back(data, sample_width)
     return data
 
+@pure
 @module
 def divergence(data, sample_width=None, sample_broadening=0):
     r"""
@@ -694,6 +702,7 @@ def filter(data, key="", comparator="eq", value=None):
 
     return [d for d in data if hasattr(d, key) and compare_op(getattr(d, key), value)]
 
+@pure
 @module
 def normalize(data, base='auto'):
     """
@@ -191,13 +191,16 @@ def test_nearest():
             == [fp[i] for i in [0, 0, 0, 2, 2, 1, 1, 1]]).all()
 
 
-def poisson_average(y, dy, norm='monitor'):
+def poisson_average(y, dy, norm='monitor', groups=None):
     r"""
     Return the Poisson average of a rate vector *y +/- dy*.
 
     If y, dy is multidimensional then average the first dimension, returning
     an item of one fewer dimentsions.
 
+    If *groups* is given, it is the index of the first point of each run of
+    consecutive points to average, and the result has one item per group.
+
     Use *norm='monitor'* When counting against monitor (the default) or
     *norm='time'* when counting against time.  Use *norm='none'* if *y, dy*
     is unnormalized, and the poisson sum should be returned. Use *norm='gauss'*
@@ -320,6 +323,10 @@ def poisson_average(y, dy, norm='monitor'):
     """
     if norm not in ("monitor", "time", "gauss", "none"):
         raise ValueError("expected norm to be time, monitor or none")
+    if groups is None:
+        total = lambda v: np.sum(v, axis=0)
+    else:
+        total = lambda v: np.add.reduceat(v, groups, axis=0)
 
     # Check whether we are combining rates or counts.  If it is counts,
     # then simply sum them, and sum the uncertainty in quadrature. This
@@ -329,14 +336,14 @@ def poisson_average(y, dy, norm='monitor'):
     # the individual counts giving zero, so long as variance on zero counts
     # is set to zero rather than one.
     if norm == "none":
-        bar_y = np.sum(y, axis=0)
-        bar_dy = np.sqrt(np.sum(dy**2, axis=0))
+        bar_y = total(y)
+        bar_dy = np.sqrt(total(dy**2))
         return bar_y, bar_dy
 
     dy = dy + (dy == 0)  # Protect against zero counts in division
     if norm == "gauss":
-        Swx = np.sum(y/dy**2, axis=0)
-        Sw = np.sum(dy**-2, axis=0)
+        Swx = total(y/dy**2)
+        Sw = total(dy**-2)
         bar_y = Swx / Sw
         bar_dy = 1/np.sqrt(Sw)
         return bar_y, bar_dy
@@ -347,8 +354,8 @@ def poisson_average(y, dy, norm='monitor'):
     counts = y*monitors
 
     # Compute average rate
-    combined_monitors = np.sum(monitors, axis=0)
-    combined_counts = np.sum(counts, axis=0)
+    combined_monitors = total(monitors)
+    combined_counts = total(counts)
     bar_y = combined_counts/combined_monitors
     if norm == "time":
         bar_dy = np.sqrt(bar_y/combined_monitors)
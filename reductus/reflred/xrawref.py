@@ -23,6 +23,9 @@ from . import xrdml
 from . import refldata
 from .resolution import FWHM2sigma
 
+# Bump when a change to the loader, or to the bruker, rigaku or xrdml
+# readers, changes the entries it returns.
+LOADER_VERSION = 1
 
 def load_entries(filename, file_obj=None, entries=None):
     """
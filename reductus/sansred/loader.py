@@ -8,10 +8,16 @@ from reductus.dataflow.lib import unit
 from reductus.dataflow.lib.h5_open import h5_open_zip
 
 from reductus.vsansred.loader import load_detector, load_metadata
+from reductus.vsansred.loader import LOADER_VERSION as VSANS_LOADER_VERSION
 from reductus.vsansred.steps import _s, _b
 
 from .sansdata import SansData, RawSANSData
 
+# Bump when a change to the loader changes the entries it returns.  The
+# vsansred loader version is included since it reads the detector and
+# metadata.
+LOADER_VERSION = "%d.%d"%(VSANS_LOADER_VERSION, 1)
+
 metadata_lookup = {
     "acamplitude.voltage": "DAS_logs/acAmplitude/voltage",
     "adam.voltage": "DAS_logs/adam4021/voltage",
@@ -16,6 +16,7 @@ import numpy as np
 
 from reductus.dataflow.lib.uncertainty import Uncertainty
 from reductus.dataflow.lib.exporters import exports_HDF5, exports_text
+from reductus.dataflow.data import array_item
 from reductus.vsansred.vsansdata import RawVSANSData, _toDictItem
 
 IS_PY3 = sys.version_info[0] >= 3
@@ -164,7 +165,7 @@ class SansData:
         plottable_data = {
             'entry': self.metadata['entry'],
             'type': '2d',
-            'z':  [data.flatten().tolist()],
+            'z':  [array_item(data.ravel())],
             'title': _s(self.metadata['run.filename'])+': ' + _s(self.metadata['sample.labl']),
             #'metadata': self.metadata,
             'options': {
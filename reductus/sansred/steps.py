@@ -16,6 +16,7 @@ from collections import OrderedDict
 
 import numpy as np
 
+from reductus.dataflow.automod import pure
 from reductus.dataflow.calc import process_template
 from reductus.dataflow.core import Template
 from reductus.dataflow.lib.uncertainty import Uncertainty
@@ -89,14 +90,15 @@ def LoadDIV(filelist=None, variance=0.0001):
 
     2018-04-21 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_get_many
     from .sans_vaxformat import readNCNRSensitivity
 
     output = []
-    for fileinfo in filelist:
+    contents = url_get_many(filelist, mtime_check=False)
+    for fileinfo, content in zip(filelist, contents):
         path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
         name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=False))
+        fid = BytesIO(content)
         sens_raw = readNCNRSensitivity(fid)
         detectors = [{"detector": {"data": {"value": Uncertainty(sens_raw, sens_raw * variance)}}}]
         metadata = OrderedDict([
@@ -132,20 +134,23 @@ def LoadRawSANS(filelist=None, check_timestamps=True):
 
     2018-04-23 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .loader import readSANSNexuz
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        if name.upper().endswith(".DIV"):
+    is_div = [basename(fileinfo['path']).upper().endswith(".DIV")
+              for fileinfo in filelist]
+    nexus = [fileinfo for fileinfo, div in zip(filelist, is_div) if not div]
+    loaded = iter(url_load_many(
+        nexus, lambda fileinfo, fid: readSANSNexuz(basename(fileinfo['path']), fid),
+        loader_id(readSANSNexuz), mtime_check=check_timestamps))
+    for fileinfo, div in zip(filelist, is_div):
+        if div:
             sens = LoadDIV([fileinfo])
             entries = [sens]
         else:
-            entries = readSANSNexuz(name, fid)
+            entries = next(loaded)
         
         data.extend(entries)
 
@@ -679,6 +684,7 @@ def FX(xx,sx3,xcenter,sx):
     return sx3*np.tan((xx-xcenter)*sx/sx3)
 
 @cache
+@pure
 @module
 def PixelsToQ(data, beam_center=[None,None], correct_solid_angle=True):
     """
@@ -723,7 +729,8 @@ def PixelsToQ(data, beam_center=[None,None], correct_solid_angle=True):
     X = sx3*np.tan((x-xcenter)*sx/sx3) - dxbm # in mm in nexus, but converted by loader
     Y = sy3*np.tan((y-ycenter)*sy/sy3) - dybm
     r, theta, q, phi, qx, qy, qz = _calculate_Q(X, Y, Z, q0)
-    
+
+    res = data.copy()
     if correct_solid_angle:
         """
         rad = sqrt(dtdis2 + xd^2 + yd^2)
@@ -736,7 +743,7 @@ def PixelsToQ(data, beam_center=[None,None], correct_solid_angle=True):
         xx = (np.cos((x-xcenter)*sx/sx3))**2
         yy = (np.cos((y-ycenter)*sy/sy3))**2
         #data.data.x = data.data.x / (np.cos(theta)**3)
-        data.data.x = data.data.x * xx * yy / (np.cos(2*theta)**3)
+        res.data.x = res.data.x * xx * yy / (np.cos(2*theta)**3)
 
     # bin corners:
     X_low = sx3*np.tan((x - 0.5 - xcenter)*sx/sx3) - dxbm # in mm in nexus, but converted by loader
@@ -747,7 +754,6 @@ def PixelsToQ(data, beam_center=[None,None], correct_solid_angle=True):
     r_low, theta_low, q_low, phi_low, qx_low, qy_low, qz_low = _calculate_Q(X_low, Y_low, Z, q0)
     r_high, theta_high, q_high, phi_high, qx_high, qy_high, qz_high = _calculate_Q(X_high, Y_high, Z, q0)
 
-    res = data.copy()
     #Adding res.q
     res.q = q
     res.qx = qx
@@ -1173,6 +1179,7 @@ def shift_1d(data, shift=1.0, dshift=0.0):
     return data
 
 
+@pure
 @module
 def correct_detector_efficiency(sansdata):
     """
@@ -1229,6 +1236,7 @@ def correct_detector_efficiency(sansdata):
 
     return res
 
+@pure
 @module
 def correct_dead_time(sansdata, deadtime=1.0e-6):
     """
@@ -1261,6 +1269,7 @@ def correct_dead_time(sansdata, deadtime=1.0e-6):
     result.data *= dscale
     return result
 
+@pure
 @module
 def monitor_normalize(sansdata, mon0=1e8):
     """"
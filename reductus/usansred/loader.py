@@ -15,6 +15,9 @@ from reductus.dataflow.lib.strings import _s, _b
 
 from .usansdata import RawData, USansData
 
+# Bump when a change to the loader changes the entries it returns.
+LOADER_VERSION = 1
+
 metadata_lookup = OrderedDict([
     ("run.filename", "DAS_logs/trajectoryData/fileName"),
     ("analysis.intent", "DAS_logs/trajectoryData/intent"),
@@ -86,18 +86,20 @@ def LoadRawUSANS(filelist=None, check_timestamps=True, det_deadtime=7e-6, trans_
 
     2020-01-29 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .loader import readUSANSNexus
     from .usansdata import USansData
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readUSANSNexus(name, fid, det_deadtime=det_deadtime, trans_deadtime=trans_deadtime)
-        
+    name = loader_id(readUSANSNexus, "(det_deadtime=%r, trans_deadtime=%r)"
+                     % (det_deadtime, trans_deadtime))
+    loaded = url_load_many(
+        filelist, lambda fileinfo, fid: readUSANSNexus(
+            basename(fileinfo['path']), fid,
+            det_deadtime=det_deadtime, trans_deadtime=trans_deadtime),
+        name, mtime_check=check_timestamps)
+    for entries in loaded:
         data.extend(entries)
 
     return data
@@ -11,6 +11,7 @@ IS_PY3 = sys.version_info[0] >= 3
 from reductus.dataflow.lib.uncertainty import Uncertainty
 from reductus.dataflow.lib.strings import _s, _b
 from reductus.dataflow.lib.exporters import exports_text, exports_HDF5
+from reductus.dataflow.data import array_item
 
 class RawData(object):
     def __init__(self, metadata=None, countTime=None, detCts=None, transCts=None, monCts=None, Q=None):
@@ -273,7 +274,7 @@ def _toDictItem(obj, convert_bytes=False):
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist()
+        obj = array_item(obj)
     elif isinstance(obj, datetime.datetime):
         obj = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second]
     elif isinstance(obj, list):
@@ -13,10 +13,14 @@ import numpy as np
 
 from reductus.dataflow.lib import hzf_readonly_stripped as hzf
 from reductus.dataflow.lib import unit
-from reductus.dataflow.lib.h5_open import h5_open_zip
+from reductus.dataflow.lib.h5_open import h5_open_zip, LazyDataset
+from reductus.dataflow.data import array_item
 
 from .vsansdata import VSansData, RawVSANSData, _s, _b
 
+# Bump when a change to the loader changes the entries it returns.
+LOADER_VERSION = 1
+
 metadata_lookup = OrderedDict([
     #"det.dis", "DAS_logs/detectorPosition/softPosition",
     
@@ -149,14 +153,20 @@ def data_as(field, units):
         value = converter(field[()], units)
         return value
 
-def load_detector(dobj, load_data=True):
+def load_detector(dobj, load_data=True, fileinfo=None):
     # load detector information from a NeXuS group
+    # If load_data is False the detector counts are skipped, or if fileinfo
+    # is given they are replaced by a LazyDataset which reads them on use.
     detector = OrderedDict()
     for k in dobj:
-        if not load_data and k == 'data':
+        if not load_data and k == 'data' and fileinfo is None:
             continue
         subobj = dobj[k]
-        detector[k] = OrderedDict(value=subobj[()], attrs=OrderedDict(_toDictItem(subobj.attrs)))
+        if not load_data and k == 'data':
+            value = LazyDataset(fileinfo, subobj.name, subobj.shape, subobj.dtype)
+        else:
+            value = subobj[()]
+        detector[k] = OrderedDict(value=value, attrs=OrderedDict(_toDictItem(subobj.attrs)))
         if hasattr(subobj, 'shape'):
             detector[k]['attrs']['shape'] = subobj.shape
         if hasattr(subobj, 'dtype'):
@@ -185,9 +195,13 @@ def load_metadata(entry, multiplicity=1, i=1, metadata_lookup=metadata_lookup, u
             metadata[mkey] = field
     return metadata
 
-def readVSANSNexuz(input_file, file_obj=None, metadata_lookup=metadata_lookup, load_data=True):
+def readVSANSNexuz(input_file, file_obj=None, metadata_lookup=metadata_lookup, load_data=True, fileinfo=None):
     """
     Load all entries from the NeXus file into sans data sets.
+
+    If *load_data* is False then only the metadata and the small detector
+    fields are read.  The detector counts are omitted, or, if the *fileinfo*
+    for the file is given, loaded from the file when first used.
     """
     datasets = []
     file = h5_open_zip(input_file, file_obj)
@@ -207,7 +221,7 @@ def readVSANSNexuz(input_file, file_obj=None, metadata_lookup=metadata_lookup, l
             metadata = load_metadata(entry, multiplicity, i, metadata_lookup=metadata_lookup, unit_specifiers=unit_specifiers)
             #print(metadata)
             detector_keys = [n for n in entry['instrument'] if n.startswith('detector_')]
-            detectors = dict([(k, load_detector(entry['instrument'][k], load_data=load_data)) for k in detector_keys])
+            detectors = dict([(k, load_detector(entry['instrument'][k], load_data=load_data, fileinfo=fileinfo)) for k in detector_keys])
             metadata['entry'] = entryname
             if metadata.get('sample.labl', None) is not None and metadata.get('run.configuration', None) is not None:
                 metadata['sample.description'] = _s(metadata["sample.labl"]).replace(_s(metadata["run.configuration"]), "")
@@ -224,7 +238,7 @@ def _toDictItem(obj, convert_bytes=False):
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist()
+        obj = array_item(obj)
     elif isinstance(obj, datetime.datetime):
         obj = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second]
     elif isinstance(obj, list):
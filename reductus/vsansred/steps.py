@@ -4,6 +4,7 @@ from io import BytesIO
 import sys
 import numpy as np
 
+from reductus.dataflow.automod import pure
 from reductus.dataflow.lib.uncertainty import Uncertainty
 
 # Action names
@@ -75,10 +76,10 @@ def hidden(action):
     action.visible = False
     return action
 
-@cache
+@nocache
 @module
 @hidden
-def _LoadVSANS(filelist=None, check_timestamps=True):
+def _LoadVSANS(filelist=None, check_timestamps=True, load_data=True):
     """
     loads a data file into a VSansData obj and returns that.
 
@@ -88,6 +89,9 @@ def _LoadVSANS(filelist=None, check_timestamps=True):
     
     check_timestamps (bool): verify that timestamps on file match request
 
+    load_data (bool): include the data in the load; otherwise the detector
+    data is read from the file when it is first used
+
     **Returns**
 
     output (raw[]): all the entries loaded.
@@ -95,16 +99,22 @@ def _LoadVSANS(filelist=None, check_timestamps=True):
     | 2018-04-29 Brian Maranville
     | 2020-10-01 Brian Maranville adding fileinfo to metadata
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .loader import readVSANSNexuz
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readVSANSNexuz(name, fid)
+    # Not cached as a node: the parsed entries are already cached for each
+    # file by url_load_many.
+    if load_data:
+        load = lambda fileinfo, fid: readVSANSNexuz(basename(fileinfo['path']), fid)
+        name = loader_id(readVSANSNexuz)
+    else:
+        load = lambda fileinfo, fid: readVSANSNexuz(
+            basename(fileinfo['path']), fid, load_data=False, fileinfo=fileinfo)
+        name = loader_id(readVSANSNexuz, "(load_data=False)")
+    loaded = url_load_many(filelist, load, name, mtime_check=check_timestamps)
+    for fileinfo, entries in zip(filelist, loaded):
         for entry in entries:
             if fileinfo['path'].endswith("DIV.h5"):
                 print('div file...')
@@ -197,7 +207,7 @@ def addSimple(data):
         #output.metadata['run.detcnt'] += d.metadata['run.detcnt']
     return output
 
-@cache
+@nocache
 @module
 def LoadVSANSHe3(filelist=None, check_timestamps=True):
     """
@@ -215,16 +225,19 @@ def LoadVSANSHe3(filelist=None, check_timestamps=True):
 
     2018-04-29 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .loader import readVSANSNexuz, he3_metadata_lookup
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readVSANSNexuz(name, fid, metadata_lookup=he3_metadata_lookup)
+    # Not cached as a node: the parsed entries are already cached for each
+    # file by url_load_many.
+    loaded = url_load_many(
+        filelist, lambda fileinfo, fid: readVSANSNexuz(
+            basename(fileinfo['path']), fid, metadata_lookup=he3_metadata_lookup),
+        loader_id(readVSANSNexuz, "(metadata_lookup=he3_metadata_lookup)"),
+        mtime_check=check_timestamps)
+    for entries in loaded:
         data.extend(entries)
 
     return data
@@ -294,7 +307,7 @@ def LoadVSANSDIV(filelist=None, check_timestamps=True):
 
     2019-10-30 Brian Maranville
     """
-    from reductus.dataflow.fetch import url_get
+    from reductus.dataflow.fetch import url_load_many, loader_id
     from .loader import readVSANSNexuz
     
 
@@ -302,11 +315,11 @@ def LoadVSANSDIV(filelist=None, check_timestamps=True):
         filelist = []
 
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readVSANSNexuz(name, fid) # metadata_lookup=div_metadata_lookup)
+    # shares the parsed entries with _LoadVSANS
+    loaded = url_load_many(
+        filelist, lambda fileinfo, fid: readVSANSNexuz(basename(fileinfo['path']), fid), # metadata_lookup=div_metadata_lookup)
+        loader_id(readVSANSNexuz), mtime_check=check_timestamps)
+    for entries in loaded:
         for entry in entries:
             div_entries = _loadDivData(entry)
             data.extend(div_entries)
@@ -609,6 +622,7 @@ def sort_sample(raw_data):
     return blocked_beam
 
 @nocache
+@pure
 @module
 def calculate_XY(raw_data, solid_angle_correction=True):
     """
@@ -756,6 +770,7 @@ def calculate_XY(raw_data, solid_angle_correction=True):
     return output
 
 @cache
+@pure
 @module
 def oversample_XY(realspace_data, oversampling=3, exclude_back_detector=True):
     """
@@ -814,6 +829,7 @@ def oversample_XY(realspace_data, oversampling=3, exclude_back_detector=True):
 
     return rd
 
+@pure
 @module
 def monitor_normalize(qdata, mon0=1e8):
     """"
@@ -874,6 +890,7 @@ def correct_detector_sensitivity(data, sensitivity, exclude_back_detector=True):
 
 
 @nocache
+@pure
 @module   
 def calculate_Q(realspace_data):
     """
@@ -16,6 +16,7 @@ import numpy as np
 
 from reductus.dataflow.lib.uncertainty import Uncertainty
 from reductus.dataflow.lib.exporters import exports_HDF5, exports_text
+from reductus.dataflow.data import array_item
 
 IS_PY3 = sys.version_info[0] >= 3
 
@@ -75,7 +76,7 @@ def _toDictItem(obj, convert_bytes=False):
     elif isinstance(obj, np.floating):
         obj = float(obj)
     elif isinstance(obj, np.ndarray):
-        obj = obj.tolist()
+        obj = array_item(obj)
     elif isinstance(obj, Uncertainty):
         obj = _toDictItem({'x': obj.x, 'variance': obj.variance})
     elif isinstance(obj, datetime.datetime):
@@ -13,6 +13,8 @@ from reductus.dataflow.calc import process_template
 from reductus.rev import revision_info
 from reductus.dataflow import configure
 from reductus.dataflow import fetch
+from reductus.dataflow import trace
+from reductus.web_gui import jobs
 
 api_methods = []
 
@@ -110,7 +112,7 @@ def find_calculated(template_def, config):
     return retval
 
 @expose
-def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full', export_type="column", concatenate=True):
+def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full', export_type="column", concatenate=True, lod=None):
     """ json-rpc wrapper for calc_single
     template_def =
     {"name": "template_name",
@@ -140,12 +142,25 @@ def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full'
 
     terminal_id is the id of the terminal for that module, that you want to get the value from
     (output terminals only).
+
+    lod, for return_type 'plottable', reduces the resolution of 2D plots:
+
+    lod =
+    {"pixels": 262144, "window": [xmin, xmax, ymin, ymax], "method": "mean"}
+
+    where all fields are optional, and method is one of mean, max or min
+    (see :mod:`reductus.dataflow.lod`).
     """
     template = Template(**template_def)
     #print "template_def:", template_def, "config:", config, "target:",nodenum,terminal_id
     #print "modules","\n".join(m for m in df._module_registry.keys())
     try:
-        retval = process_template(template, config, target=(nodenum, terminal_id))
+        if return_type == 'plottable' and lod is not None:
+            from reductus.dataflow.lod import template_plottable
+            return template_plottable(template, config, (nodenum, terminal_id),
+                                      **lod)
+        retval = process_template(template, config, target=(nodenum, terminal_id),
+                                  lazy=True)
     except Exception:
         print("==== template ===="); pprint(template_def)
         print("==== config ===="); pprint(config)
@@ -218,10 +233,72 @@ def list_instruments():
 def get_startup_banner():
     return configure.STARTUP_BANNER
 
+def get_stats(reset=False):
+    """
+    Return the node timing and cache statistics for this server process.
+
+    Only exposed if *expose_stats* is set in the server configuration.
+    If *reset* is true, then start collecting new statistics.
+    """
+    report = trace.get_report()
+    report["cache"] = get_cache().cache_stats()
+    if reset in (True, "true", "1"):
+        trace.reset()
+    return report
+
+def submit_job(template_def, config, nodenum, terminal_id, return_type='full', export_type="column", concatenate=True):
+    """
+    Start the *calc_terminal* calculation in the background.
+
+    Returns *{"job_id": id, "new": bool}*, where *new* is False if the
+    same calculation was already submitted.  Poll *job_status(job_id)*
+    until the status is "done", then call *job_result(job_id)*.
+    """
+    template = Template(**template_def)
+    job_id, is_new = jobs.submit(
+        template, template_def, config, nodenum, terminal_id,
+        return_type=return_type, export_type=export_type,
+        concatenate=concatenate)
+    return {"job_id": job_id, "new": is_new}
+
+def job_status(job_id, since=0):
+    """
+    Return the status of the job, which is one of "queued", "running",
+    "done" or "error", with *done* out of *total* nodes completed.
+    *nodes* lists the completed nodes from index *since*.
+    """
+    status = jobs.status(job_id, since=int(since))
+    if status is None:
+        raise KeyError("job %r not found"%job_id)
+    return status
+
+def job_result(job_id):
+    """
+    Return the value of a finished job, as returned by *calc_terminal*.
+    """
+    status = jobs.status(job_id, since=-1)
+    if status is None:
+        raise KeyError("job %r not found"%job_id)
+    if status["status"] != jobs.DONE:
+        raise ValueError("job %r is %s"%(job_id, status["status"]))
+    result = jobs.result(job_id)
+    if result is None:
+        # The result was dropped from the cache; submit the job again.
+        raise KeyError("result for job %r not found"%job_id)
+    return result
+
 def initialize(config=None):
     if config is None:
         config = configure.load_config('config')
     configure.apply_config(user_config=config)
+    if config.get('expose_stats', False) and 'get_stats' not in api_methods:
+        expose(get_stats)
+    jobs_config = config.get('jobs', None)
+    if jobs_config:
+        jobs.configure(calc_terminal, **jobs_config)
+        for method in (submit_job, job_status, job_result):
+            if method.__name__ not in api_methods:
+                expose(method)
 
 if __name__ == '__main__':
     initialize()
@@ -0,0 +1,460 @@
+"""
+Run template calculations as background jobs.
+
+Long reductions tie up a server worker for the whole calculation when
+they are run inside the request.  Instead the client can call
+*submit_job* with the same arguments as *calc_terminal*, then poll
+*job_status* for the nodes completed so far and fetch the value with
+*job_result* once the status is "done".
+
+The job id is the fingerprint of the requested terminal and return type,
+so identical submissions from several clients share one job.  Finished
+jobs are reused for *JOB_TTL* seconds, except for templates with modules
+flagged *nocache*, which are run again for each submission.
+
+Jobs are queued with a broker selected in the server configuration::
+
+    "jobs": {"broker": "local", "workers": 2}
+
+runs the jobs on a pool of threads in the server process.  Jobs are only
+visible to the process that ran them, so this requires a single server
+process.  The job status is held in memory, but the results are stored
+in the configured cache.  Use::
+
+    "jobs": {"broker": "redis", "workers": 1, "params": {"host": "localhost"}}
+
+to put them on a redis list shared by all server processes.  With redis,
+each server process runs *workers* threads taking jobs from the list
+(use 0 for a web-only process), and extra worker processes can be started
+with::
+
+    python -m reductus.web_gui.jobs [config.json]
+
+Worker threads in the server process only run under uwsgi if it is
+started with *--enable-threads*.  Running jobs are kept alive by a
+heartbeat from the worker.  If the worker dies, the job is run again by
+the next submission after *JOB_LEASE* seconds.
+
+A singleton :class:`JobManager` is configured by :func:`.api.initialize`.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from reductus.dataflow import trace
+from reductus.dataflow.cache import get_cache
+from reductus.dataflow.calc import generate_fingerprint, _format_ordered
+
+#: Number of finished jobs retained by the local broker.
+JOB_HISTORY = 100
+
+#: Seconds that a finished job is kept and reused.
+JOB_TTL = 3600
+
+#: Seconds without a heartbeat before a running redis job is abandoned.
+JOB_LEASE = 30
+
+QUEUED, RUNNING, DONE, ERROR = "queued", "running", "done", "error"
+
+_current = threading.local()
+_listening = False
+
+def _record_span(span):
+    # Trace listener: spans are emitted from the thread evaluating the
+    # template, which is the job worker thread.  Templates evaluated within
+    # a node on the same thread, such as by the VSANS load steps, are not
+    # part of the job progress.
+    job = getattr(_current, 'job', None)
+    if job is not None and span.depth == 0:
+        broker, job_id = job
+        broker.progress(job_id, {
+            "node": span.node, "module": span.module_id,
+            "status": span.status, "wall": span.wall,
+        })
+
+def job_id(template, config, nodenum, terminal_id, options):
+    """
+    Return the job id for the calculation of *(nodenum, terminal_id)*.
+
+    *options* are the remaining *calc_terminal* arguments, which change
+    the form of the result but not the calculation.
+    """
+    from reductus.dataflow.calc import fingerprint_template
+    node_fp = fingerprint_template(template, config)[nodenum]
+    parts = (node_fp, terminal_id, str(_format_ordered(options)))
+    return generate_fingerprint(("job",) + parts)
+
+
+class LocalBroker(object):
+    """
+    Run jobs on a pool of *workers* threads in this process.
+    """
+    def __init__(self, workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(self, job_id, total, run, reuse=True):
+        """
+        Queue *run()* as *job_id* unless it is already queued or running,
+        or it is done and *reuse* is true.  Failed jobs are run again, as
+        are finished jobs whose result has been dropped from the cache.
+        """
+        with self._lock:
+            self._trim()
+            job = self._jobs.pop(job_id, None)
+            if job is not None and (
+                    job["status"] in (QUEUED, RUNNING)
+                    or (job["status"] == DONE and reuse
+                        and get_cache().exists(_result_key(job_id)))):
+                self._jobs[job_id] = job
+                return False
+            self._jobs[job_id] = {
+                "status": QUEUED, "total": total, "nodes": [],
+                "error": None, "finished": None,
+            }
+        self._pool.submit(self._run, job_id, run)
+        return True
+
+    def _trim(self):
+        # Drop expired jobs, then the oldest jobs beyond the history.
+        expired = time.time() - JOB_TTL
+        finished = [k for k, v in self._jobs.items()
+                    if v["finished"] is not None]
+        for k in finished:
+            if self._jobs[k]["finished"] < expired:
+                del self._jobs[k]
+        finished = [k for k in finished if k in self._jobs]
+        for k in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[k]
+
+    def _run(self, job_id, run):
+        self._update(job_id, status=RUNNING)
+        try:
+            result = run_job(self, job_id, run)
+            # Results can be large, so keep them in the cache rather than
+            # in the job table.
+            get_cache().store(_result_key(job_id), result)
+        except Exception as exc:
+            self._finish(job_id, status=ERROR, error=repr(exc))
+        else:
+            self._finish(job_id, status=DONE)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _finish(self, job_id, **fields):
+        # The number of nodes scheduled can differ from the total estimated
+        # on submission if the cache changed in the meantime.
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields, finished=time.time())
+            if job["status"] == DONE:
+                job["total"] = len(job["nodes"])
+
+    def progress(self, job_id, node):
+        with self._lock:
+            self._jobs[job_id]["nodes"].append(node)
+
+    def status(self, job_id, since=0):
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+            if job is None:
+                return None
+            return {
+                "status": job["status"], "total": job["total"],
+                "done": len(job["nodes"]), "nodes": job["nodes"][since:],
+                "error": job["error"],
+            }
+
+    def result(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+            if job is None or job["status"] != DONE:
+                return None
+        return get_cache().retrieve_many([_result_key(job_id)])[0]
+
+
+class RedisBroker(object):
+    """
+    Queue jobs on a redis list shared between server processes.
+
+    *params* are passed to *redis.Redis*.  Jobs are run by *workers*
+    threads in this process and by any :func:`run_worker` processes.
+    The submitted arguments, rather than the run function, are placed on
+    the queue, so *runner(\\*\\*args)* is called to evaluate them.
+    """
+    QUEUE = "reductus:jobs"
+
+    def __init__(self, runner, workers=1, params=None):
+        import redis
+        self._redis = redis.Redis(**(params or {}))
+        self._runner = runner
+        self._threads = []
+        for k in range(workers):
+            thread = threading.Thread(target=self.work, daemon=True,
+                                      name="job-%d"%k)
+            thread.start()
+            self._threads.append(thread)
+
+    def _key(self, job_id):
+        return "reductus:job:" + job_id
+
+    def submit(self, job_id, total, args, reuse=True):
+        key = self._key(job_id)
+        # Only the first submission creates the job; failed jobs, running
+        # jobs whose worker stopped sending heartbeats, and finished jobs
+        # which are not to be reused, are replaced so that they can be
+        # run again.
+        if not self._redis.hsetnx(key, "status", QUEUED):
+            pipe = self._redis.pipeline()
+            pipe.hget(key, "status")
+            pipe.exists(key + ":worker")
+            status, alive = pipe.execute()
+            status = status.decode() if status is not None else None
+            replace = (ERROR,) if reuse else (ERROR, DONE)
+            if status == RUNNING and not alive:
+                replace = (RUNNING,)
+            if status not in replace:
+                return False
+            self._redis.delete(key, key + ":nodes")
+            if not self._redis.hsetnx(key, "status", QUEUED):
+                return False
+        pipe = self._redis.pipeline()
+        pipe.hset(key, mapping={"total": total, "submitted": time.time()})
+        pipe.expire(key, JOB_TTL)
+        pipe.lpush(self.QUEUE, json.dumps({"job_id": job_id, "args": args}))
+        pipe.execute()
+        return True
+
+    def work(self, timeout=5):
+        """
+        Take jobs from the queue and run them until the process exits.
+        """
+        while True:
+            item = self._redis.brpop(self.QUEUE, timeout=timeout)
+            if item is None:
+                continue
+            request = json.loads(item[1])
+            self._run(request["job_id"], request["args"])
+
+    def _run(self, job_id, args):
+        import msgpack
+        key = self._key(job_id)
+        worker = key + ":worker"
+        # Set the status and the heartbeat together so that submit never
+        # sees a running job without a worker.
+        pipe = self._redis.pipeline()
+        pipe.hset(key, "status", RUNNING)
+        pipe.set(worker, 1, ex=JOB_LEASE)
+        pipe.execute()
+        stop = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(worker, stop),
+                                daemon=True, name="job-heartbeat")
+        beat.start()
+        try:
+            result = run_job(self, job_id, lambda: self._runner(**args))
+        except Exception as exc:
+            fields = {"status": ERROR, "error": repr(exc)}
+        else:
+            packed = msgpack.packb(result, use_bin_type=True)
+            done = self._redis.llen(key + ":nodes")
+            fields = {"status": DONE, "result": packed, "total": done}
+        finally:
+            stop.set()
+            beat.join()
+        pipe = self._redis.pipeline()
+        pipe.hset(key, mapping=fields)
+        pipe.delete(worker)
+        pipe.expire(key, JOB_TTL)
+        pipe.expire(key + ":nodes", JOB_TTL)
+        pipe.execute()
+
+    def _heartbeat(self, worker, stop):
+        while not stop.wait(JOB_LEASE/3):
+            try:
+                self._redis.set(worker, 1, ex=JOB_LEASE)
+            except Exception:
+                # Try again on the next beat; if the server stays away
+                # the job is run again by the next submission.
+                pass
+
+    def progress(self, job_id, node):
+        key = self._key(job_id) + ":nodes"
+        self._redis.rpush(key, json.dumps(node))
+
+    def status(self, job_id, since=0):
+        key = self._key(job_id)
+        pipe = self._redis.pipeline()
+        pipe.hmget(key, "status", "total", "error")
+        pipe.lrange(key + ":nodes", since, -1)
+        pipe.llen(key + ":nodes")
+        (status, total, error), nodes, done = pipe.execute()
+        if status is None:
+            return None
+        return {
+            "status": status.decode(), "total": int(total or 0), "done": done,
+            "nodes": [json.loads(node) for node in nodes],
+            "error": error.decode() if error is not None else None,
+        }
+
+    def result(self, job_id):
+        import msgpack
+        packed = self._redis.hget(self._key(job_id), "result")
+        return msgpack.unpackb(packed, raw=False) if packed is not None else None
+
+
+def _result_key(job_id):
+    return "job:" + job_id
+
+def run_job(broker, job_id, run):
+    """
+    Call *run()* for *job_id*, reporting the nodes as they complete.
+    """
+    _current.job = (broker, job_id)
+    try:
+        return run()
+    finally:
+        _current.job = None
+
+
+class JobManager(object):
+    """
+    Submit calculations to the configured broker.
+
+    *runner* is *calc_terminal*, or any function with the same arguments.
+    """
+    def __init__(self):
+        self._broker = None
+        self._runner = None
+
+    def configure(self, runner, broker="local", workers=2, params=None):
+        self._runner = runner
+        if broker == "redis":
+            self._broker = RedisBroker(runner, workers=workers, params=params)
+        else:
+            self._broker = LocalBroker(workers=workers)
+        global _listening
+        if not _listening:
+            trace.add_listener(_record_span)
+            _listening = True
+
+    @property
+    def broker(self):
+        if self._broker is None:
+            raise RuntimeError("jobs not configured")
+        return self._broker
+
+    def submit(self, template, template_def, config, nodenum, terminal_id,
+               **options):
+        """
+        Queue the calculation and return *(job_id, is_new)*.
+        """
+        from reductus.dataflow.calc import scheduled_nodes
+        from reductus.dataflow.core import lookup_module
+        jid = job_id(template, config, nodenum, terminal_id, options)
+        # calc_terminal evaluates lazily, skipping nodes it doesn't need.
+        total = len(scheduled_nodes(
+            template, config, target=(nodenum, terminal_id), lazy=True))
+        # Results depending on nocache modules can change between runs.
+        reuse = all(lookup_module(template.modules[node]['module']).cached
+                    for node, _ in template.ordered(target=nodenum))
+        args = dict(template_def=template_def, config=config,
+                    nodenum=nodenum, terminal_id=terminal_id, **options)
+        if isinstance(self.broker, RedisBroker):
+            is_new = self.broker.submit(jid, total, args, reuse=reuse)
+        else:
+            is_new = self.broker.submit(
+                jid, total, lambda: self._runner(**args), reuse=reuse)
+        return jid, is_new
+
+    def status(self, job_id, since=0):
+        return self.broker.status(job_id, since=since)
+
+    def result(self, job_id):
+        return self.broker.result(job_id)
+
+
+# Singleton job manager for the server process
+JOB_MANAGER = JobManager()
+
+# direct access to singleton methods
+configure = JOB_MANAGER.configure
+submit = JOB_MANAGER.submit
+status = JOB_MANAGER.status
+result = JOB_MANAGER.result
+
+
+def run_worker(config=None):
+    """
+    Run jobs from the redis queue in this process.
+    """
+    from reductus.web_gui import api
+    from reductus.dataflow.configure import load_config
+    if config is None:
+        config = load_config('config')
+    # This process only runs jobs, so take them on the main thread.
+    config = dict(config, jobs=dict(config.get('jobs', {}), workers=0))
+    api.initialize(config)
+    JOB_MANAGER.broker.work()
+
+def main():
+    import sys
+    config = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rt') as fid:
+            config = json.loads(fid.read())
+    run_worker(config)
+
+
+
+def test_local_broker():
+    from reductus.dataflow.cache import CACHE_MANAGER, memory_cache
+    CACHE_MANAGER.use_memory()
+    CACHE_MANAGER._cache = memory_cache()
+    broker = LocalBroker(workers=1)
+    def wait(job_id):
+        deadline = time.time() + 10
+        while (broker.status(job_id)["status"] in (QUEUED, RUNNING)
+               and time.time() < deadline):
+            time.sleep(0.01)
+        return broker.status(job_id)
+    # Spans from templates evaluated within a node are not counted, failed
+    # jobs are run again, and finished jobs are run again unless reused.
+    def run():
+        _record_span(trace.NodeSpan(0, "a.load", "fp0", "calculated", 0., 1.))
+        _record_span(trace.NodeSpan(0, "b.load", "fp2", "calculated", 0., 1., depth=1))
+        return "value"
+    def fail():
+        raise ValueError("bad")
+    trace.add_listener(_record_span)
+    try:
+        assert broker.submit("nested", 2, run)
+        assert broker.submit("error", 1, fail)
+        status, error = wait("nested"), wait("error")
+        assert status["done"] == status["total"] == 1
+        assert error["status"] == ERROR and "bad" in error["error"]
+        assert broker.submit("error", 1, fail)
+        assert not broker.submit("nested", 2, run)
+        assert broker.submit("nested", 2, run, reuse=False)
+        wait("nested")
+    finally:
+        trace.remove_listener(_record_span)
+    assert broker.status("missing") is None
+    # The result is kept in the cache rather than in the job table, and
+    # the job is run again if the cache drops it.
+    assert "result" not in broker._jobs["nested"]
+    assert broker.result("nested") == "value"
+    CACHE_MANAGER.delete(_result_key("nested"))
+    assert broker.result("nested") is None
+    assert broker.submit("nested", 2, run)
+    wait("nested")
+    assert broker.result("nested") == "value"
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,7 @@ import os, sys, posixpath
 import traceback
 import logging
 
-from flask import Flask, request, make_response, redirect, send_from_directory
+from flask import Flask, Response, request, make_response, redirect, send_from_directory
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 import msgpack as msgpack_converter
@@ -28,8 +28,15 @@ mimetypes.add_type("text/javascript", ".mjs")
 mimetypes.add_type("image/png", ".png")
 mimetypes.add_type("image/svg+xml", ".svg")
 
+#: Accept type for msgpack with numpy arrays packed as binary buffers,
+#: as described in :mod:`reductus.dataflow.lib.msgpack_ndarray`.
+BINARY_MSGPACK = "application/x-msgpack-ndarray"
+RETURN_TYPES = ["application/json", "application/msgpack", BINARY_MSGPACK]
+
 def create_app(config=None):
     from reductus.web_gui import api
+    from reductus.dataflow.data import binary_arrays
+    from reductus.dataflow.lib.msgpack_ndarray import iter_packb
 
     RPC_ENDPOINT = '/RPC2'
     STATIC_FOLDER = "webreduce"
@@ -76,16 +83,29 @@ def create_app(config=None):
             else:
                 real_kwargs = request.get_json() if request.get_data() else {}
             return_type = request.headers.get("Accept", "application/msgpack")
-            if return_type not in ["application/json", "application/msgpack"]:
+            if return_type not in RETURN_TYPES:
                 # fall back to application/json for debugging GET requests
                 return_type = "application/json"
-            if return_type not in ["application/json", "application/msgpack"]:
+            if return_type not in RETURN_TYPES:
                 code = 406
-                content = {'exception': 
+                content = {'exception':
                     'no valid Accept return type provided. \
-                    (leave unspecified or use one of application/json or application/msgpack)'}
+                    (leave unspecified or use one of %s)' % ", ".join(RETURN_TYPES)}
                 return_type = "application/json"
                 packed = json.dumps(content)
+            elif return_type == BINARY_MSGPACK:
+                # Arrays are sent as binary buffers and the response is
+                # streamed as it is packed.  The content is computed before
+                # the response starts so that errors are reported normally,
+                # and the setting is restored while the stream is consumed,
+                # which may happen on another thread.
+                with binary_arrays():
+                    content = mfunc(*args, **real_kwargs)
+                def stream(content):
+                    with binary_arrays():
+                        for piece in iter_packb(content):
+                            yield piece
+                return Response(stream(content), mimetype=return_type)
             else:
                 content = mfunc(*args, **real_kwargs)
                 if return_type == "application/msgpack":
@@ -108,6 +128,33 @@ def create_app(config=None):
         app.add_url_rule(path, path, wrapped, methods=["POST", "GET"])
         app.add_url_rule(shortpath, shortpath, wrapped, methods=["POST", "GET"])
 
+    if 'job_status' in api.api_methods:
+        @app.route('/jobs/<job_id>/events')
+        def job_events(job_id):
+            """
+            Stream the job status as server-sent events until it finishes.
+
+            This holds a server worker for the length of the job, so
+            polling job_status is preferred when workers are scarce.
+            """
+            import time
+            from flask import stream_with_context, abort
+            try:
+                first = api.job_status(job_id)
+            except KeyError:
+                abort(404)
+            def events():
+                status, since = first, 0
+                while True:
+                    since += len(status["nodes"])
+                    yield "data: %s\n\n"%json.dumps(status)
+                    if status["status"] in ("done", "error"):
+                        break
+                    time.sleep(0.5)
+                    status = api.job_status(job_id, since=since)
+            return Response(stream_with_context(events()),
+                            mimetype="text/event-stream")
+
     from reductus.rev import print_revision
     print_revision()
 